@@ -200,6 +200,35 @@ class Config:
     # data storage: 'GCP' for Google Cloud Platform, 'file' for local storage
     QUETZAL_DATA_STORAGE = os.environ.get('QUETZAL_DATA_STORAGE', 'GCP')
     QUETZAL_BACKGROUND_JOBS = bool(os.environ.get('QUETZAL_BACKGROUND_JOBS', False))
+    # digests of the file contents saved in base metadata besides the md5sum:
+    # a comma-separated list of 'sha256' and 'crc32c', or an empty string
+    QUETZAL_EXTRA_DIGESTS = [name for name in
+                             os.environ.get('QUETZAL_EXTRA_DIGESTS', 'sha256,crc32c').split(',')
+                             if name]
+    # compute the extra digests on a background task, after the upload response
+    QUETZAL_ASYNC_DIGESTS = bool(os.environ.get('QUETZAL_ASYNC_DIGESTS', False))
+    # codec used to compress the contents of uploaded files: 'zstd', or an empty
+    # string to store them unchanged
+    QUETZAL_STORAGE_CODEC = os.environ.get('QUETZAL_STORAGE_CODEC') or None
+    QUETZAL_STORAGE_CODEC_LEVEL = int(os.environ.get('QUETZAL_STORAGE_CODEC_LEVEL') or 3)
+    # Cache-Control directives of the contents of committed files, which never
+    # change; use 'public' instead of 'private' to let shared caches keep them
+    QUETZAL_FILE_CACHE_CONTROL = os.environ.get('QUETZAL_FILE_CACHE_CONTROL') or \
+        'private, max-age=31536000, immutable'
+    # reference the committed contents instead of keeping the uploaded copy
+    # when an uploaded file has the checksum and size of a committed file
+    QUETZAL_UPLOAD_DEDUP = bool(os.environ.get('QUETZAL_UPLOAD_DEDUP', False))
+    # number of files opened ahead of the one being sent on archive downloads,
+    # which is also the number of threads used by each archive download
+    QUETZAL_ARCHIVE_PREFETCH = int(os.environ.get('QUETZAL_ARCHIVE_PREFETCH') or 4)
+    # minimum age in seconds of the unreferenced stored files deleted by the
+    # garbage collection, which protects the files being uploaded or committed
+    QUETZAL_GC_GRACE_PERIOD = int(os.environ.get('QUETZAL_GC_GRACE_PERIOD') or 86400)
+    # age in seconds after which the garbage collection deletes the upload
+    # sessions that were not finalized, with their staged chunks
+    QUETZAL_UPLOAD_EXPIRATION = int(os.environ.get('QUETZAL_UPLOAD_EXPIRATION') or 7 * 86400)
+    # run the garbage collection every day as a background job
+    QUETZAL_GC_JOB = bool(os.environ.get('QUETZAL_GC_JOB', False))
 
     # Quetzal-GCP storage configuration
     QUETZAL_GCP_CREDENTIALS = os.environ.get('QUETZAL_GCP_CREDENTIALS') or \
@@ -208,10 +237,39 @@ class Config:
         'gs://quetzal-dev-data'
     QUETZAL_GCP_BACKUP_BUCKET = os.environ.get('QUETZAL_GCP_BACKUP_BUCKET') or \
         'gs://quetzal-dev-backups'
+    # shared bucket where workspaces are saved as prefixes, such as
+    # 'gs://quetzal-dev-data/workspaces', or an empty string to create a
+    # bucket for each workspace. A prefix of the data bucket makes commits
+    # same-bucket copies
+    QUETZAL_GCP_WORKSPACE_BUCKET = os.environ.get('QUETZAL_GCP_WORKSPACE_BUCKET') or None
+    # GCP download mode: 'app' to send the file contents from the application,
+    # 'signed_url' to redirect to a short-lived signed URL of the object
+    QUETZAL_GCP_DOWNLOAD_MODE = os.environ.get('QUETZAL_GCP_DOWNLOAD_MODE') or 'app'
+    QUETZAL_GCP_SIGNED_URL_EXPIRATION = int(os.environ.get('QUETZAL_GCP_SIGNED_URL_EXPIRATION') or 300)
+    # number of concurrent batch copy requests when committing a workspace
+    QUETZAL_GCP_COMMIT_WORKERS = int(os.environ.get('QUETZAL_GCP_COMMIT_WORKERS') or 16)
+    # seconds during which bucket objects are reused without being created again
+    QUETZAL_GCP_BUCKET_CACHE_TTL = int(os.environ.get('QUETZAL_GCP_BUCKET_CACHE_TTL') or 300)
+    # local directory where downloaded files are cached, or an empty string to
+    # disable the download cache; maximum size of the cache and of each file in
+    # it, in bytes
+    QUETZAL_GCP_CACHE_DIR = os.environ.get('QUETZAL_GCP_CACHE_DIR') or None
+    QUETZAL_GCP_CACHE_SIZE = int(os.environ.get('QUETZAL_GCP_CACHE_SIZE') or 10 << 30)
+    QUETZAL_GCP_CACHE_MAX_FILE_SIZE = int(os.environ.get('QUETZAL_GCP_CACHE_MAX_FILE_SIZE') or 1 << 30)
+    # seconds that a download waits for a concurrent download of the same file
+    # to fill the cache, before downloading it directly
+    QUETZAL_GCP_CACHE_FILL_WAIT = float(os.environ.get('QUETZAL_GCP_CACHE_FILL_WAIT') or 10)
 
     # Quetzal-file storage configuration
     QUETZAL_FILE_DATA_DIR = os.environ.get('QUETZAL_FILE_DATA_DIR') or '/data'
     QUETZAL_FILE_USER_DATA_DIR = os.environ.get('QUETZAL_FILE_USER_DATA_DIR') or '/workspaces'
+    # file download mode: 'app' to send the file contents from the application,
+    # 'nginx' to delegate it to nginx with a X-Accel-Redirect header on an
+    # internal location, 'sendfile' to delegate it with a X-Sendfile header
+    QUETZAL_FILE_DOWNLOAD_MODE = os.environ.get('QUETZAL_FILE_DOWNLOAD_MODE') or 'app'
+    QUETZAL_FILE_ACCEL_PREFIX = os.environ.get('QUETZAL_FILE_ACCEL_PREFIX') or '/_quetzal_files'
+    # number of concurrent file copies when committing a workspace
+    QUETZAL_FILE_COMMIT_WORKERS = int(os.environ.get('QUETZAL_FILE_COMMIT_WORKERS') or 4)
 
     def __init__(self):
         # Dynamic properties: configuration elements that must change according
@@ -0,0 +1,138 @@
+"""metadata head table
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-16 17:40:52.204417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+# Same functions and triggers as quetzal.app.models.METADATA_HEAD_TRIGGERS
+triggers = """
+CREATE OR REPLACE FUNCTION metadata_head_refresh(file_ids uuid[], head_family_name varchar, head_workspace_id integer)
+RETURNS void AS $$
+BEGIN
+    DELETE FROM metadata_head
+    WHERE id_file = ANY(file_ids)
+      AND family_name = head_family_name
+      AND fk_workspace_id IS NOT DISTINCT FROM head_workspace_id;
+    INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+    SELECT metadata.id_file, family.name, family.fk_workspace_id, max(metadata.id)
+    FROM metadata JOIN family ON family.id = metadata.fk_family_id
+    WHERE metadata.id_file = ANY(file_ids)
+      AND family.name = head_family_name
+      AND family.fk_workspace_id IS NOT DISTINCT FROM head_workspace_id
+    GROUP BY metadata.id_file, family.name, family.fk_workspace_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION metadata_head_on_metadata() RETURNS trigger AS $$
+DECLARE
+    head_family_name varchar;
+    head_workspace_id integer;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.fk_family_id = NEW.fk_family_id AND OLD.id_file = NEW.id_file THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT name, fk_workspace_id INTO head_family_name, head_workspace_id
+        FROM family WHERE id = OLD.fk_family_id;
+        PERFORM metadata_head_refresh(ARRAY[OLD.id_file], head_family_name, head_workspace_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT name, fk_workspace_id INTO head_family_name, head_workspace_id
+        FROM family WHERE id = NEW.fk_family_id;
+        IF head_workspace_id IS NULL THEN
+            INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+            VALUES (NEW.id_file, head_family_name, NULL, NEW.id)
+            ON CONFLICT (id_file, family_name) WHERE fk_workspace_id IS NULL
+            DO UPDATE SET fk_metadata_id = GREATEST(metadata_head.fk_metadata_id, EXCLUDED.fk_metadata_id);
+        ELSE
+            INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+            VALUES (NEW.id_file, head_family_name, head_workspace_id, NEW.id)
+            ON CONFLICT (fk_workspace_id, id_file, family_name) WHERE fk_workspace_id IS NOT NULL
+            DO UPDATE SET fk_metadata_id = GREATEST(metadata_head.fk_metadata_id, EXCLUDED.fk_metadata_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION metadata_head_on_family() RETURNS trigger AS $$
+DECLARE
+    file_ids uuid[];
+BEGIN
+    SELECT array_agg(DISTINCT id_file) INTO file_ids FROM metadata WHERE fk_family_id = NEW.id;
+    IF file_ids IS NOT NULL THEN
+        PERFORM metadata_head_refresh(file_ids, OLD.name, OLD.fk_workspace_id);
+        PERFORM metadata_head_refresh(file_ids, NEW.name, NEW.fk_workspace_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER metadata_head_metadata
+AFTER INSERT OR UPDATE OF id_file, fk_family_id OR DELETE ON metadata
+FOR EACH ROW EXECUTE PROCEDURE metadata_head_on_metadata();
+
+CREATE TRIGGER metadata_head_family
+AFTER UPDATE OF name, fk_workspace_id ON family
+FOR EACH ROW
+WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.fk_workspace_id IS DISTINCT FROM NEW.fk_workspace_id)
+EXECUTE PROCEDURE metadata_head_on_family();
+"""
+
+drop_triggers = """
+DROP FUNCTION IF EXISTS metadata_head_on_family() CASCADE;
+DROP FUNCTION IF EXISTS metadata_head_on_metadata() CASCADE;
+DROP FUNCTION IF EXISTS metadata_head_refresh(uuid[], varchar, integer);
+"""
+
+# The latest metadata of each file, family name and workspace (or global)
+backfill = """
+INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+SELECT metadata.id_file, family.name, family.fk_workspace_id, max(metadata.id)
+FROM metadata JOIN family ON family.id = metadata.fk_family_id
+GROUP BY metadata.id_file, family.name, family.fk_workspace_id;
+"""
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('metadata_head',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('id_file', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('family_name', sa.String(length=60), nullable=False),
+    sa.Column('fk_workspace_id', sa.Integer(), nullable=True),
+    sa.Column('fk_metadata_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['fk_metadata_id'], ['metadata.id'], ),
+    sa.ForeignKeyConstraint(['fk_workspace_id'], ['workspace.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_metadata_head_id_file'), 'metadata_head', ['id_file'], unique=False)
+    op.create_index('uq_metadata_head_global', 'metadata_head', ['id_file', 'family_name'], unique=True,
+                    postgresql_where=sa.text('fk_workspace_id IS NULL'))
+    op.create_index('uq_metadata_head_workspace', 'metadata_head', ['fk_workspace_id', 'id_file', 'family_name'],
+                    unique=True, postgresql_where=sa.text('fk_workspace_id IS NOT NULL'))
+    # ### end Alembic commands ###
+    op.execute(backfill)
+    op.execute(triggers)
+
+
+def downgrade():
+    op.execute(drop_triggers)
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index('uq_metadata_head_workspace', table_name='metadata_head')
+    op.drop_index('uq_metadata_head_global', table_name='metadata_head')
+    op.drop_index(op.f('ix_metadata_head_id_file'), table_name='metadata_head')
+    op.drop_table('metadata_head')
+    # ### end Alembic commands ###
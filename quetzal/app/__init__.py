@@ -105,8 +105,9 @@ def create_app(config_name=None):
     from .models import (
         ApiKey,
         User, Role,
+        DataObject, DataObjectReference,
         Metadata, Family, FileState, MetadataQuery, QueryDialect,
-        Workspace, WorkspaceState
+        UploadSession, Workspace, WorkspaceState
     )
 
     @flask_app.shell_context_processor
@@ -118,11 +119,14 @@ def create_app(config_name=None):
             'User': User,
             'Role': Role,
             'ApiKey': ApiKey,
+            'DataObject': DataObject,
+            'DataObjectReference': DataObjectReference,
             'Metadata': Metadata,
             'Family': Family,
             'FileState': FileState,
             'MetadataQuery': MetadataQuery,
             'QueryDialect': QueryDialect,
+            'UploadSession': UploadSession,
             'Workspace': Workspace,
             'WorkspaceState': WorkspaceState,
         }
@@ -167,5 +171,10 @@ def create_app(config_name=None):
         # Backup logs at midnight + 5 minutes so that the timed rolling logs do their rollover
         scheduler.add_job(backup_logs, trigger=CronTrigger(hour=0, minute=5),
                           args=(flask_app,), misfire_grace_time=3600*6)
+        if flask_app.config['QUETZAL_GC_JOB']:
+            from quetzal.app.background import collect_garbage
+            # Delete unreferenced stored files at night
+            scheduler.add_job(collect_garbage, trigger=CronTrigger(hour=3),
+                              args=(flask_app,), misfire_grace_time=3600*6)
 
     return flask_app
@@ -1,10 +1,12 @@
 from . import file
 from . import query
+from . import upload
 from . import workspace
 
 
 __all__ = (
     'file',
     'query',
+    'upload',
     'workspace',
 )
@@ -1,4 +1,9 @@
+import collections
+import concurrent.futures
 import datetime
+import hashlib
+import itertools
+import json
 import logging
 import os
 import pathlib
@@ -7,17 +12,34 @@ import tempfile
 import urllib.parse
 from uuid import uuid4
 
-from flask import current_app, request, send_file
+from flask import current_app, redirect, request, send_file, stream_with_context
 from requests import codes
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import JSONB
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import LimitedStream
 
 from quetzal.app import db
-from quetzal.app.helpers.google_api import get_bucket, get_object
-from quetzal.app.helpers.files import split_check_path, get_readable_info
+from quetzal.app.helpers.cache import get_disk_cache
+from quetzal.app.helpers.google_api import (
+    BlobReader, get_bucket, get_object, get_signed_url, split_location
+)
+from quetzal.app.helpers.files import (
+    codec_available, decode_stream, iter_archive, split_check_path,
+    stream_archive, HashingReader
+)
 from quetzal.app.helpers.pagination import paginate
 from quetzal.app.api.data import storage
+from quetzal.app.api.data.filters import apply_filters
+from quetzal.app.api.data.helpers import (
+    discard_uploads, extra_digests, find_stored_contents, get_base_family,
+    get_writable_workspace, now, reference_contents, schedule_digests,
+    upload_digests, verify_filename_path
+)
+from quetzal.app.api.data.query import file_ids as query_file_ids
 from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
 from quetzal.app.models import (
-    BaseMetadataKeys, Family, FileState, Workspace, Metadata
+    Family, FileState, Workspace, Metadata, MetadataHead, MetadataQuery
 )
 from quetzal.app.security import (
     PublicReadPermission, ReadWorkspacePermission, WriteWorkspacePermission
@@ -26,6 +48,25 @@ from quetzal.app.security import (
 
 logger = logging.getLogger(__name__)
 
+BULK_INSERT_SIZE = 1000
+""" Number of metadata entries inserted on each statement of a bulk insert """
+
+BULK_UPDATE_STATEMENT = text(
+    'UPDATE metadata SET json = changes.json '
+    'FROM jsonb_to_recordset(:rows) AS changes(id integer, json jsonb) '
+    'WHERE metadata.id = changes.id'
+).bindparams(bindparam('rows', type_=JSONB))
+""" Update of the json of many metadata entries, given as ``{'id': ..., 'json': ...}`` rows """
+
+ARCHIVE_MANIFEST_NAME = 'manifest.json'
+""" Name of the archive entry with the metadata of the files of an archive download """
+
+ARCHIVE_BATCH_SIZE = 1000
+""" Number of files whose metadata is read at once on an archive download """
+
+ARCHIVE_MANIFEST_MEMORY = 1 << 20
+""" Size in bytes of the manifest of an archive download kept in memory before using a temporary file """
+
 
 def create(*, wid, content=None, user, token_info=None):
     """ Create a file on a workspace
@@ -80,21 +121,7 @@ def create(*, wid, content=None, user, token_info=None):
                            detail=f'Cannot add files to a workspace on {workspace.state.name} state')
 
     # Get the base metadata family in order to put the basic metadata info.
-    base_family = workspace.families.filter_by(name='base').first()
-
-    # This query should not be None because all workspaces have a 'base' family,
-    # but in case this happens, it would be a problem of the current
-    # implementation (possibly by manually doing things like in unit tests).
-    # Just in case, we will raise an exception
-    if base_family is None:
-        logger.error('Workspace %d does not have base family metadata!',
-                     workspace.id)
-        raise APIException(status=codes.server_error,
-                           title='Incorrect workspace configuration',
-                           detail='Cannot add files to workspace because it does '
-                                  'not have the "base" family. This situation '
-                                  'should not happen and will be reported to '
-                                  'the administrator')
+    base_family = get_base_family(workspace)
 
     # Manage temporary parameter
     temporary = (request.args.get('temporary', 'false').capitalize() == 'True')
@@ -105,7 +132,6 @@ def create(*, wid, content=None, user, token_info=None):
 
     #  Create metadata object
     meta = Metadata(id_file=uuid4(), family=base_family)
-    md5, size = get_readable_info(content)
     path, filename = split_check_path(content.filename)
     if 'path' in request.args:
         path = request.args['path']
@@ -113,43 +139,274 @@ def create(*, wid, content=None, user, token_info=None):
         'id': str(meta.id_file),
         'filename': filename,
         'path': path,
-        'size': size,
-        'checksum': md5,
-        'date': _now(),
+        'size': None,
+        'checksum': None,
+        'date': now(),
         'url': '',
         'state': state.name,
+        **{name: None for name in extra_digests()},
     }
-    db.session.add(meta)
 
     # Send file to workspace bucket (not in the data bucket, this is done
-    # during the workspace commit operation)
+    # during the workspace commit operation).
+    # The md5sum and size are calculated while the storage backend reads the
+    # contents, so that the file is only read once
+    reader = HashingReader(content, upload_digests())
+    codec = _storage_codec()
     try:
         url, obj = storage.upload(str(pathlib.Path(path) / filename),
-                                  content,
-                                  workspace.data_url)
+                                  reader,
+                                  workspace.data_url,
+                                  codec)
+        md5, size = reader.finish()
     except:
         logger.warning('Failed to upload file', exc_info=True)
         raise APIException(status=codes.server_error,
                            title='Failed to upload file',
                            detail='Could not upload file')
 
-    try:
-        storage.set_permissions(obj, workspace.owner)
-    except:
-        # TODO: delete file if it was created
-        logger.warning('Failed to set file permissions', exc_info=True)
-        raise APIException(status=codes.server_error,
-                           title='Failed to upload file',
-                           detail='Could not update file permissions')
+    # Save model. The size and checksum are the ones of the contents before
+    # encoding them with the storage codec
+    meta.update({
+        'size': size,
+        'checksum': md5,
+        'url': url,
+        **reader.digests(),
+    })
+    if codec is not None:
+        meta.update({'codec': codec})
+
+    stored = find_stored_contents([(md5, size)]) if current_app.config['QUETZAL_UPLOAD_DEDUP'] else {}
+    if (md5, size) in stored:
+        # The contents were already committed: the uploaded copy is not needed
+        meta.json = reference_contents(meta.json, stored[(md5, size)])
+    else:
+        try:
+            storage.set_permissions(obj, workspace.owner)
+        except:
+            # TODO: delete file if it was created
+            logger.warning('Failed to set file permissions', exc_info=True)
+            raise APIException(status=codes.server_error,
+                               title='Failed to upload file',
+                               detail='Could not update file permissions')
 
-    # Save model
-    meta.json['url'] = url
     db.session.add(meta)
     db.session.commit()
+    if (md5, size) in stored:
+        discard_uploads([url])
+    schedule_digests([meta.id_file])
 
     return meta.json, codes.created
 
 
+def create_reference(*, wid, body, user, token_info=None):
+    """ Create a file on a workspace with contents that are already stored
+
+    This function is the implementation of the reference file endpoint in
+    the Quetzal API. Clients send the checksum and size of a file instead of
+    its contents. When some committed file has the same contents, the new
+    file is created with a reference to them and its contents do not need to
+    be uploaded. Otherwise, the response is a not found error and the
+    contents must be uploaded.
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier where the file will be created.
+    body: dict
+        File details: checksum, size, filename, path and temporary.
+    user: quetzal.app.models.User
+        User that owns the file. This parameter is set by connexion.
+    token_info:
+        Authentication token. This parameter is set by connexion.
+
+    Returns
+    -------
+    details: dict
+        File details object.
+    code: int
+        HTTP response code.
+
+    API endpoints
+    -------------
+    * `POST /api/v1/data/workspaces/{wid}/files/reference`
+      :redoc:`See in redoc <operation/workspace_file.create_reference>`.
+
+    """
+    workspace = get_writable_workspace(wid)
+    base_family = get_base_family(workspace)
+
+    path, filename = split_check_path(body['filename'])
+    if 'path' in body:
+        path = body['path']
+    verify_filename_path(filename, path)
+
+    content = (body['checksum'].lower(), body['size'])
+    data_object = find_stored_contents([content]).get(content)
+    if data_object is None:
+        raise ObjectNotFoundException(status=codes.not_found,
+                                      title='Contents not found',
+                                      detail=f'There are no stored contents with checksum '
+                                             f'{content[0]} and size {content[1]}. '
+                                             f'Upload the file contents instead.')
+
+    state = FileState.TEMPORARY if body.get('temporary', False) else FileState.READY
+    meta = Metadata(id_file=uuid4(), family=base_family)
+    meta.json = reference_contents({
+        'id': str(meta.id_file),
+        'filename': filename,
+        'path': path,
+        'size': data_object.size,
+        'checksum': data_object.checksum,
+        'date': now(),
+        'url': '',
+        'state': state.name,
+        **{name: None for name in extra_digests()},
+        **_stored_digests(data_object),
+    }, data_object)
+    db.session.add(meta)
+    db.session.commit()
+    schedule_digests([meta.id_file])
+
+    return meta.json, codes.created
+
+
+def create_archive(*, wid, content=None, user, token_info=None):
+    """ Create many files on a workspace from an archive
+
+    This function is the implementation of the upload archive endpoint in the
+    Quetzal API. It accepts a tar (optionally compressed) or a zip archive and
+    creates one file for each regular file in the archive, preserving the path
+    of each entry in its base metadata.
+
+    In contrast to :py:func:`create`, the permission and workspace
+    verifications are done once for all files and the base metadata entries
+    are inserted in batches, in a single transaction. If any file fails, no
+    file is created.
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier where the files will be uploaded.
+    content: file-like
+        Contents of the archive.
+    user: quetzal.app.models.User
+        User that owns the files. This parameter is set by connexion.
+    token_info:
+        Authentication token. This parameter is set by connexion.
+
+    Returns
+    -------
+    details: list
+        List of file details objects.
+    code: int
+        HTTP response code.
+
+    API endpoints
+    -------------
+    * `POST /api/v1/data/workspaces/{wid}/files/archive`
+      :redoc:`See in redoc <operation/workspace_file.create_archive>`.
+
+    """
+    if content is None:
+        raise APIException(status=codes.bad_request,
+                           title='Missing archive content',
+                           detail='Cannot create files without an archive')
+
+    workspace = get_writable_workspace(wid)
+    base_family = get_base_family(workspace)
+
+    # Manage temporary and path parameters
+    temporary = (request.args.get('temporary', 'false').capitalize() == 'True')
+    state = FileState.TEMPORARY if temporary else FileState.READY
+    prefix = request.args.get('path', '')
+    if prefix:
+        verify_filename_path('', prefix)
+
+    try:
+        entries = iter_archive(content)
+    except ValueError:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid archive',
+                           detail='Archive must be a tar or zip file')
+
+    date = now()
+    codec = _storage_codec()
+    rows = []
+    created = []
+    uploaded_urls = []
+    uploaded_objs = []
+    duplicated_urls = set()
+
+    def insert_rows():
+        if current_app.config['QUETZAL_UPLOAD_DEDUP']:
+            stored = find_stored_contents((row['json']['checksum'], row['json']['size'])
+                                           for row in rows)
+            for row in rows:
+                content = (row['json']['checksum'], row['json']['size'])
+                if content in stored:
+                    duplicated_urls.add(row['json']['url'])
+                    row['json'] = reference_contents(row['json'], stored[content])
+        db.session.execute(Metadata.__table__.insert().values(rows))
+        created.extend(row['json'] for row in rows)
+        rows.clear()
+
+    try:
+        for name, entry in entries:
+            path, filename = split_check_path(name)
+            path = os.path.normpath(os.path.join(prefix, path)) if prefix else path
+            reader = HashingReader(entry, upload_digests())
+            url, obj = storage.upload(str(pathlib.Path(path) / filename),
+                                      reader,
+                                      workspace.data_url,
+                                      codec)
+            uploaded_urls.append(url)
+            uploaded_objs.append(obj)
+            md5, size = reader.finish()
+
+            file_id = uuid4()
+            meta_json = {
+                'id': str(file_id),
+                'filename': filename,
+                'path': path,
+                'size': size,
+                'checksum': md5,
+                'date': date,
+                'url': url,
+                'state': state.name,
+                **{name: None for name in extra_digests()},
+                **reader.digests(),
+            }
+            if codec is not None:
+                meta_json['codec'] = codec
+            rows.append({'id_file': file_id, 'json': meta_json, 'fk_family_id': base_family.id})
+
+            if len(rows) >= BULK_INSERT_SIZE:
+                insert_rows()
+
+        if rows:
+            insert_rows()
+
+        # Permissions are set on all files at once, so that the storage
+        # backend can group them in fewer requests
+        storage.set_permissions_many([obj for url, obj in zip(uploaded_urls, uploaded_objs)
+                                      if url not in duplicated_urls],
+                                     workspace.owner)
+
+    except:
+        logger.warning('Failed to upload archive', exc_info=True)
+        db.session.rollback()
+        discard_uploads(uploaded_urls)
+        raise APIException(status=codes.server_error,
+                           title='Failed to upload archive',
+                           detail='Could not upload files from the archive')
+
+    db.session.commit()
+    discard_uploads(duplicated_urls)
+    schedule_digests([meta_json['id'] for meta_json in created])
+    return created, codes.created
+
+
 def delete(*, wid, uuid, user, token_info=None):
 
     # TODO: deleting a file that exists in the global workspace means clearing
@@ -178,8 +435,7 @@ def delete(*, wid, uuid, user, token_info=None):
 
     # Before marking the file for deletion, we must ensure that this workspace
     # has all the metadata families that reference this file
-    latest_meta_committed = Metadata.get_latest_global(uuid)
-    related_families = set(m.family.name for m in latest_meta_committed)
+    related_families = set(_all_metadata(uuid))
     related_families.add('base')
     if related_families > set(f.name for f in workspace.families):
         # Note the > is the superset operator
@@ -264,21 +520,7 @@ def update_metadata(*, wid, uuid, body):
     # * The "id" entry cannot be changed for any family
     # * The family must have been declared on the creation of the workspace
     for name, content in body['metadata'].items():
-        # Verification: base metadata
-        if name == 'base':
-            if content.keys() - {'path', 'filename'}:
-                # see RFC 7231 or https://stackoverflow.com/a/3290198/227103
-                raise APIException(status=codes.bad_request,
-                                   title='Invalid metadata modification',
-                                   detail='Cannot change metadata family "base" except for its path')
-            # Do some verifications on the filename and path
-            _verify_filename_path(content.get('filename', ''), content.get('path', ''))
-
-        # Verification: id cannot be changed
-        if 'id' in content.keys():
-            raise APIException(status=codes.bad_request,
-                               title='Invalid metadata modification',
-                               detail='Cannot change metadata "id" entry')
+        _verify_metadata_change(name, content)
 
         # Family exists on this workspace?
         family = workspace.families.filter_by(name=name).first()
@@ -324,6 +566,149 @@ def update_metadata(*, wid, uuid, body):
     return {"id": uuid, "metadata": meta}, codes.ok
 
 
+def update_metadata_many(*, wid, body):
+    """ Update the metadata of many files of a workspace
+
+    This function is the implementation of the bulk modification of
+    metadata, which applies the same changes as :py:func:`update_metadata`
+    on many files in a single transaction. Instead of a few queries by file
+    and family, the latest metadata of all the files is retrieved with one
+    query by family, and the changes are written with a few set-based
+    statements: new metadata entries for the files whose latest metadata of
+    a family is committed, and in-place updates for the files that already
+    have metadata of that family on this workspace.
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier.
+    body: list
+        Changes of each file, as dictionaries with the file ``id`` and its
+        ``metadata`` changes by family.
+
+    Returns
+    -------
+    files: list
+        File details with the updated metadata of the changed families.
+
+    """
+    workspace = Workspace.get_or_404(wid)
+
+    if not WriteWorkspacePermission(wid).can():
+        raise APIException(status=codes.forbidden,
+                           title='Forbidden',
+                           detail='You are not authorized to modify metadata on this workspace')
+
+    if not workspace.can_change_metadata:
+        # See note on 412 code and werkzeug on top of workspace.py file
+        raise APIException(status=codes.precondition_failed,
+                           title='Cannot update metadata of files',
+                           detail=f'Cannot update metadata of files to a '
+                                  f'workspace on {workspace.state.name} state')
+
+    # Gather the changes by family and file, in the order of the request
+    families = {family.name: family for family in workspace.families}
+    changes = collections.defaultdict(dict)
+    for entry in body:
+        file_id = str(entry['id'])
+        for name, content in entry['metadata'].items():
+            _verify_metadata_change(name, content)
+            if name not in families:
+                raise APIException(status=codes.bad_request,
+                                   title='Invalid family',
+                                   detail=f'Workspace does not have family {name}')
+            changes[name].setdefault(file_id, {}).update(content)
+
+    file_ids = list(set(str(entry['id']) for entry in body))
+    latest_by_family = {'base': _latest_metadata_many(workspace, 'base', file_ids)}
+    missing = set(file_ids) - latest_by_family['base'].keys()
+    if missing:
+        raise ObjectNotFoundException(status=codes.not_found,
+                                      title='Not found',
+                                      detail=f'Files {", ".join(sorted(missing))} do not '
+                                             f'exist on workspace {wid}')
+    deleted = [file_id for file_id, meta in latest_by_family['base'].items()
+               if meta.json.get('state') == FileState.DELETED.name]
+    if deleted:
+        raise ObjectNotFoundException(status=codes.not_found,
+                                      title='Not found',
+                                      detail=f'Files {", ".join(sorted(deleted))} are deleted '
+                                             f'on workspace {wid}')
+
+    # Files renamed on the storage backend are moved back if anything fails,
+    # so that their URL remains the one of their committed metadata
+    moved = []
+    try:
+        updated = _update_metadata_many(workspace, families, changes, latest_by_family, moved)
+    except:
+        db.session.rollback()
+        _restore_renamed_files(moved, workspace.data_url)
+        raise
+
+    return [{'id': file_id, 'metadata': metadata} for file_id, metadata in updated.items()], codes.ok
+
+
+def _update_metadata_many(workspace, families, changes, latest_by_family, moved):
+    """Write the metadata changes of :py:func:`update_metadata_many`
+
+    Each file renamed on the storage backend is added to `moved` as an
+    ``(url, path, filename)`` tuple, with its new URL and its previous path
+    and filename.
+    """
+    new_rows = []
+    updated_rows = []
+    updated = collections.defaultdict(dict)
+    for name, family_changes in changes.items():
+        family = families[name]
+        if name not in latest_by_family:
+            latest_by_family[name] = _latest_metadata_many(workspace, name, list(family_changes))
+
+        for file_id, content in family_changes.items():
+            latest = latest_by_family[name].get(file_id)
+            meta_json = dict(latest.json) if latest is not None else {'id': file_id}
+
+            # A change in the path or filename inside a worspace must entail a rename!
+            if name == 'base' and \
+                    ('path' in content or 'filename' in content) and \
+                    (meta_json.get('url') or '').startswith(workspace.data_url):
+                meta_json['url'] = _move_file(meta_json['url'],
+                                              workspace.data_url,
+                                              content.get('path', meta_json['path']),
+                                              content.get('filename', meta_json['filename']))
+                moved.append((meta_json['url'], meta_json['path'], meta_json['filename']))
+            meta_json.update(content)
+
+            if latest is not None and latest.fk_family_id == family.id:
+                # This file has some local (ie not committed) metadata
+                updated_rows.append({'id': latest.id, 'json': meta_json})
+            else:
+                # This file has no metadata or some global (ie committed)
+                # metadata under this family: a new entry is added
+                new_rows.append({'id_file': file_id, 'json': meta_json, 'fk_family_id': family.id})
+            updated[file_id][name] = meta_json
+
+    for i in range(0, len(new_rows), BULK_INSERT_SIZE):
+        db.session.execute(Metadata.__table__.insert().values(new_rows[i:i + BULK_INSERT_SIZE]))
+    for i in range(0, len(updated_rows), BULK_INSERT_SIZE):
+        db.session.execute(BULK_UPDATE_STATEMENT, {'rows': updated_rows[i:i + BULK_INSERT_SIZE]})
+    db.session.commit()
+
+    logger.info('Updated metadata of %d files: %d new and %d updated entries',
+                len(updated), len(new_rows), len(updated_rows))
+    return updated
+
+
+def _restore_renamed_files(moved, location):
+    """Rename back the files renamed by a failed metadata update"""
+    for url, path, filename in reversed(moved):
+        logger.info('Restoring %s to %s/%s', url, path, filename)
+        try:
+            _move_file(url, location, path, filename)
+        except:
+            logger.error('Could not restore %s to %s/%s', url, path, filename, exc_info=True)
+    moved.clear()
+
+
 def set_metadata(*, wid, uuid, body):
     # TODO: maybe change spec to {"metadata": object}
     workspace = Workspace.get_or_404(wid)
@@ -364,16 +749,15 @@ def details(*, uuid):
         # A request for metadata without workspace means that we should look
         # into metadata that has been committed. That is, it has a null workspace
         # associated to their families
-        latest_meta_committed = Metadata.get_latest_global(uuid)
+        meta = _all_metadata(uuid)
 
-        if latest_meta_committed.count() == 0:
+        if not meta:
             raise ObjectNotFoundException(status=codes.not_found,
                                           title='Not found',
                                           detail=f'File {uuid} does not exist or has not '
                                                  f'been committed yet.')
 
-        meta = _gather_metadata(latest_meta_committed)
-        return {'id': uuid, 'metadata': meta}, codes.ok
+        return _metadata_response(uuid, meta)
 
     elif best == 'application/octet-stream':
         # A request for content without workspace means that we should look
@@ -391,10 +775,9 @@ def details(*, uuid):
                                           title='File contents not found',
                                           detail=f'File {uuid} has been deleted.')
 
-        tmp_file = _download_file(base_meta.json['url'])
-        response = send_file(tmp_file, mimetype='application/octet-stream')
-        response.direct_passthrough = False
-        return response, codes.ok
+        # The contents of a committed file never change
+        response = _file_response(base_meta.json, current_app.config['QUETZAL_FILE_CACHE_CONTROL'])
+        return response, response.status_code
 
     raise APIException(status=codes.bad_request,
                        title='Invalid accept header',
@@ -421,7 +804,7 @@ def details_w(*, wid=None, uuid):
                                                default=None)
     if best == 'application/json':
         meta = _all_metadata(uuid, workspace)
-        return {'id': uuid, 'metadata': meta}, codes.ok
+        return _metadata_response(uuid, meta)
 
     elif best == 'application/octet-stream':
         # TODO: continue here! maybe reuse _all_metadata or Metadata.get_latest(...)
@@ -437,10 +820,8 @@ def details_w(*, wid=None, uuid):
                                           title='File contents not found',
                                           detail=f'File {uuid} has been deleted in workspace {wid}')
 
-        tmp_file = _download_file(base_meta.json['url'])
-        response = send_file(tmp_file, mimetype='application/octet-stream')
-        response.direct_passthrough = False
-        return response, codes.ok
+        response = _file_response(base_meta.json)
+        return response, response.status_code
 
     raise APIException(status=codes.bad_request,
                        title='Invalid accept header',
@@ -454,45 +835,11 @@ def fetch(*args, **kwargs):
                            title='Forbidden',
                            detail='You are not authorized to list public files.')
 
-    # Get all the committed base metadata that existed before the creation of
-    # the workspace
-    previous_meta = (
-        Metadata
-        .query
-        .join(Family)
-        .filter(Family.name == 'base',
-                # Check that the family's workspace is None: this means is committed
-                Family.fk_workspace_id.is_(None))
-    )
-
-    # Now take the results but drop repeated entries by file_id,
-    # which is possible through a DISTINCT ON combined with an ORDER BY
-    union_query = (
-        previous_meta
-        .distinct(Metadata.id_file)
-        .order_by(Metadata.id_file, Metadata.id.desc())
-    )
+    union_query = _latest_base_metadata()
 
     # Finally, apply filters
     if 'filters' in request.args:
-        filters = request.args['filters'].split(',')
-        for f in filters:
-            if not f:
-                continue
-            try:
-                key, value = f.split('=', 1)
-            except ValueError:
-                raise APIException(status=codes.bad_request,
-                                   title='Bad request',
-                                   detail='Invalid format for filters.')
-            try:
-                # Verify that key is a valid value in the enum
-                BaseMetadataKeys(key)
-            except ValueError:
-                raise APIException(status=codes.bad_request,
-                                   title='Bad request',
-                                   detail=f'"{key}" is not a valid filter key.')
-            union_query = union_query.filter(Metadata.json[key].astext == value)
+        union_query = apply_filters(union_query, request.args['filters'])
 
     pager = paginate(union_query, serializer=lambda meta: meta.json)
     return pager.response_object(), 200
@@ -507,109 +854,592 @@ def fetch_w(*, wid):
                            title='Forbidden',
                            detail='You are not authorized to read metadata on this workspace')
 
-    # Get all the committed base metadata that existed before the creation of
-    # the workspace
-    previous_meta = (
-        Metadata
-        .query
-        .join(Family)
-        .filter(Family.name == 'base',
-                # Check that the family's workspace is None: this means is committed
-                Family.fk_workspace_id.is_(None),
-                # Verify the reference when there is a reference, otherwise it means
-                # that there was no metadata before
-                Metadata.id <= workspace.fk_last_metadata_id
-                if workspace.fk_last_metadata_id is not None else False)
-    )
-
-    # Get all the metadata that has been added to this workspace
-    workspace_meta = (
-        Metadata
-        .query
-        .join(Family)
-        .filter(Family.name == 'base',
-                Family.workspace == workspace)
-    )
-
-    # Now take the results of both queries, but drop repeated entries by file_id,
-    # which is possible through a DISTINCT ON combined with an ORDER BY
-    union_query = (
-        previous_meta.union(workspace_meta)
-        .distinct(Metadata.id_file)
-        .order_by(Metadata.id_file, Metadata.id.desc())
-    )
+    union_query = _latest_base_metadata(workspace)
 
     # Finally, apply filters
     if 'filters' in request.args:
-        filters = request.args['filters'].split(',')
-        for f in filters:
-            if not f:
-                continue
-            try:
-                key, value = f.split('=', 1)
-            except ValueError:
-                raise APIException(status=codes.bad_request,
-                                   title='Bad request',
-                                   detail='Invalid format for filters.')
-            try:
-                # Verify that key is a valid value in the enum
-                BaseMetadataKeys(key)
-            except ValueError:
-                raise APIException(status=codes.bad_request,
-                                   title='Bad request',
-                                   detail=f'"{key}" is not a valid filter key.')
-            union_query = union_query.filter(Metadata.json[key].astext == value)
+        union_query = apply_filters(union_query, request.args['filters'], workspace)
 
     pager = paginate(union_query, serializer=lambda meta: meta.json)
     return pager.response_object(), 200
 
 
-def _all_metadata(file_id, workspace):
+def fetch_archive(*, uuid=None, query=None, format='tar'):
+    """Get the contents of many committed files as a tar or zip archive"""
+    if not PublicReadPermission.can():
+        raise APIException(status=codes.forbidden,
+                           title='Forbidden',
+                           detail='You are not authorized to read public files.')
+
+    file_ids = _selected_files(uuid, query, None)
+    return _archive_response(None, file_ids, format, 'quetzal')
+
+
+def fetch_archive_w(*, wid, uuid=None, query=None, format='tar'):
+    """Get the contents of many files on a workspace as a tar or zip archive"""
+    workspace = Workspace.get_or_404(wid)
+
+    if not ReadWorkspacePermission(wid).can():
+        raise APIException(status=codes.forbidden,
+                           title='Forbidden',
+                           detail='You are not authorized to read files on this workspace')
+
+    file_ids = _selected_files(uuid, query, workspace)
+    return _archive_response(workspace, file_ids, format, f'workspace-{workspace.id}')
+
+
+def _latest_base_metadata(workspace=None):
+    """Query of the latest base metadata of each file
+
+    Without a workspace, these are the files that have been committed.
+    With a workspace, these are the files that were committed before the
+    workspace was created, plus the files added or modified on the workspace.
+    """
+    if workspace is None:
+        return Metadata.get_latest_global(family_name='base')
+    return workspace.get_metadata().filter(Family.name == 'base')
+
+
+def _latest_metadata_many(workspace, family_name, file_ids):
+    """Latest metadata of a family for some files of a workspace, by file id"""
+    rows = (
+        workspace.get_metadata(file_ids=file_ids)
+        .filter(Family.name == family_name)
+        .order_by(None)
+        .with_entities(Metadata.id, Metadata.id_file, Metadata.json, Metadata.fk_family_id)
+    )
+    return {str(row.id_file): row for row in rows}
+
+
+def _verify_metadata_change(name, content):
+    """Verify that a change of the metadata of a family is valid
+
+    Metadata of the "base" family cannot be modified, with the exception of
+    the "path" and "filename" entries, and the "id" entry cannot be changed
+    for any family.
+    """
+    # Verification: base metadata
+    if name == 'base':
+        if content.keys() - {'path', 'filename'}:
+            # see RFC 7231 or https://stackoverflow.com/a/3290198/227103
+            raise APIException(status=codes.bad_request,
+                               title='Invalid metadata modification',
+                               detail='Cannot change metadata family "base" except for its path')
+        # Do some verifications on the filename and path
+        verify_filename_path(content.get('filename', ''), content.get('path', ''))
+
+    # Verification: id cannot be changed
+    if 'id' in content.keys():
+        raise APIException(status=codes.bad_request,
+                           title='Invalid metadata modification',
+                           detail='Cannot change metadata "id" entry')
+
+
+def _storage_codec():
+    """Codec used to store the contents of new files, or ``None``"""
+    codec = current_app.config['QUETZAL_STORAGE_CODEC']
+    if codec is not None and not codec_available(codec):
+        logger.warning('Storage codec %s is not available, files are stored unchanged', codec)
+        return None
+    return codec
+
+
+def _stored_digests(data_object):
+    """Get the extra digests of a committed object, from any file that uses it"""
+    reference = data_object.references.first()
+    if reference is None:
+        return {}
+    base_meta = Metadata.get_latest_global(reference.id_file, 'base').first()
+    if base_meta is None:
+        return {}
+    return {name: base_meta.json[name] for name in extra_digests()
+            if base_meta.json.get(name) is not None}
+
+
+def _all_metadata(file_id, workspace=None):
     """Gather all metadata of a file in a workspace
 
     If a file has metadata of families f1, f2, ..., this function returns
     a dictionary ``{'f1': {...}, 'f2': {...}, ...}``. This structure is suitable
-    for the responses of file fetch metadata operations.
+    for the responses of file fetch metadata operations. Without a workspace,
+    this is the committed metadata of the file.
+    """
+    return _all_metadata_many([file_id], workspace).get(str(file_id), {})
+
+
+def _all_metadata_many(file_ids, workspace=None):
+    """Gather all metadata of many files in a workspace, by file identifier
+
+    The latest metadata of all families is retrieved for all the files with a
+    single query, see :py:meth:`quetzal.app.models.Workspace.get_metadata`.
+    Without a workspace, this is the committed metadata of the files. Without
+    file identifiers, all the files are included.
     """
-    latest_by_family = []
-    for family in workspace.families.all():
-        latest = Metadata.get_latest(file_id, family)
-        if latest is not None:
-            latest_by_family.append(latest)
-    return _gather_metadata(latest_by_family)
-
-
-def _gather_metadata(metadatas):
-    gathered_meta = {}
-    for meta in metadatas:
-        gathered_meta[meta.family.name] = meta.json
+    if file_ids is not None:
+        file_ids = [str(file_id) for file_id in file_ids]
+        if not file_ids:
+            return {}
+
+    if workspace is None:
+        query = Metadata.get_latest_global()
+        if file_ids is not None:
+            query = query.filter(MetadataHead.id_file.in_(file_ids))
+    else:
+        query = workspace.get_metadata(file_ids=file_ids)
+
+    gathered_meta = collections.defaultdict(dict)
+    for id_file, family_name, meta_json in query.with_entities(Metadata.id_file, Family.name, Metadata.json):
+        gathered_meta[str(id_file)][family_name] = meta_json
     return gathered_meta
 
 
-def _download_file(url):
+def _selected_files(uuids, qid, workspace):
+    """Get the identifiers of the files requested for an archive download
+
+    Files are selected by a list of identifiers, by the results of a saved
+    query of the same workspace, or both; their intersection is used in the
+    latter case. Returns ``None`` when all files are requested.
+    """
+    file_ids = None
+    if qid is not None:
+        query = MetadataQuery.get_or_404(qid)
+        if query.workspace != workspace:
+            raise ObjectNotFoundException(status=codes.not_found,
+                                          title='Not found',
+                                          detail=f'Query {qid} was not found')
+        file_ids = query_file_ids(query, workspace)
+    if uuids:
+        uuids = set(str(uuid) for uuid in uuids)
+        file_ids = uuids if file_ids is None else file_ids & uuids
+    return file_ids
+
+
+def _archive_response(workspace, file_ids, archive_format, basename):
+    """Prepare a response that streams the contents of files as an archive
+
+    The archive ends with a ``manifest.json`` entry that has the name of
+    each file inside the archive and its metadata of all families. Files that
+    have been deleted are not included. Without a workspace, the files are
+    the committed files.
+
+    The archive is generated while it is sent, see
+    :py:func:`quetzal.app.helpers.files.stream_archive`. The metadata of the
+    files is read by batches of ``ARCHIVE_BATCH_SIZE`` files, and the
+    manifest is written while the files are sent, in a temporary file when
+    it becomes large, so that the memory used does not depend on the number
+    of files. While a file is sent, the next ``QUETZAL_ARCHIVE_PREFETCH``
+    files are opened by a thread pool of the download, so that the latency
+    of the storage backend is not paid on each file.
+    """
+    metadata_query = _latest_base_metadata(workspace)
+    if file_ids is not None:
+        missing = _missing_files(metadata_query, file_ids)
+        if missing:
+            raise ObjectNotFoundException(status=codes.not_found,
+                                          title='Not found',
+                                          detail=f'Files {", ".join(sorted(missing))} do not exist')
+        metadata_query = metadata_query.filter(Metadata.id_file.in_(file_ids))
+
+    def files(manifest):
+        # Each file is added to the manifest when it is about to be sent
+        separator = b'\n'
+        for name, meta, all_metadata in _archive_names(_archive_files(metadata_query, workspace)):
+            manifest.write(separator + json.dumps({'name': name, 'metadata': all_metadata}).encode('utf-8'))
+            separator = b',\n'
+            yield name, meta
+
+    def entries():
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_MANIFEST_MEMORY) as manifest:
+            manifest.write(b'{"files": [')
+            for name, meta, contents in _prefetch_contents(files(manifest)):
+                yield name, meta['size'], contents
+            manifest.write(b'\n]}\n')
+            size = manifest.tell()
+            manifest.seek(0)
+            yield ARCHIVE_MANIFEST_NAME, size, manifest
+
+    mimetype = {'tar': 'application/x-tar', 'zip': 'application/zip'}[archive_format]
+    response = current_app.response_class(stream_with_context(stream_archive(entries(), archive_format)),
+                                          mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{basename}.{archive_format}"'
+    response.status_code = codes.ok
+    return response, response.status_code
+
+
+def _missing_files(metadata_query, file_ids):
+    """Identifiers of the requested files of an archive that do not exist"""
+    file_ids = sorted(str(file_id) for file_id in file_ids)
+    missing = set()
+    for i in range(0, len(file_ids), ARCHIVE_BATCH_SIZE):
+        batch = file_ids[i:i + ARCHIVE_BATCH_SIZE]
+        found = (
+            metadata_query
+            .filter(Metadata.id_file.in_(batch))
+            .order_by(None)
+            .with_entities(Metadata.id_file)
+        )
+        missing.update(set(batch) - set(str(id_file) for id_file, in found))
+    return missing
+
+
+def _archive_files(metadata_query, workspace):
+    """Iterate over the ``(base_meta, all_metadata)`` of the files of an archive
+
+    The base metadata is read by batches, and the metadata of all families
+    is gathered for each batch. Files without contents are skipped.
+    """
+    metas = (meta.json for meta in metadata_query.yield_per(ARCHIVE_BATCH_SIZE))
+    while True:
+        batch = list(itertools.islice(metas, ARCHIVE_BATCH_SIZE))
+        if not batch:
+            return
+        batch = [meta for meta in batch if meta.get('url') and meta.get('size') is not None]
+        all_metadata = _all_metadata_many([meta['id'] for meta in batch], workspace)
+        for meta in batch:
+            yield meta, all_metadata.get(meta['id'], {'base': meta})
+
+
+def _archive_names(files):
+    """Iterate over the ``(name, base_meta, all_metadata)`` of the files of an archive
+
+    Files are named by their path and filename. When two files have the same
+    name, the identifier of the file is added as a directory of its path.
+    """
+    used = {ARCHIVE_MANIFEST_NAME}
+    for meta, all_metadata in files:
+        path, filename = split_check_path(os.path.join(meta.get('path') or '', meta['filename']))
+        name = os.path.join(path, filename)
+        if name in used:
+            name = os.path.join(path, meta['id'], filename)
+        used.add(name)
+        yield name, meta, all_metadata
+
+
+def _prefetch_contents(files):
+    """Iterate over the ``(name, base_meta, contents)`` of archive files
+
+    The contents of the next ``QUETZAL_ARCHIVE_PREFETCH`` files are opened in
+    advance by a thread pool of the same size. Each archive download has its
+    own pool, so that concurrent downloads do not wait for the files of each
+    other: a process uses up to ``QUETZAL_ARCHIVE_PREFETCH`` threads for each
+    archive download that it is sending. Any contents opened in advance and
+    not consumed are closed when the iteration is interrupted.
+    """
+    app = current_app._get_current_object()
+    prefetch = max(1, current_app.config['QUETZAL_ARCHIVE_PREFETCH'])
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='archive')
+    files = iter(files)
+    pending = collections.deque()
+
+    def open_contents(meta):
+        with app.app_context():
+            return _open_contents(meta)
+
+    def submit_next():
+        for name, meta in itertools.islice(files, 1):
+            pending.append((name, meta, pool.submit(open_contents, meta)))
+
+    try:
+        for _ in range(prefetch):
+            submit_next()
+        while pending:
+            name, meta, future = pending.popleft()
+            submit_next()
+            yield name, meta, future.result()
+    finally:
+        for _, _, future in pending:
+            if not future.cancel() and future.exception() is None:
+                future.result().close()
+        pool.shutdown(wait=False)
+
+
+def _open_contents(base_meta):
+    """Open the contents of a file as a binary file object, decoded if needed"""
+    contents = _download_file(base_meta['url'], size=base_meta.get('size'),
+                              version=base_meta.get('checksum'))
+    if isinstance(contents, str):
+        contents = open(contents, 'rb')
+    if base_meta.get('codec') is not None:
+        contents = decode_stream(contents, base_meta['codec'])
+    return contents
+
+
+def _file_response(base_meta, cache_control='no-cache'):
+    """Prepare a response with the contents of a file
+
+    Responses have a strong ``ETag``, made from the checksum of the file
+    contents, and a ``Cache-Control`` header with the `cache_control`
+    directives. Requests with a matching ``If-None-Match`` header receive a
+    not modified response before the storage backend is used.
+
+    Requests with a single byte range in their ``Range`` header receive a
+    partial content response, and only the requested bytes are read from
+    the storage backend. Requests with several ranges, or with an
+    ``If-Range`` header that does not match the ``ETag``, receive the
+    complete file contents, which is permitted by RFC 7233.
+
+    Files stored with a codec are always sent by the application, see
+    :py:func:`_file_response_encoded`.
+    """
+    url = base_meta['url']
+    etag = _content_etag(base_meta)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return _not_modified_response(etag, cache_control, vary_encoding=base_meta.get('codec') is not None)
+
+    if base_meta.get('codec') is not None:
+        response = _file_response_encoded(url, base_meta['codec'], base_meta.get('size'))
+    elif (current_app.config['QUETZAL_DATA_STORAGE'] == 'file' and
+            current_app.config['QUETZAL_FILE_DOWNLOAD_MODE'] != 'app'):
+        response = _file_response_accel(url)
+    elif (current_app.config['QUETZAL_DATA_STORAGE'] == 'GCP' and
+            current_app.config['QUETZAL_GCP_DOWNLOAD_MODE'] == 'signed_url'):
+        # The redirection must not be cached beyond the signature expiration
+        return _file_response_signed_url(url)
+    else:
+        response = _file_response_app(url, base_meta.get('size'), base_meta.get('checksum'))
+
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def _file_response_app(url, size, checksum):
+    """Prepare a response with the contents of a file, or a byte range of it"""
+    byte_range = _requested_range(size, checksum)
+
+    if byte_range is None:
+        response = send_file(_download_file(url, size=size, version=checksum),
+                             mimetype='application/octet-stream')
+        response.status_code = codes.ok
+    else:
+        start, stop = byte_range
+        response = send_file(_download_file(url, start, stop, size=size, version=checksum),
+                             mimetype='application/octet-stream')
+        response.status_code = codes.partial_content
+        response.content_range = ContentRange('bytes', start, stop, size)
+        response.content_length = stop - start
+
+    if size is not None:
+        response.accept_ranges = 'bytes'
+        if response.content_length is None:
+            response.content_length = size
+    response.direct_passthrough = False
+    return response
+
+
+def _file_response_encoded(url, codec, size):
+    """Prepare a response with the contents of a file stored with a codec
+
+    Clients that accept the codec as a content encoding receive the stored
+    contents unchanged, with a ``Content-Encoding`` header. Other clients
+    receive the decoded contents, which are decoded while they are sent.
+    Range requests are ignored and the complete contents are sent, which is
+    permitted by RFC 7233.
+    """
+    contents = _download_file(url)
+    if _accepts_encoding(codec):
+        response = send_file(contents, mimetype='application/octet-stream')
+        response.content_encoding = codec
+    else:
+        if isinstance(contents, str):
+            contents = open(contents, 'rb')
+        response = send_file(decode_stream(contents, codec), mimetype='application/octet-stream')
+        if size is not None:
+            response.content_length = size
+    response.status_code = codes.ok
+    response.vary.add('Accept-Encoding')
+    response.direct_passthrough = False
+    return response
+
+
+def _accepts_encoding(codec):
+    """Whether the request accepts a codec as a content encoding"""
+    return any(value == codec and quality > 0 for value, quality in request.accept_encodings)
+
+
+def _content_etag(base_meta):
+    """Get the entity tag of the contents of a file, or ``None``
+
+    The contents of a file only change with its checksum. Files stored with
+    a codec have a different tag when they are sent encoded, since it is a
+    different representation of the same contents.
+    """
+    checksum = base_meta.get('checksum')
+    if checksum is None:
+        return None
+    codec = base_meta.get('codec')
+    if codec is not None and _accepts_encoding(codec):
+        return f'{checksum}.{codec}'
+    return checksum
+
+
+def _metadata_etag(metadata):
+    """Get the entity tag of the metadata of a file, a hash of its contents"""
+    serialized = json.dumps(metadata, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _metadata_response(uuid, metadata):
+    """Prepare the response with the metadata of a file and its ``ETag``
+
+    Requests with a matching ``If-None-Match`` header receive a not modified
+    response. Metadata can change on any commit, so clients must always
+    revalidate it.
+    """
+    etag = _metadata_etag(metadata)
+    if request.if_none_match.contains_weak(etag):
+        response = _not_modified_response(etag, 'no-cache')
+        return response, response.status_code
+    return {'id': uuid, 'metadata': metadata}, codes.ok, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
+
+def _not_modified_response(etag, cache_control, *, vary_encoding=False):
+    response = current_app.response_class(status=codes.not_modified)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    if vary_encoding:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def _file_response_accel(url):
+    """Prepare a response that delegates sending a local file to the web server
+
+    The response has no contents, only a header that the web server in front
+    of the application replaces with the file contents. The file contents
+    never pass through a worker, and the web server also manages any range
+    or conditional request.
+    """
+    path = _download_file_local(url)
+    mode = current_app.config['QUETZAL_FILE_DOWNLOAD_MODE']
+    response = current_app.response_class(mimetype='application/octet-stream')
+    if mode == 'nginx':
+        # An internal nginx location maps this prefix to the root directory
+        prefix = current_app.config['QUETZAL_FILE_ACCEL_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = urllib.parse.quote(prefix + path)
+    elif mode == 'sendfile':
+        response.headers['X-Sendfile'] = path
+    else:
+        raise ValueError(f'Unknown file download mode {mode}.')
+    response.status_code = codes.ok
+    return response
+
+
+def _file_response_signed_url(url):
+    """Prepare a redirection to a signed URL of a GCP object
+
+    The client downloads the file contents directly from GCP, including
+    range requests, during the configured expiration time.
+    """
+    expiration = datetime.timedelta(seconds=current_app.config['QUETZAL_GCP_SIGNED_URL_EXPIRATION'])
+    response = redirect(get_signed_url(url, expiration), code=codes.see_other)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def _requested_range(size, etag=None):
+    """Get the ``(start, stop)`` byte range requested for a file of a size
+
+    Returns ``None`` when the whole file should be served. A conditional
+    ``If-Range`` request is only served partially when its entity tag is
+    the `etag` of the file; dates are never used because they are not
+    strong validators.
+    """
+    byte_range = request.range
+    if byte_range is None or size is None:
+        return None
+    if 'If-Range' in request.headers and (etag is None or request.if_range.etag != etag):
+        return None
+    if byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+
+    resolved = byte_range.range_for_length(size)
+    if resolved is None:
+        raise APIException(status=codes.requested_range_not_satisfiable,
+                           title='Range not satisfiable',
+                           detail=f'Requested range is outside the file size of {size} bytes',
+                           headers={'Content-Range': f'bytes */{size}'})
+    return resolved
+
+
+def _download_file(url, start=None, stop=None, *, size=None, version=None):
+    """Get the contents of a file, or of its ``[start, stop)`` byte range
+
+    The file `size` and `version`, its checksum, are optional. The GCP
+    backend uses the size to avoid downloading past the end of the file, and
+    both of them to identify the file on the download cache.
+    """
     storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
     if storage_backend == 'GCP':
-        return _download_file_gcp(url)
+        return _download_file_gcp(url, start, stop, size, version)
     elif storage_backend == 'file':
-        return _download_file_local(url)
+        return _download_file_local(url, start, stop)
     raise ValueError(f'Unknown storage backend {storage_backend}.')
 
 
-def _download_file_gcp(url):
-    # Create a temporal file in memory unless it exceeds 32Mb, whence it
-    # will be spilled to a file
-    file_obj = tempfile.SpooledTemporaryFile(mode='w+b', max_size=32 * (1 << 20))
-    blob = get_object(url)
-    blob.download_to_file(file_obj)
-    # TODO: manage exception
-
-    file_obj.flush()
-    file_obj.seek(0)
-    return file_obj
+def _download_file_gcp(url, start=None, stop=None, size=None, version=None):
+    def open_blob(start, stop):
+        # Stream the blob by chunks instead of downloading it completely
+        # before responding. The first chunk is downloaded now so that any
+        # error is reported before the response starts. The blob properties
+        # are not loaded: only the chunk downloads are sent to GCP
+        reader = BlobReader(get_object(url), start, stop)
+        reader.prefetch()
+        return reader
+
+    cache = _download_cache(size, version)
+    if cache is not None:
+        # Entries are keyed by the checksum instead of the blob generation:
+        # the contents at a URL only change with a new checksum, and reading
+        # the generation would cost one more GCP request per download
+        key = (url, version, size)
+        if start is None:
+            # A miss is streamed while it fills the cache
+            return cache.open(key, lambda: open_blob(None, size))
+        # Byte ranges are only served from complete entries
+        file_obj = cache.get(key)
+        if file_obj is not None:
+            return _RangeStream(file_obj, start, stop)
+
+    return open_blob(start, stop if start is not None else size)
+
+
+def _download_cache(size, version):
+    """Get the disk cache of GCP downloads, if it can be used for a file"""
+    directory = current_app.config['QUETZAL_GCP_CACHE_DIR']
+    if not directory or size is None or version is None:
+        return None
+    if size > current_app.config['QUETZAL_GCP_CACHE_MAX_FILE_SIZE']:
+        return None
+    return get_disk_cache(directory, current_app.config['QUETZAL_GCP_CACHE_SIZE'],
+                          current_app.config['QUETZAL_GCP_CACHE_FILL_WAIT'])
+
+
+def _download_file_local(url, start=None, stop=None):
+    path = urllib.parse.urlparse(url).path
+    if start is None:
+        return path
+    return _RangeStream(open(path, 'rb'), start, stop)
+
+
+class _RangeStream(LimitedStream):
+    """The ``[start, stop)`` byte range of a file, which closes the file
+
+    A :py:class:`LimitedStream` does not close its stream, so the file of a
+    ranged download would otherwise remain open after its response is sent.
+    """
 
+    def __init__(self, file_obj, start, stop):
+        file_obj.seek(start)
+        super().__init__(file_obj, stop - start)
+        self._file_obj = file_obj
 
-def _download_file_local(url):
-    return urllib.parse.urlparse(url).path
+    def close(self):
+        try:
+            self._file_obj.close()
+        finally:
+            super().close()
 
 
 def _delete_file(url):
@@ -631,50 +1461,6 @@ def _delete_file_local(url):
     path.unlink()
 
 
-def _verify_filename_path(filename, path):
-    """Perform some security considerations on filename and path"""
-    # TODO: improve this, for the moment this is very limited
-
-    # No unix or windows absolute paths
-    if pathlib.PurePosixPath(filename).anchor or pathlib.PureWindowsPath(filename).anchor:
-        raise APIException(status=codes.bad_request,
-                           title='Invalid filename metadata modification',
-                           detail='Filename cannot be an absolute path')
-    if pathlib.PurePosixPath(path).anchor or pathlib.PureWindowsPath(path).anchor:
-        raise APIException(status=codes.bad_request,
-                           title='Invalid path metadata modification',
-                           detail='Path cannot be a absolute')
-
-    # No backslashes
-    if '\\' in filename or '\\' in path:
-        raise APIException(status=codes.bad_request,
-                           title='Invalid filename or path modification',
-                           detail='Filename and path cannot have backslashes')
-
-    # Filename does not have a path
-    if os.path.dirname(filename):
-        raise APIException(status=codes.bad_request,
-                           title='Invalid filename metadata modification',
-                           detail='Filename must not contain a path')
-
-    # Protect path from traversal
-    if path:
-        current_directory = os.path.abspath(os.curdir)
-        requested_path = os.path.relpath(path, start=current_directory)
-        requested_path = os.path.abspath(requested_path)
-        common_prefix = os.path.commonprefix([requested_path, current_directory])
-        if common_prefix != current_directory:
-            raise APIException(status=codes.bad_request,
-                               title='Invalid path metadata modification',
-                               detail='Path contains traversal operation')
-
-        # Path must be normalized
-        if os.path.normpath(path) != path:
-            raise APIException(status=codes.bad_request,
-                               title='Invalid path modification',
-                               detail='Path must be normalized')
-
-
 def _move_file(url, location, path, filename):
     logger.info('move_file %s, %s, %s, %s', url, location, path, filename)
     storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
@@ -697,7 +1483,8 @@ def _move_file_gcp(url, location, path, filename):
     file_url_parsed = urllib.parse.urlparse(url)
     data_bucket = get_bucket(location)
     source_blob = data_bucket.blob(file_url_parsed.path.lstrip('/'))
-    new_path = str(pathlib.Path(path) / filename)
+    _, prefix = split_location(location)
+    new_path = prefix + str(pathlib.Path(path) / filename)
     if (data_bucket.name, new_path) != (source_blob.bucket.name, source_blob.name):
         logger.info('Moving %s -> %s/%s', source_blob, source_blob.bucket, source_blob.name)
         new_blob = data_bucket.copy_blob(source_blob, data_bucket, new_path)
@@ -706,12 +1493,3 @@ def _move_file_gcp(url, location, path, filename):
 
     logger.info('Move not necessary: src is dest')
     return f'gs://{data_bucket.name}/{new_path}'
-
-
-
-def _now():
-    """Get a datetime object with the current datetime (in UTC) as a string
-
-    This function is also created for ease of unit test mocks
-    """
-    return str(datetime.datetime.now(datetime.timezone.utc))
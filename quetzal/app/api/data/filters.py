@@ -0,0 +1,170 @@
+""" Filters of the file listings
+
+The ``filters`` parameter of the file listings is a comma-separated list of
+conditions on the latest metadata of the files, each one written as
+``[family.]key[[operator]]=value``. The family defaults to *base*, and the
+operator to *eq*:
+
+* ``eq``: the value is equal to the given value, such as ``path=images``.
+* ``in``: the value is one of several values, separated by ``|``, such as
+  ``other.label[in]=cat|dog``.
+* ``contains``: the value is an array that contains all the given values,
+  separated by ``|``, such as ``other.tags[contains]=red|large``.
+* ``prefix``: the value is a string that starts with the given value, such as
+  ``filename[prefix]=IMG_``.
+* ``lt``, ``lte``, ``gt`` and ``gte``: the value is less than, less than or
+  equal to, greater than or greater than or equal to the given value, which is
+  compared as a number when it is one, such as ``size[gte]=1024``, or as a
+  string otherwise.
+
+Equality, membership and containment are expressed as a JSONB containment of
+the metadata, which uses its GIN index. Prefixes and ranges use expression
+indexes, which exist for the most common base metadata keys.
+"""
+
+import collections
+import json
+import math
+import re
+
+from requests import codes
+from sqlalchemy import type_coerce
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import and_, func, or_
+
+from quetzal.app import db
+from quetzal.app.api.exceptions import APIException
+from quetzal.app.models import BaseMetadataKeys, Family, Metadata
+
+
+FILTER_PATTERN = re.compile(r'^(?:(?P<family>[^.\[\]=]+)\.)?(?P<key>[^.\[\]=]+)'
+                            r'(?:\[(?P<operator>\w+)\])?=(?P<value>.*)$')
+""" Format of each filter """
+
+LIST_SEPARATOR = '|'
+""" Separator of the values of the *in* and *contains* operators """
+
+RANGE_OPERATORS = {
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b,
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+}
+
+
+def apply_filters(query, filters, workspace=None):
+    """ Filter a query of the latest base metadata of files
+
+    Parameters
+    ----------
+    query: queryset
+        Query of the latest :py:class:`Metadata` of the base family.
+    filters: str
+        Comma-separated list of filters, as described in this module.
+    workspace: :py:class:`quetzal.app.models.Workspace`, optional
+        Workspace of the files. When not set, the filters apply to the
+        committed metadata.
+
+    Returns
+    -------
+    queryset
+        The filtered query.
+
+    """
+    conditions = collections.defaultdict(list)
+    for expression in filters.split(','):
+        if not expression:
+            continue
+        family_name, condition = _parse_filter(expression)
+        conditions[family_name].append(condition)
+
+    for family_name, family_conditions in conditions.items():
+        if family_name == 'base':
+            query = query.filter(*family_conditions)
+            continue
+
+        # Files whose latest metadata of the family verifies all the
+        # conditions of that family
+        if workspace is None:
+            family_query = Metadata.get_latest_global(family_name=family_name)
+        else:
+            family_query = workspace.get_metadata().filter(Family.name == family_name)
+        family_files = (
+            family_query
+            .filter(*family_conditions)
+            .with_entities(Metadata.id_file)
+            .order_by(None)
+            .subquery()
+        )
+        query = query.filter(Metadata.id_file.in_(db.session.query(family_files.c.id_file)))
+
+    return query
+
+
+def _parse_filter(expression):
+    match = FILTER_PATTERN.match(expression)
+    if match is None:
+        raise APIException(status=codes.bad_request,
+                           title='Bad request',
+                           detail='Invalid format for filters.')
+
+    family_name = match.group('family') or 'base'
+    key = match.group('key')
+    operator = match.group('operator') or 'eq'
+    value = match.group('value')
+
+    if family_name == 'base':
+        try:
+            # Verify that key is a valid value in the enum
+            BaseMetadataKeys(key)
+        except ValueError:
+            raise APIException(status=codes.bad_request,
+                               title='Bad request',
+                               detail=f'"{key}" is not a valid filter key.')
+
+    if operator == 'eq':
+        condition = or_(*(Metadata.json.contains({key: v}) for v in _json_values(value)))
+    elif operator == 'in':
+        condition = or_(*(Metadata.json.contains({key: v})
+                          for item in value.split(LIST_SEPARATOR)
+                          for v in _json_values(item)))
+    elif operator == 'contains':
+        condition = and_(*(or_(*(Metadata.json.contains({key: [v]}) for v in _json_values(item)))
+                           for item in value.split(LIST_SEPARATOR)))
+    elif operator == 'prefix':
+        escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        condition = Metadata.json[key].astext.like(escaped + '%')
+    elif operator in RANGE_OPERATORS:
+        bound = _json_values(value)[-1]
+        if not isinstance(bound, (int, float)) or isinstance(bound, bool):
+            bound = value
+        # Values of another type are compared by their type by Postgres, so
+        # they must be excluded explicitly
+        condition = and_(
+            func.jsonb_typeof(Metadata.json[key]) == ('string' if isinstance(bound, str) else 'number'),
+            RANGE_OPERATORS[operator](Metadata.json[key], type_coerce(bound, JSONB)),
+        )
+    else:
+        raise APIException(status=codes.bad_request,
+                           title='Bad request',
+                           detail=f'"{operator}" is not a valid filter operator.')
+
+    return family_name, condition
+
+
+def _json_values(value):
+    """ JSON values that a filter value can represent
+
+    A filter value is always a string, but it may represent a number, a
+    boolean or null: the string and that value are returned, in this order.
+    """
+    values = [value]
+    try:
+        literal = json.loads(value)
+    except ValueError:
+        return values
+    if isinstance(literal, float) and not math.isfinite(literal):
+        return values
+    if literal is None or isinstance(literal, (bool, int, float)):
+        values.append(literal)
+    return values
@@ -0,0 +1,250 @@
+""" Garbage collection of stored files that are not referenced
+
+Some operations can leave files on the storage backends that no metadata
+references anymore: an upload that fails after its contents were saved, a
+failed cleanup of a deduplicated upload, or a commit interrupted after its
+objects were copied. These files are never read again but still use storage
+space. The functions of this module find and delete them.
+"""
+
+import datetime
+import itertools
+import logging
+import pathlib
+import urllib.parse
+
+from flask import current_app
+from sqlalchemy import text
+
+from quetzal.app import db
+from quetzal.app.api.data import storage
+from quetzal.app.models import DataObject, Metadata, UploadSession, Workspace, WorkspaceState
+
+
+logger = logging.getLogger(__name__)
+
+GC_LOCK_KEY = 0x71757a6c
+""" Key of the Postgres advisory lock held during a garbage collection """
+
+GC_BATCH_SIZE = 1000
+""" Number of files looked up and deleted at once """
+
+
+def collect_garbage(grace_period=None, *, dry_run=False):
+    """ Delete the stored files that are not referenced by any metadata
+
+    The files of the global data storage and of the workspaces that are ready
+    are listed progressively, and looked up by batches in the *url* of all
+    the metadata versions and in the data objects. A file that is not
+    referenced anywhere is deleted when it was last modified before the grace
+    period, which protects the files that are being uploaded or committed.
+
+    The upload sessions that were not finalized after
+    ``QUETZAL_UPLOAD_EXPIRATION`` are deleted too, with their staged chunks.
+
+    Only one collection runs at a time, even with several application
+    instances: the others return immediately.
+
+    Parameters
+    ----------
+    grace_period: int
+        Minimum age in seconds of the deleted files. Defaults to the
+        ``QUETZAL_GC_GRACE_PERIOD`` configuration.
+    dry_run: bool
+        When set, the unreferenced files and expired uploads are counted but
+        not deleted.
+
+    Returns
+    -------
+    report: dict
+        Number of scanned, unreferenced and deleted files, the number of
+        bytes reclaimed and the number of files that could not be deleted,
+        in total and by location, and the number of expired uploads.
+        ``None`` when another collection is running.
+
+    """
+    if grace_period is None:
+        grace_period = current_app.config['QUETZAL_GC_GRACE_PERIOD']
+    threshold = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=grace_period)
+
+    # The lock is held until the end of the transaction, which spans the
+    # whole collection since it only reads the database
+    locked = db.session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'),
+                                {'key': GC_LOCK_KEY}).scalar()
+    if not locked:
+        logger.info('Garbage collection skipped: another collection is running')
+        db.session.rollback()
+        return None
+
+    report = _new_report()
+    report['locations'] = []
+    try:
+        for location, skipped in _collected_locations():
+            location_report = _collect_location(location, skipped, threshold, dry_run)
+            logger.info('Garbage collection of %s: %d files, %d unreferenced, '
+                        '%d deleted, %d bytes reclaimed, %d errors', location,
+                        location_report['scanned'], location_report['unreferenced'],
+                        location_report['deleted'], location_report['reclaimed_bytes'],
+                        location_report['errors'])
+            for key, value in location_report.items():
+                if key != 'location':
+                    report[key] += value
+            report['locations'].append(location_report)
+
+        report['expired_uploads'] = _expire_uploads(dry_run)
+        logger.info('Garbage collection of uploads: %d expired', report['expired_uploads'])
+        db.session.commit()
+    finally:
+        db.session.rollback()
+
+    return report
+
+
+def _new_report(location=None):
+    report = {
+        'scanned': 0,
+        'unreferenced': 0,
+        'deleted': 0,
+        'reclaimed_bytes': 0,
+        'errors': 0,
+    }
+    if location is not None:
+        report['location'] = location
+    return report
+
+
+def _collected_locations():
+    """ Locations of the global data storage and of the ready workspaces
+
+    Each location is a ``(url, skipped)`` tuple, where `skipped` is a tuple
+    of the prefixes of the URLs of the location that are not collected.
+
+    Workspaces may be saved inside the global data storage, such as prefixes
+    of the data bucket. Their files are then collected with the global data
+    storage, so that they are not listed twice, and the workspaces that are
+    not ready are skipped.
+    """
+    committing = (
+        Workspace.query
+        .filter(Workspace._state == WorkspaceState.COMMITTING)
+        .count()
+    )
+    if committing:
+        # The objects of a commit are referenced when it ends, possibly after
+        # the grace period when it transfers many large files
+        logger.info('Garbage collection of the data storage skipped: '
+                    '%d workspaces are being committed', committing)
+        data_url = None
+    elif current_app.config['QUETZAL_DATA_STORAGE'] == 'GCP':
+        data_url = current_app.config['QUETZAL_GCP_DATA_BUCKET']
+    else:
+        data_url = 'file://' + current_app.config['QUETZAL_FILE_DATA_DIR']
+
+    # Workspaces of another storage backend cannot be listed
+    scheme = 'gs://' if current_app.config['QUETZAL_DATA_STORAGE'] == 'GCP' else 'file://'
+    workspaces = (
+        Workspace.query
+        .filter(Workspace.data_url.startswith(scheme))
+        .order_by(Workspace.id)
+        .with_entities(Workspace.data_url, Workspace._state)
+        .all()
+    )
+
+    inside = set()
+    if data_url is not None:
+        data_prefix = _url_prefix(data_url)
+        inside = {url for url, _ in workspaces if _url_prefix(url).startswith(data_prefix)}
+        skipped = tuple(_url_prefix(url) for url, state in workspaces
+                        if url in inside and state != WorkspaceState.READY)
+        yield data_url, skipped
+
+    for url, state in workspaces:
+        if state == WorkspaceState.READY and url not in inside:
+            yield url, ()
+
+
+def _expire_uploads(dry_run):
+    """ Delete the upload sessions that were not finalized in time
+
+    Sessions that are being used, such as a session receiving a chunk, are
+    locked and skipped until the next collection.
+    """
+    expiration = current_app.config['QUETZAL_UPLOAD_EXPIRATION']
+    threshold = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=expiration)
+    expired = (
+        UploadSession.query
+        .filter(UploadSession.id_file.is_(None),
+                UploadSession.creation_date < threshold)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    count = 0
+    for upload in expired:
+        if not dry_run:
+            try:
+                if upload.workspace.data_url is not None:
+                    storage.delete_chunks(str(upload.id), upload.workspace.data_url)
+            except Exception as exc:
+                logger.warning('Could not delete the chunks of upload %s: %s', upload.id, exc)
+                continue
+            db.session.delete(upload)
+        count += 1
+    return count
+
+
+def _url_prefix(url):
+    """ Prefix of the URLs of the files of a location """
+    if url.startswith('file://'):
+        url = 'file://' + str(pathlib.Path(urllib.parse.urlparse(url).path).resolve())
+    return url.rstrip('/') + '/'
+
+
+def _collect_location(location, skipped, threshold, dry_run):
+    report = _new_report(location)
+    objects = (obj for obj in storage.list_objects(location) if not obj[0].startswith(skipped))
+    candidates = _old_objects(objects, threshold, report)
+    while True:
+        batch = list(itertools.islice(candidates, GC_BATCH_SIZE))
+        if not batch:
+            break
+        unreferenced = _unreferenced(batch)
+        report['unreferenced'] += len(unreferenced)
+        if dry_run or not unreferenced:
+            continue
+        try:
+            storage.delete_objects([url for url, _ in unreferenced])
+        except Exception as exc:
+            logger.warning('Could not delete %d unreferenced files of %s: %s',
+                           len(unreferenced), location, exc)
+            report['errors'] += len(unreferenced)
+            continue
+        report['deleted'] += len(unreferenced)
+        report['reclaimed_bytes'] += sum(size for _, size in unreferenced)
+    return report
+
+
+def _old_objects(objects, threshold, report):
+    for url, size, modified in objects:
+        report['scanned'] += 1
+        if modified is not None and modified < threshold:
+            yield url, size
+
+
+def _unreferenced(batch):
+    """ Filter the ``(url, size)`` of a batch that no metadata references """
+    urls = [url for url, _ in batch]
+    # Any metadata version counts, since older versions are still readable.
+    # Metadata is looked up first: while a commit runs, the lookup waits for
+    # its lock, and the data objects lookup then sees the committed objects
+    referenced = {
+        url for url, in
+        db.session.query(Metadata.json['url'].astext)
+        .filter(Metadata.json['url'].astext.in_(urls))
+        .distinct()
+    }
+    referenced.update(
+        url for url, in
+        db.session.query(DataObject.url)
+        .filter(DataObject.url.in_(urls))
+    )
+    return [(url, size) for url, size in batch if url not in referenced]
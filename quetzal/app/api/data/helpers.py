@@ -0,0 +1,190 @@
+""" Helpers shared by the file and upload operations of workspaces
+
+These functions verify the workspaces and the files being added, and
+prepare the base metadata of new files: their digests and the committed
+contents that they may reference.
+"""
+
+import datetime
+import logging
+import os
+import pathlib
+
+from flask import current_app
+from requests import codes
+from sqlalchemy import tuple_
+
+from quetzal.app.api.data import storage
+from quetzal.app.api.data.tasks import compute_file_digests
+from quetzal.app.api.exceptions import APIException
+from quetzal.app.helpers.files import available_digests
+from quetzal.app.models import DataObject, Workspace
+from quetzal.app.security import WriteWorkspacePermission
+
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_BATCH_SIZE = 1000
+""" Number of contents looked up at once in the committed objects """
+
+
+def get_writable_workspace(wid):
+    workspace = Workspace.get_or_404(wid)
+
+    if not WriteWorkspacePermission(wid).can():
+        raise APIException(status=codes.forbidden,
+                           title='Forbidden',
+                           detail='You are not authorized to add files to this workspace')
+
+    # Uploading a file requires new metadata, so the check here is to verify
+    # that the workspace status permits changes on metadata
+    if not workspace.can_change_metadata:
+        # See note on 412 code and werkzeug on top of workspace.py file
+        raise APIException(status=codes.precondition_failed,
+                           title='Cannot add file to workspace',
+                           detail=f'Cannot add files to a workspace on {workspace.state.name} state')
+
+    return workspace
+
+
+def get_base_family(workspace):
+    """Get the base family of a workspace where new files are added"""
+    base_family = workspace.families.filter_by(name='base').first()
+
+    # This query should not be None because all workspaces have a 'base' family,
+    # but in case this happens, it would be a problem of the current
+    # implementation (possibly by manually doing things like in unit tests).
+    # Just in case, we will raise an exception
+    if base_family is None:
+        logger.error('Workspace %d does not have base family metadata!',
+                     workspace.id)
+        raise APIException(status=codes.server_error,
+                           title='Incorrect workspace configuration',
+                           detail='Cannot add files to workspace because it does '
+                                  'not have the "base" family. This situation '
+                                  'should not happen and will be reported to '
+                                  'the administrator')
+    return base_family
+
+
+def verify_filename_path(filename, path):
+    """Perform some security considerations on filename and path"""
+    # TODO: improve this, for the moment this is very limited
+
+    # No unix or windows absolute paths
+    if pathlib.PurePosixPath(filename).anchor or pathlib.PureWindowsPath(filename).anchor:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid filename metadata modification',
+                           detail='Filename cannot be an absolute path')
+    if pathlib.PurePosixPath(path).anchor or pathlib.PureWindowsPath(path).anchor:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid path metadata modification',
+                           detail='Path cannot be a absolute')
+
+    # No backslashes
+    if '\\' in filename or '\\' in path:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid filename or path modification',
+                           detail='Filename and path cannot have backslashes')
+
+    # Filename does not have a path
+    if os.path.dirname(filename):
+        raise APIException(status=codes.bad_request,
+                           title='Invalid filename metadata modification',
+                           detail='Filename must not contain a path')
+
+    # Protect path from traversal
+    if path:
+        current_directory = os.path.abspath(os.curdir)
+        requested_path = os.path.relpath(path, start=current_directory)
+        requested_path = os.path.abspath(requested_path)
+        common_prefix = os.path.commonprefix([requested_path, current_directory])
+        if common_prefix != current_directory:
+            raise APIException(status=codes.bad_request,
+                               title='Invalid path metadata modification',
+                               detail='Path contains traversal operation')
+
+        # Path must be normalized
+        if os.path.normpath(path) != path:
+            raise APIException(status=codes.bad_request,
+                               title='Invalid path modification',
+                               detail='Path must be normalized')
+
+
+def extra_digests():
+    """Names of the digests saved in base metadata besides the md5sum"""
+    return available_digests(current_app.config['QUETZAL_EXTRA_DIGESTS'])
+
+
+def upload_digests():
+    """Names of the extra digests computed while a file is uploaded
+
+    When the digests are computed asynchronously, none are computed during
+    the upload: they are left to the task scheduled by
+    :py:func:`schedule_digests`.
+    """
+    if current_app.config['QUETZAL_ASYNC_DIGESTS']:
+        return []
+    return extra_digests()
+
+
+def schedule_digests(file_ids):
+    """Schedule the computation of the extra digests of new files"""
+    digests = extra_digests()
+    if not current_app.config['QUETZAL_ASYNC_DIGESTS'] or not digests:
+        return
+    for file_id in file_ids:
+        compute_file_digests.si(str(file_id), digests).apply_async()
+
+
+def find_stored_contents(contents):
+    """Get the committed objects that store some contents
+
+    Parameters
+    ----------
+    contents: iterable
+        Iterable of ``(checksum, size)`` tuples.
+
+    Returns
+    -------
+    dict
+        The :py:class:`DataObject` of each stored content, indexed by its
+        ``(checksum, size)`` tuple. Contents that are not stored are absent.
+
+    """
+    contents = list(set(content for content in contents if None not in content))
+    objects = {}
+    for i in range(0, len(contents), LOOKUP_BATCH_SIZE):
+        batch = contents[i:i + LOOKUP_BATCH_SIZE]
+        for data_object in DataObject.query.filter(tuple_(DataObject.checksum, DataObject.size).in_(batch)):
+            objects[(data_object.checksum, data_object.size)] = data_object
+    return objects
+
+
+def reference_contents(meta_json, data_object):
+    """Get the base metadata of a file whose contents are a committed object
+
+    Like a commit, the *url* and *codec* entries are the ones of the object,
+    which may have been stored with another codec than the new file.
+    """
+    new_json = dict(meta_json, url=data_object.url, codec=data_object.codec)
+    if new_json['codec'] is None:
+        del new_json['codec']
+    return new_json
+
+
+def discard_uploads(urls):
+    """Delete uploaded files that are not used, logging any failure"""
+    for url in urls:
+        try:
+            storage.delete_objects([url])
+        except:
+            logger.warning('Failed to delete unused upload %s', url, exc_info=True)
+
+
+def now():
+    """Get a datetime object with the current datetime (in UTC) as a string
+
+    This function is also created for ease of unit test mocks
+    """
+    return str(datetime.datetime.now(datetime.timezone.utc))
@@ -18,6 +18,9 @@ from quetzal.app.security import (
 
 logger = logging.getLogger(__name__)
 
+QUERY_BATCH_SIZE = 1000
+""" Number of query results read on each fetch when gathering file ids """
+
 
 def create(*, body, user, token_info=None):
 
@@ -78,19 +81,7 @@ def details(*, qid, user, token_info=None):
     engine = db.get_engine(app=current_app, bind='read_only_bind')
     conn = engine.raw_connection()
     with conn.cursor() as cursor:
-        cursor.execute(f'SET SEARCH_PATH TO global_views_{query.dialect.value}')
-        try:
-            cursor.execute(query.code)
-        except ProgrammingError as ex:
-            # Log bad permission errors with warning; the user may be trying something fishy
-            if ex.pgcode == '42501':
-                logger.warning('User query failed due to permissions. Query %s was: %s',
-                               query, query.code, exc_info=ex)
-            else:
-                logger.info('User query failed', exc_info=ex)
-            raise APIException(status=codes.bad_request,
-                               title='Query failed',
-                               detail=f'Query could not be executed due to error:\n{ex!s}')
+        _execute(cursor, query, f'global_views_{query.dialect.value}')
 
         pager = paginate(cursor)
         response = query.to_dict(pager.response_object())
@@ -170,22 +161,73 @@ def details_w(*, wid, qid, user, token_info=None):
     engine = db.get_engine(app=current_app, bind='read_only_bind')
     conn = engine.raw_connection()
     with conn.cursor() as cursor:
-        cursor.execute(f'SET SEARCH_PATH TO {workspace.pg_schema_name}_{query.dialect.value}')
-        try:
-            cursor.execute(query.code)
-        except ProgrammingError as ex:
-            # Log bad permission errors with warning; the user may be trying something fishy
-            if ex.pgcode == '42501':
-                logger.warning('User query failed due to permissions. Query %s was: %s',
-                               query, query.code, exc_info=ex)
-            else:
-                logger.info('User query failed', exc_info=ex)
-            raise APIException(status=codes.bad_request,
-                               title='Query failed',
-                               detail=f'Query could not be executed due to error:\n{ex!s}')
+        _execute(cursor, query, f'{workspace.pg_schema_name}_{query.dialect.value}')
 
         pager = paginate(cursor)
         response = query.to_dict(pager.response_object())
         return response, codes.ok
 
 
+def file_ids(query, workspace=None):
+    """Get the file identifiers in the results of a query
+
+    The query results must have an ``id`` column, like the views of every
+    metadata family. Results are read by batches, so that the complete
+    results are never kept in memory.
+
+    Parameters
+    ----------
+    query: MetadataQuery
+        The query to execute, which must be a query of `workspace`.
+    workspace: Workspace, optional
+        Workspace of the query. By default, the query is a global query.
+
+    Returns
+    -------
+    ids: set
+        Set of file identifiers, as strings.
+
+    """
+    if workspace is None:
+        search_path = f'global_views_{query.dialect.value}'
+    else:
+        if workspace.pg_schema_name is None:
+            raise APIException(status=codes.precondition_failed,
+                               title='Cannot query an unscanned workspace',
+                               detail='Queries need a workspace that has been correctly scanned')
+        search_path = f'{workspace.pg_schema_name}_{query.dialect.value}'
+
+    engine = db.get_engine(app=current_app, bind='read_only_bind')
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            _execute(cursor, query, search_path)
+            columns = [column.name for column in cursor.description or []]
+            if 'id' not in columns:
+                raise APIException(status=codes.bad_request,
+                                   title='Invalid query',
+                                   detail=f'Query {query.id} results do not have an "id" column')
+            index = columns.index('id')
+            ids = set()
+            for rows in iter(lambda: cursor.fetchmany(QUERY_BATCH_SIZE), []):
+                ids.update(str(row[index]) for row in rows if row[index] is not None)
+            return ids
+    finally:
+        conn.close()
+
+
+def _execute(cursor, query, search_path):
+    """Execute a user query on a schema of the metadata views"""
+    cursor.execute(f'SET SEARCH_PATH TO {search_path}')
+    try:
+        cursor.execute(query.code)
+    except ProgrammingError as ex:
+        # Log bad permission errors with warning; the user may be trying something fishy
+        if ex.pgcode == '42501':
+            logger.warning('User query failed due to permissions. Query %s was: %s',
+                           query, query.code, exc_info=ex)
+        else:
+            logger.info('User query failed', exc_info=ex)
+        raise APIException(status=codes.bad_request,
+                           title='Query failed',
+                           detail=f'Query could not be executed due to error:\n{ex!s}')
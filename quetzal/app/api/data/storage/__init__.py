@@ -2,15 +2,17 @@ from flask import current_app
 
 from quetzal.app.api.exceptions import QuetzalException
 from quetzal.app.api.data.storage import gcp, local
+from quetzal.app.helpers.files import EncodingReader
 
 
-def upload(filename, contents, location):
+def upload(filename, contents, location, codec=None):
     """ Upload a file
 
     Upload the `contents` as a file named `filename` in `location`.
 
     This function dispaches the upload operation on the configured storage
-    backend.
+    backend. When a `codec` is set, the contents are encoded while they are
+    sent to the backend, so the stored file is the encoded one.
 
     Parameters
     ----------
@@ -21,6 +23,9 @@ def upload(filename, contents, location):
     location: str
         URL of the target location where the file will be saved. This should be
         the URL of a workspace
+    codec: str, optional
+        Name of the codec used to encode the stored file. See
+        :py:class:`quetzal.app.helpers.files.EncodingReader`.
 
     Returns
     -------
@@ -37,6 +42,10 @@ def upload(filename, contents, location):
         functions are not captured here.
 
     """
+    if codec is not None:
+        contents.seek(0)
+        contents = EncodingReader(contents, codec, current_app.config['QUETZAL_STORAGE_CODEC_LEVEL'])
+
     backend = current_app.config['QUETZAL_DATA_STORAGE']
     if backend == 'file':
         return local.upload(filename, contents, location)
@@ -73,3 +82,239 @@ def set_permissions(file_obj, owner):
         return gcp.set_permissions(file_obj, owner)
     else:
         raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def set_permissions_many(file_objs, owner):
+    """ Set the permissions of several files
+
+    Same as :py:func:`set_permissions`, but for many files at once. Backends
+    may group the changes in fewer requests.
+
+    Parameters
+    ----------
+    file_objs: list
+        Objects pointing to files, as returned by :py:func:`upload`.
+    owner: quetzal.app.models.User
+        User object that will own the files.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.set_permissions_many(file_objs, owner)
+    elif backend == 'GCP':
+        return gcp.set_permissions_many(file_objs, owner)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def upload_chunk(key, offset, contents, location):
+    """ Upload a chunk of a file
+
+    Stage the `contents` as the chunk at position `offset` of the upload
+    identified by `key`, in `location`. Chunks are assembled into a file with
+    :py:func:`assemble_chunks`.
+
+    This function dispaches the operation on the configured storage backend.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload, used to group its chunks.
+    offset: int
+        Position in bytes of the chunk in the file.
+    contents: file-like
+        A buffer of bytes with the chunk contents.
+    location: str
+        URL of the target location where the chunk will be staged. This should
+        be the URL of a workspace
+
+    Returns
+    -------
+    md5sum, size: str, int
+        MD5 sum and size of the chunk.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.upload_chunk(key, offset, contents, location)
+    elif backend == 'GCP':
+        return gcp.upload_chunk(key, offset, contents, location)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def list_chunks(key, location):
+    """ List the chunks of an upload
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    location: str
+        URL of the location where the chunks are staged.
+
+    Returns
+    -------
+    list
+        List of ``(offset, size)`` tuples, sorted by offset.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.list_chunks(key, location)
+    elif backend == 'GCP':
+        return gcp.list_chunks(key, location)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def assemble_chunks(key, filename, location, digests=()):
+    """ Assemble the chunks of an upload into a file
+
+    Concatenate all the chunks of the upload identified by `key` into a file
+    named `filename` in `location`, then remove the staged chunks. The caller
+    is responsible for verifying that the chunks are contiguous.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    filename: str
+        Target file name where the contents will be saved.
+    location: str
+        URL of the location where the chunks are staged and the file will be
+        saved. This should be the URL of a workspace
+    digests: iterable
+        Names of other digests of the file to compute besides the md5sum.
+
+    Returns
+    -------
+    url: str
+        URL to where the file was saved.
+    obj: object
+        An object pointing where the file was saved for further manipulation.
+        Its type depends on the data backend.
+    md5sum, size: str, int
+        MD5 sum and size of the file.
+    other_digests: dict
+        Other digests of the file, indexed by their name.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.assemble_chunks(key, filename, location, digests)
+    elif backend == 'GCP':
+        return gcp.assemble_chunks(key, filename, location, digests)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def delete_chunks(key, location):
+    """ Remove all the staged chunks of an upload
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    location: str
+        URL of the location where the chunks are staged.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.delete_chunks(key, location)
+    elif backend == 'GCP':
+        return gcp.delete_chunks(key, location)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def list_objects(location):
+    """ Iterate over all the stored files of a location
+
+    Staged chunks of resumable uploads are not included: they belong to
+    their upload until it is finalized or deleted.
+
+    Parameters
+    ----------
+    location: str
+        URL of the location, such as a workspace or the global data storage.
+
+    Returns
+    -------
+    iterator
+        Iterator of ``(url, size, modified)`` tuples, where `modified` is the
+        timezone-aware date of the last modification of the file. The files
+        are listed progressively, never all at once.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.list_objects(location)
+    elif backend == 'GCP':
+        return gcp.list_objects(location)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
+
+
+def delete_objects(urls):
+    """ Delete several stored files
+
+    Files that do not exist are ignored by the local backend. Backends may
+    group the deletes in fewer requests.
+
+    Parameters
+    ----------
+    urls: list
+        URLs of the files to delete.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.QuetzalException
+        When the storage backend is unknown. Exceptions by the dispatched
+        functions are not captured here.
+
+    """
+    backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if backend == 'file':
+        return local.delete_objects(urls)
+    elif backend == 'GCP':
+        return gcp.delete_objects(urls)
+    else:
+        raise QuetzalException(f'Unknown storage backend "{backend}"')
@@ -3,11 +3,19 @@ import logging
 from flask import current_app
 
 from quetzal.app.api.exceptions import QuetzalException
-from quetzal.app.helpers.google_api import get_bucket
+from quetzal.app.helpers.files import HashingReader, HashingWriter
+from quetzal.app.helpers.google_api import (
+    MAX_BATCH_SIZE, delete_blobs, get_bucket, get_client, get_object, grant_owner,
+    split_location
+)
 
 
 logger = logging.getLogger(__name__)
 
+UPLOADS_PREFIX = '.uploads'
+MAX_COMPOSE_SOURCES = 32  # Limit set by GCP on a compose request
+MAX_COMPOSE_COMPONENTS = 1024  # Limit set by GCP on the components of a composite object
+
 
 def upload(filename, content, location):
     """ Save a file on a local filesystem.
@@ -21,8 +29,9 @@ def upload(filename, content, location):
     content: file-like
         Contents of the file.
     location: str
-        URL of the bucket the file will be saved. The `filename` parameter will
-        be relative to this parameter.
+        URL of the bucket, or of the prefix of a shared bucket, where the file
+        will be saved. The `filename` parameter will be relative to this
+        parameter.
 
     Returns
     -------
@@ -39,22 +48,182 @@ def upload(filename, content, location):
     """
     logger.debug('Saving GCP file %s at %s', filename, location)
 
-    # Verification that the upload does not change the global data directory
+    # Verification that the upload does not change the global data directory.
+    # Workspaces may be prefixes of the data bucket, but not the bucket itself
     data_bucket_url = current_app.config['QUETZAL_GCP_DATA_BUCKET']
-    if location.startswith(data_bucket_url):
+    if split_location(location) == split_location(data_bucket_url):
         raise QuetzalException('Cannot upload directly to global data bucket')
 
     # No rewind needed: this is handled by upload_from_file
     # No target directory creation needed: there are no directories in GCP, they
     # are coded into the file name.
     target_bucket = get_bucket(location)
-    blob = target_bucket.blob(filename)
+    blob = target_bucket.blob(_blob_name(location, filename))
     blob.upload_from_file(content, rewind=True)
     return f'gs://{target_bucket.name}/{blob.name}', blob
 
 
 def set_permissions(blob, owner):
     logger.debug('Setting ownership of %s to %s', blob, owner)
-    acl = blob.acl
-    acl.user(owner.email).grant_owner()
-    acl.save()
+    grant_owner(blob, owner.email)
+
+
+def set_permissions_many(blobs, owner):
+    logger.debug('Setting ownership of %d objects to %s', len(blobs), owner)
+    client = get_client()
+    for i in range(0, len(blobs), MAX_BATCH_SIZE):
+        with client.batch():
+            for blob in blobs[i:i + MAX_BATCH_SIZE]:
+                grant_owner(blob, owner.email, client=client)
+
+
+def upload_chunk(key, offset, content, location):
+    """ Save a chunk of a file being uploaded in several parts
+
+    Implements the *upload chunk* mechanism of the GCP backend. Chunks are
+    staged as objects under a hidden prefix of the workspace location, named by
+    their offset. A chunk sent again at the same offset replaces the previous
+    one.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload, used to group its chunks.
+    offset: int
+        Position in bytes of the chunk in the file.
+    content: file-like
+        Contents of the chunk.
+    location: str
+        URL of the workspace bucket where the chunk will be staged.
+
+    Returns
+    -------
+    md5sum, size: str, int
+        MD5 sum and size of the chunk.
+
+    """
+    logger.debug('Saving chunk %s of upload %s at %s', offset, key, location)
+    bucket = get_bucket(location)
+    blob = bucket.blob(f'{_chunks_prefix(key, location)}{offset:020d}')
+    reader = HashingReader(content)
+    blob.upload_from_file(reader, rewind=True)
+    return reader.finish()
+
+
+def list_chunks(key, location):
+    """ List the chunks received for an upload
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    location: str
+        URL of the workspace bucket where the chunks are staged.
+
+    Returns
+    -------
+    list
+        List of ``(offset, size)`` tuples, sorted by offset.
+
+    """
+    return sorted((offset, blob.size) for offset, blob in _list_chunk_blobs(key, location))
+
+
+def assemble_chunks(key, filename, location, digests=()):
+    """ Assemble the chunks of an upload into a file
+
+    The chunks are concatenated with compose requests, which are executed
+    on the GCP side. The md5sum of the file is computed by reading the chunks
+    in order, since GCP does not provide a md5sum for composite objects.
+    Staged chunks are removed afterwards.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    filename: str
+        Filename where the file will be saved. It can include a relative path.
+    location: str
+        URL of the workspace bucket where the chunks are staged and the file
+        will be saved.
+    digests: iterable
+        Names of other digests of the file to compute besides the md5sum.
+
+    Returns
+    -------
+    url: str
+        URL to the assembled file. Its format will be ``gs://url/to/file``.
+    blob_obj: :py:class:`google.cloud.storage.blob.Blob`
+        Blob object where the file was saved.
+    md5sum, size: str, int
+        MD5 sum and size of the assembled file.
+    other_digests: dict
+        Other digests of the assembled file, indexed by their name.
+
+    """
+    logger.debug('Assembling upload %s as %s at %s', key, filename, location)
+    bucket = get_bucket(location)
+    chunk_blobs = [blob for _, blob in sorted(_list_chunk_blobs(key, location),
+                                              key=lambda item: item[0])]
+    if len(chunk_blobs) > MAX_COMPOSE_COMPONENTS:
+        # Fail before reading any chunk
+        raise QuetzalException(f'Cannot assemble {len(chunk_blobs)} chunks: a composite '
+                               f'object has at most {MAX_COMPOSE_COMPONENTS} components')
+
+    writer = HashingWriter(digests)
+    for blob in chunk_blobs:
+        blob.download_to_file(writer)
+
+    # A compose request accepts a limited number of sources: the first request
+    # creates the target object and the following ones append to it
+    target = bucket.blob(_blob_name(location, filename))
+    target.content_type = 'application/octet-stream'
+    target.compose(chunk_blobs[:MAX_COMPOSE_SOURCES])
+    step = MAX_COMPOSE_SOURCES - 1
+    for i in range(MAX_COMPOSE_SOURCES, len(chunk_blobs), step):
+        target.compose([target] + chunk_blobs[i:i + step])
+
+    delete_blobs(chunk_blobs)
+    return (f'gs://{bucket.name}/{target.name}', target, writer.hexdigest(), writer.size,
+            writer.digests())
+
+
+def delete_chunks(key, location):
+    """ Remove all staged chunks of an upload """
+    delete_blobs((blob for _, blob in _list_chunk_blobs(key, location)), ignore_missing=True)
+
+
+def _blob_name(location, filename):
+    _, prefix = split_location(location)
+    return prefix + filename
+
+
+def _chunks_prefix(key, location):
+    return _blob_name(location, f'{UPLOADS_PREFIX}/{key}/')
+
+
+def _list_chunk_blobs(key, location):
+    bucket = get_bucket(location)
+    prefix = _chunks_prefix(key, location)
+    for blob in bucket.list_blobs(prefix=prefix):
+        yield int(blob.name[len(prefix):]), blob
+
+
+def list_objects(location):
+    """ Iterate over the ``(url, size, modified)`` of the blobs of a location
+
+    Blobs are listed page by page as the iteration advances. The staged
+    chunks of any workspace saved under the location are skipped too, since
+    the data bucket may be shared with the workspaces.
+    """
+    bucket = get_bucket(location)
+    _, prefix = split_location(location)
+    for blob in bucket.list_blobs(prefix=prefix or None):
+        if f'/{UPLOADS_PREFIX}/' in f'/{blob.name}':
+            continue
+        yield f'gs://{bucket.name}/{blob.name}', blob.size, blob.updated
+
+
+def delete_objects(urls):
+    """ Delete blobs with batch requests """
+    delete_blobs(get_object(url) for url in urls)
@@ -1,14 +1,23 @@
+import contextlib
+import datetime
 import logging
+import os
 import pathlib
+import shutil
 import urllib.parse
+from uuid import uuid4
 
 from flask import current_app
 
 from quetzal.app.api.exceptions import QuetzalException
+from quetzal.app.helpers.files import HashingReader, MultiHash
 
 
 logger = logging.getLogger(__name__)
 
+COPY_BUFFER_SIZE = 1 << 20  # 1 Mb
+UPLOADS_DIR = '.uploads'
+
 
 def upload(filename, content, location):
     """ Save a file on a local filesystem.
@@ -55,11 +64,207 @@ def upload(filename, content, location):
     target_path.parent.mkdir(parents=True, exist_ok=True)
     filename = str(target_path.resolve())
 
-    # Save the contents
-    content.save(filename)
+    # Save the contents. This is a streamed copy so that the contents are read
+    # only once, in case `content` is a reader that computes its md5sum
+    with _replacing_file(target_path) as fd:
+        shutil.copyfileobj(content, fd, COPY_BUFFER_SIZE)
 
     return f'file://{filename}', target_path
 
 
 def set_permissions(file_obj, owner):
     logger.debug('File permissions on file local storage does not do anything')
+
+
+def set_permissions_many(file_objs, owner):
+    logger.debug('File permissions on file local storage does not do anything')
+
+
+def upload_chunk(key, offset, content, location):
+    """ Save a chunk of a file being uploaded in several parts
+
+    Implements the *upload chunk* mechanism of the local file storage backend.
+    Chunks are staged in a hidden directory of `location`, named by their
+    offset. A chunk sent again at the same offset replaces the previous one.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload, used to group its chunks.
+    offset: int
+        Position in bytes of the chunk in the file.
+    content: file-like
+        Contents of the chunk.
+    location: str
+        URL of the workspace directory where the chunk will be staged.
+
+    Returns
+    -------
+    md5sum, size: str, int
+        MD5 sum and size of the chunk.
+
+    """
+    logger.debug('Saving chunk %s of upload %s at %s', offset, key, location)
+    chunks_dir = _chunks_dir(key, location)
+    chunks_dir.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary (hidden) file first so that a partial chunk is never
+    # considered as received
+    target_path = chunks_dir / f'{offset:020d}'
+    tmp_path = chunks_dir / f'.{target_path.name}-{uuid4().hex}'
+    reader = HashingReader(content)
+    with open(tmp_path, 'wb') as fd:
+        shutil.copyfileobj(reader, fd, COPY_BUFFER_SIZE)
+    os.replace(tmp_path, target_path)
+
+    return reader.finish()
+
+
+def list_chunks(key, location):
+    """ List the chunks received for an upload
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    location: str
+        URL of the workspace directory where the chunks are staged.
+
+    Returns
+    -------
+    list
+        List of ``(offset, size)`` tuples, sorted by offset.
+
+    """
+    chunks_dir = _chunks_dir(key, location)
+    if not chunks_dir.exists():
+        return []
+    chunks = []
+    for entry in chunks_dir.iterdir():
+        if entry.name.startswith('.'):
+            # Temporary file of a chunk that is still being received
+            continue
+        chunks.append((int(entry.name), entry.stat().st_size))
+    return sorted(chunks)
+
+
+def assemble_chunks(key, filename, location, digests=()):
+    """ Assemble the chunks of an upload into a file
+
+    The chunks are concatenated in order of their offset, in a single pass
+    that also computes the md5sum and size of the file. Staged chunks are
+    removed afterwards.
+
+    Parameters
+    ----------
+    key: str
+        Identifier of the upload.
+    filename: str
+        Filename where the file will be saved. It can include a relative path.
+    location: str
+        URL of the workspace directory where the chunks are staged and the
+        file will be saved.
+    digests: iterable
+        Names of other digests of the file to compute besides the md5sum.
+
+    Returns
+    -------
+    url: str
+        URL to the assembled file. Its format will be ``file://absolute/path/to/file``.
+    path_obj: :py:class:`pathlib.Path`
+        Path object where the file was saved.
+    md5sum, size: str, int
+        MD5 sum and size of the assembled file.
+    other_digests: dict
+        Other digests of the assembled file, indexed by their name.
+
+    """
+    logger.debug('Assembling upload %s as %s at %s', key, filename, location)
+    chunks_dir = _chunks_dir(key, location)
+    target_dir = pathlib.Path(urllib.parse.urlparse(location).path).resolve()
+    target_path = target_dir / filename
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+
+    hashobj = MultiHash(('md5',) + tuple(digests))
+    size = 0
+    with _replacing_file(target_path) as fd:
+        for offset, _ in list_chunks(key, location):
+            with open(chunks_dir / f'{offset:020d}', 'rb') as chunk:
+                while True:
+                    data = chunk.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    hashobj.update(data)
+                    size += len(data)
+                    fd.write(data)
+
+    delete_chunks(key, location)
+    filename = str(target_path.resolve())
+    other_digests = {name: hashobj.hexdigest(name) for name in digests}
+    return f'file://{filename}', target_path, hashobj.hexdigest(), size, other_digests
+
+
+@contextlib.contextmanager
+def _replacing_file(target_path):
+    """ Open a temporary file that replaces `target_path` once written
+
+    A file committed on the local backend may be a hard link of the global
+    data directory. Writing it in place would change the committed contents
+    of all files that reference them, so a new file is written instead and
+    replaces the previous one, which leaves the committed contents intact.
+    """
+    tmp_path = target_path.parent / f'.{target_path.name}-{uuid4().hex}'
+    try:
+        with open(tmp_path, 'wb') as fd:
+            yield fd
+        os.replace(tmp_path, target_path)
+    except:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+def delete_chunks(key, location):
+    """ Remove all staged chunks of an upload """
+    shutil.rmtree(_chunks_dir(key, location), ignore_errors=True)
+
+
+def _chunks_dir(key, location):
+    return pathlib.Path(urllib.parse.urlparse(location).path).resolve() / UPLOADS_DIR / key
+
+
+def list_objects(location):
+    """ Iterate over the ``(url, size, modified)`` of the files of a directory
+
+    The modification date is the latest of the modification and status change
+    times, because files moved or linked on a commit keep their modification
+    time.
+    """
+    parsed = urllib.parse.urlparse(location)
+    if parsed.scheme != 'file' or not parsed.path:
+        raise QuetzalException(f'Cannot list files of {location}: not a local directory')
+    root = pathlib.Path(parsed.path).resolve()
+    if not root.is_dir():
+        return
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (directory == root and entry.name == UPLOADS_DIR):
+                        pending.append(pathlib.Path(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    info = entry.stat(follow_symlinks=False)
+                    modified = datetime.datetime.fromtimestamp(max(info.st_mtime, info.st_ctime),
+                                                               datetime.timezone.utc)
+                    yield f'file://{entry.path}', info.st_size, modified
+
+
+def delete_objects(urls):
+    """ Delete local files, ignoring the ones that do not exist """
+    for url in urls:
+        try:
+            os.unlink(urllib.parse.urlparse(url).path)
+        except FileNotFoundError:
+            pass
@@ -1,26 +1,40 @@
+import concurrent.futures
 import copy
+import functools
 import itertools
 import logging
+import os
 import pathlib
 import shutil
 from urllib.parse import urlparse
 
 from flask import current_app
-from sqlalchemy import func, types
+from google.api_core.exceptions import GoogleAPICallError
+from sqlalchemy import func, tuple_, types
 from sqlalchemy.sql.ddl import CreateSchema
 from sqlalchemy.sql import literal
 from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, insert
 
 from quetzal.app import celery, db
 from quetzal.app.api.exceptions import Conflict, EmptyCommit, WorkerException
-from quetzal.app.helpers.google_api import get_client, get_bucket, get_data_bucket
+from quetzal.app.helpers.files import compute_digests, decode_stream, transfer_file
+from quetzal.app.helpers.google_api import (
+    MAX_BATCH_SIZE, BlobReader, clone_client, delete_blobs, get_client, get_bucket,
+    get_data_bucket, get_object, split_location
+)
 from quetzal.app.helpers.sql import CreateTableAs, DropSchemaIfExists, GrantUsageOnSchema
-from quetzal.app.models import Family, FileState, Metadata, QueryDialect, Workspace, WorkspaceState
+from quetzal.app.models import (
+    DataObject, DataObjectReference, Family, FileState, Metadata, QueryDialect,
+    UploadSession, Workspace, WorkspaceState
+)
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of rows per statement on bulk queries and inserts
+DB_BATCH_SIZE = 1000
+
 
 @celery.task(bind=True, max_retries=10)
 def wait_for_workspace(self, wid):
@@ -199,6 +213,12 @@ def init_data_bucket(wid):
 
 
 def _init_gcp_data_bucket(bucket_name):
+    # With a shared workspace bucket, the workspace is a prefix of that bucket
+    # and there is nothing to create
+    shared_bucket = current_app.config['QUETZAL_GCP_WORKSPACE_BUCKET']
+    if shared_bucket:
+        return f'{shared_bucket.rstrip("/")}/{bucket_name}'
+
     # TODO: manage exceptions/errors
     # TODO: manage location and storage class through configuration or workspace options
     client = get_client()
@@ -264,18 +284,22 @@ def _delete_bucket(url):
 
 
 def _delete_gcp_data_bucket(url):
-    data_bucket = current_app.config['QUETZAL_GCP_DATA_BUCKET']
-    if url.startswith(data_bucket):
+    data_bucket_name, _ = split_location(current_app.config['QUETZAL_GCP_DATA_BUCKET'])
+    bucket_name, prefix = split_location(url)
+    if bucket_name == data_bucket_name and not prefix:
         raise RuntimeError('Refusing to delete the main data bucket')
     client = get_client()
     bucket = get_bucket(url, client=client)
 
-    # Delete all blobs first
-    blobs = list(bucket.list_blobs())
-    bucket.delete_blobs(blobs)  # TODO: use the on_error for missing blobs
+    # Delete all blobs first. They are listed and deleted progressively, in
+    # batch requests, so that the memory usage and the number of requests do
+    # not grow with each object
+    blobs = bucket.list_blobs(prefix=prefix or None, client=client)
+    delete_blobs(blobs, client=client, ignore_missing=True)
 
-    # Delete the bucket
-    bucket.delete()
+    # Delete the bucket, unless the workspace is a prefix of a shared bucket
+    if not prefix:
+        bucket.delete()
 
 
 def _delete_local_data_bucket(url):
@@ -365,13 +389,13 @@ def _make_json_view_query(metadata_query, families):
     # Make a joined table of all metadata and set the json column to the name of the family
     qbase = subqueries.pop(0)  # the first one is always the base family, due to the sort done before
     joined_query = db.session.query(qbase)
-    columns = [qbase.c.metadata_id_file.label('id'), qbase.c.metadata_json.label('base')]
+    columns = [qbase.c.id_file.label('id'), qbase.c.json.label('base')]
     for q in subqueries:
-        joined_query = joined_query.outerjoin((q, qbase.c.metadata_id_file == q.c.metadata_id_file))
+        joined_query = joined_query.outerjoin((q, qbase.c.id_file == q.c.id_file))
         # Here, we are coalescing to set an empty dict to files that do not
         # have an entry for this particular family. This does not apply to the
         # base family because the base family is always present
-        columns.append(coalesce(q.c.metadata_json, literal({}, types.JSON)).label(q.name))
+        columns.append(coalesce(q.c.json, literal({}, types.JSON)).label(q.name))
 
     master_query = joined_query.with_entities(*columns).subquery()
     return master_query
@@ -401,7 +425,7 @@ def _scan_create_table_views(workspace, schema_name):
     for family in workspace.families.all():
 
         tmp = workspace_metadata.filter(Family.name == family.name).subquery()
-        keys_query = db.session.query(func.jsonb_object_keys(tmp.c.metadata_json)).distinct()
+        keys_query = db.session.query(func.jsonb_object_keys(tmp.c.json)).distinct()
         keys = set(res[0] for res in keys_query.all()) - {'id'}
         logger.info('Keys for family %s are %s', family.name, keys)
 
@@ -448,6 +472,7 @@ def commit_workspace(wid):
     if workspace.state != WorkspaceState.COMMITTING:
         raise WorkerException('Workspace was not on the expected state')
 
+    moved_files = []
     db.session.begin_nested()  # make a savepoint
     try:
         # Lock the database so that nothing gets written or read on the database
@@ -481,12 +506,7 @@ def commit_workspace(wid):
             raise EmptyCommit
         logger.info('There are %d files to commit', files_ready.count() + files_deleted.count())
 
-        for file_meta in files_ready:
-            logger.info('Commit: copying %s ( %s) to data directory',
-                        file_meta, file_meta.json['url'])
-            new_url = _commit_file(file_meta.json['id'], file_meta.json['url'])
-            file_meta.update({'url': new_url})
-            db.session.add(file_meta)
+        _commit_files(files_ready.all(), moved_files)
 
         # Do the committing task:
         # Iterate over all families, but do base family last, because the
@@ -542,6 +562,7 @@ def commit_workspace(wid):
     except Conflict:
         logger.info('Commit failed due to conflict', exc_info=True)
         db.session.rollback()  # revert to savepoint
+        _restore_moved_files(moved_files)
         workspace.state = WorkspaceState.CONFLICT
         db.session.add(workspace)
 
@@ -555,6 +576,7 @@ def commit_workspace(wid):
         logger.info('Unexpected error on workspace commit, workspace will '
                     'remain in COMMITTING state', exc_info=True)
         db.session.rollback()  # revert to savepoint
+        _restore_moved_files(moved_files)
 
     db.session.commit()
 
@@ -583,30 +605,182 @@ def _conflict_detection(workspace):
 
 
 
-def _commit_file(file_id, file_url):
-    # TODO: move to a file operations file, along with upload/download
-    storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
-    if storage_backend == 'GCP':
-        return _commit_file_gcp(file_id, file_url)
-    elif storage_backend == 'file':
-        return _commit_file_local(file_id, file_url)
-    raise ValueError(f'Unknown storage backend {storage_backend}')
+def _commit_files(files_meta, moved_files):
+    """Save the contents of files on the global data storage
 
+    Contents are stored once per checksum and size: when there is already an
+    object with the same contents, nothing is copied and the file only gets
+    a reference to the existing object. The contents that are not stored yet
+    are transferred concurrently, and then the *url* entry of the base
+    metadata of each file is updated.
+
+    Workspace files that are moved instead of copied are appended to
+    `moved_files`, so that they can be restored if the commit fails.
+    """
+    # Determine which contents are already stored
+    contents = {(meta.json['checksum'], meta.json['size']) for meta in files_meta
+                if meta.json.get('checksum') is not None and meta.json.get('size') is not None}
+    objects = dict.fromkeys(contents)
+    contents = list(contents)
+    for i in range(0, len(contents), DB_BATCH_SIZE):
+        batch = contents[i:i + DB_BATCH_SIZE]
+        existing = DataObject.query.filter(tuple_(DataObject.checksum, DataObject.size).in_(batch))
+        for data_object in existing:
+            objects[(data_object.checksum, data_object.size)] = data_object
+
+    # Transfer each content that is not stored yet only once
+    transfers = {}
+    codecs = {}
+    for meta in files_meta:
+        content = (meta.json.get('checksum'), meta.json.get('size'))
+        if content not in objects:
+            # Without checksum, the contents cannot be addressed
+            transfers[meta.json['id']] = meta.json['url']
+        elif objects[content] is None:
+            transfers.setdefault(DataObject.make_key(*content), meta.json['url'])
+            codecs.setdefault(content, meta.json.get('codec'))
+    logger.info('Commit: transferring %d files, %d files are already stored',
+                len(transfers), len(files_meta) - len(transfers))
+    urls = _transfer_files(transfers, moved_files)
+
+    references = []
+    for meta in files_meta:
+        content = (meta.json.get('checksum'), meta.json.get('size'))
+        if content not in objects:
+            meta.update({'url': urls[meta.json['id']]})
+            continue
+        if objects[content] is None:
+            objects[content] = DataObject(checksum=content[0], size=content[1],
+                                          url=urls[DataObject.make_key(*content)],
+                                          codec=codecs[content])
+            db.session.add(objects[content])
+        # The stored object may have been encoded with another codec than
+        # this file, or without any codec
+        new_json = dict(meta.json, url=objects[content].url, codec=objects[content].codec)
+        if new_json['codec'] is None:
+            del new_json['codec']
+        meta.json = new_json
+        references.append((meta.json['id'], objects[content]))
+    db.session.add_all(files_meta)
+    db.session.flush()
+
+    # Point the references of the files to their object, with set-based writes
+    for i in range(0, len(references), DB_BATCH_SIZE):
+        rows = [{'id_file': file_id, 'fk_data_object_id': data_object.id}
+                for file_id, data_object in references[i:i + DB_BATCH_SIZE]]
+        statement = insert(DataObjectReference.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['id_file'],
+            set_={'fk_data_object_id': statement.excluded.fk_data_object_id},
+        )
+        db.session.execute(statement)
 
-def _commit_file_local(file_id, file_url):
-    source_path = pathlib.Path(urlparse(file_url).path)
-    target_path = pathlib.Path(current_app.config['QUETZAL_FILE_DATA_DIR']) / file_id
-    shutil.copy(str(source_path.resolve()), str(target_path.resolve()))
-    return f'file://{target_path.resolve()}'
 
+def _transfer_files(transfers, moved_files):
+    """Copy files to the global data storage concurrently
 
-def _commit_file_gcp(file_id, file_url):
-    file_url_parsed = urlparse(file_url)
-    data_bucket = get_data_bucket()
-    workpace_bucket = get_bucket(file_url)
-    source_blob = workpace_bucket.blob(file_url_parsed.path.lstrip('/'))
-    new_blob = workpace_bucket.copy_blob(source_blob, data_bucket, file_id)
-    return f'gs://{data_bucket.name}/{new_blob.name}'
+    Parameters
+    ----------
+    transfers: dict
+        Source URLs of the files to copy, indexed by their name on the global
+        data storage.
+    moved_files: list
+        List where the local files that were moved are appended.
+
+    Returns
+    -------
+    dict
+        URLs of the copied files, indexed by their name.
+
+    """
+    storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if storage_backend == 'GCP':
+        client = get_client()
+        transfer = functools.partial(_commit_files_gcp,
+                                     client=client,
+                                     data_bucket_name=get_data_bucket(client=client).name)
+        max_workers = current_app.config['QUETZAL_GCP_COMMIT_WORKERS']
+        group_size = MAX_BATCH_SIZE
+    elif storage_backend == 'file':
+        transfer = functools.partial(_commit_files_local,
+                                     data_dir=current_app.config['QUETZAL_FILE_DATA_DIR'],
+                                     moved_files=moved_files)
+        max_workers = current_app.config['QUETZAL_FILE_COMMIT_WORKERS']
+        group_size = 1
+    else:
+        raise ValueError(f'Unknown storage backend {storage_backend}')
+
+    urls = {}
+    if not transfers:
+        return urls
+    items = list(transfers.items())
+    groups = [items[i:i + group_size] for i in range(0, len(items), group_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(transfer, group) for group in groups]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                urls.update(future.result())
+        except:
+            # Do not start any pending transfer. The executor waits for the
+            # running ones, so that any moved file can be restored afterwards
+            for future in futures:
+                future.cancel()
+            raise
+    return urls
+
+
+def _commit_files_local(group, *, data_dir, moved_files):
+    urls = {}
+    for name, file_url in group:
+        source_path = pathlib.Path(urlparse(file_url).path).resolve()
+        target_path = (pathlib.Path(data_dir) / name).resolve()
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        # The workspace copy of a committed file is no longer needed, so it
+        # may be moved. It is restored if the commit fails
+        strategy = transfer_file(source_path, target_path, move=True)
+        logger.info('Commit: %s transferred to %s with %s', source_path, target_path, strategy)
+        if strategy == 'rename':
+            moved_files.append((source_path, target_path))
+        urls[name] = f'file://{target_path}'
+    return urls
+
+
+def _commit_files_gcp(group, *, client, data_bucket_name):
+    # Each group uses its own client, because the batch is saved on the client
+    client = clone_client(client)
+    data_bucket = client.bucket(data_bucket_name)
+    try:
+        with client.batch():
+            for name, file_url in group:
+                source_blob = _blob_from_url(file_url, client)
+                source_blob.bucket.copy_blob(source_blob, data_bucket, name, client=client)
+    except GoogleAPICallError:
+        # Copies of large objects between locations or storage classes may
+        # need several requests, which is only possible with rewrites
+        logger.warning('Commit: batch copy failed, retrying each object with '
+                       'a rewrite', exc_info=True)
+        for name, file_url in group:
+            source_blob = _blob_from_url(file_url, client)
+            new_blob = data_bucket.blob(name)
+            token, _, _ = new_blob.rewrite(source_blob, client=client)
+            while token is not None:
+                token, _, _ = new_blob.rewrite(source_blob, token=token, client=client)
+
+    logger.info('Commit: %d objects transferred to %s', len(group), data_bucket_name)
+    return {name: f'gs://{data_bucket_name}/{name}' for name, _ in group}
+
+
+def _blob_from_url(url, client):
+    url_parsed = urlparse(url)
+    return client.bucket(url_parsed.netloc).blob(url_parsed.path.lstrip('/'))
+
+
+def _restore_moved_files(moved_files):
+    """Move back the workspace files that were moved during a failed commit"""
+    for source_path, target_path in reversed(moved_files):
+        logger.info('Restoring %s from %s', source_path, target_path)
+        os.replace(str(target_path), str(source_path))
+    moved_files.clear()
 
 
 def merge(ancestor, theirs, mine):
@@ -764,3 +938,117 @@ def _update_global_json_views(schema_name):
 
     # Set permissions on readonly user to the schema contents
     db.session.execute(GrantUsageOnSchema(schema_name, 'db_ro_user'))
+
+
+@celery.task()
+def compute_file_digests(file_id, digests):
+    """ Compute other digests of a file and save them in its base metadata
+
+    This task is scheduled after an upload when ``QUETZAL_ASYNC_DIGESTS`` is
+    set, so that the upload responds before these digests are computed. The
+    md5sum is computed again in the same pass, and only the base metadata
+    entries with the same md5sum and size are updated. This includes the
+    committed entries when the workspace was committed in the meantime.
+
+    Parameters
+    ----------
+    file_id: str
+        File identifier.
+    digests: list
+        Names of the digests to compute.
+
+    """
+    logger.info('Computing digests %s of file %s...', digests, file_id)
+
+    latest = (
+        Metadata.query
+        .join(Family)
+        .filter(Family.name == 'base', Metadata.id_file == file_id)
+        .filter(Metadata.json['url'].astext.isnot(None),
+                Metadata.json['url'].astext != '',
+                Metadata.json['state'].astext != FileState.DELETED.name)
+        .order_by(Metadata.id.desc())
+        .first()
+    )
+    if latest is None:
+        # The file was deleted or its contents were removed in the meantime
+        logger.info('File %s has no contents, digests were not computed', file_id)
+        return
+
+    # The file is read without any lock on its metadata
+    with _open_file(latest.json['url'], latest.json.get('codec')) as file_obj:
+        values, size = compute_digests(file_obj, ['md5'] + list(digests))
+    md5 = values.pop('md5')
+
+    base_metadata = (
+        Metadata.query
+        .join(Family)
+        .filter(Family.name == 'base', Metadata.id_file == file_id)
+        .with_for_update(of=Metadata)
+    )
+    for meta in base_metadata:
+        if (meta.json.get('checksum'), meta.json.get('size')) == (md5, size):
+            meta.update(values)
+            db.session.add(meta)
+    db.session.commit()
+
+    logger.info('Computed digests of file %s', file_id)
+
+
+@celery.task()
+def finalize_upload(sid):
+    """ Create the file of an upload session from its chunks
+
+    This task is scheduled when an upload is finalized. The session is locked
+    while its chunks are assembled, so that it cannot be deleted in the
+    meantime. When the file cannot be created, the finalization of the
+    session is cancelled so that it can be requested again.
+
+    Parameters
+    ----------
+    sid: str
+        Upload session identifier.
+
+    """
+    # Imported here because the upload module schedules this task
+    from quetzal.app.api.data.upload import assemble_upload
+
+    logger.info('Finalizing upload %s...', sid)
+    upload = (
+        UploadSession.query
+        .filter_by(id=sid)
+        .with_for_update()
+        .populate_existing()
+        .first()
+    )
+    if upload is None or not upload.finalizing:
+        logger.info('Upload %s was deleted or finalized in the meantime', sid)
+        db.session.rollback()
+        return
+
+    try:
+        assemble_upload(upload)
+    except:
+        logger.warning('Failed to finalize upload %s', sid, exc_info=True)
+        db.session.rollback()
+        upload = UploadSession.query.filter_by(id=sid).with_for_update().first()
+        if upload is not None and upload.finalizing:
+            upload.finalize_date = None
+            db.session.add(upload)
+        db.session.commit()
+        return
+
+    logger.info('Upload %s finalized as file %s', sid, upload.id_file)
+
+
+def _open_file(url, codec=None):
+    storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
+    if storage_backend == 'GCP':
+        file_obj = BlobReader(get_object(url))
+    elif storage_backend == 'file':
+        file_obj = open(urlparse(url).path, 'rb')
+    else:
+        raise WorkerException(f'Unknown storage backend {storage_backend}.')
+    if codec is not None:
+        return decode_stream(file_obj, codec)
+    return file_obj
@@ -0,0 +1,333 @@
+import datetime
+import io
+import logging
+import pathlib
+from uuid import uuid4
+
+from flask import current_app
+from requests import codes
+
+from quetzal.app import db
+from quetzal.app.api.data import storage
+from quetzal.app.api.data.helpers import (
+    discard_uploads, extra_digests, find_stored_contents, get_base_family,
+    get_writable_workspace, now, reference_contents, schedule_digests,
+    upload_digests, verify_filename_path
+)
+from quetzal.app.api.data.tasks import finalize_upload
+from quetzal.app.api.exceptions import APIException
+from quetzal.app.helpers.files import split_check_path
+from quetzal.app.models import FileState, Metadata, UploadSession, Workspace
+from quetzal.app.security import ReadWorkspacePermission
+
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_CHUNKS = 1024
+""" Maximum number of chunks of an upload, which is the limit of components of a GCP composite object """
+
+
+def create(*, wid, body, user, token_info=None):
+    """ Start a resumable upload of a file on a workspace
+
+    Large files can be uploaded in chunks, which is more robust than a single
+    request because a failed chunk can be sent again without losing the
+    chunks that were already received. Chunks may also be sent in parallel.
+
+    An upload session is started with this function, then the chunks are sent
+    with :py:func:`upload_chunk` and finally the file is created with
+    :py:func:`finalize`.
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier where the file will be uploaded.
+    body: dict
+        Upload details: filename, path, size and temporary.
+    user: quetzal.app.models.User
+        User that owns the file. This parameter is set by connexion.
+    token_info:
+        Authentication token. This parameter is set by connexion.
+
+    Returns
+    -------
+    details: dict
+        Upload details object.
+    code: int
+        HTTP response code.
+
+    API endpoints
+    -------------
+    * `POST /api/v1/data/workspaces/{wid}/uploads/`
+      :redoc:`See in redoc <operation/workspace_upload.create>`.
+
+    """
+    workspace = get_writable_workspace(wid)
+
+    # Fail early when the workspace is not correctly configured
+    get_base_family(workspace)
+
+    path, filename = split_check_path(body['filename'])
+    if 'path' in body:
+        path = body['path']
+    verify_filename_path(filename, path)
+
+    upload = UploadSession(id=uuid4(),
+                           filename=filename,
+                           path=path,
+                           size=body.get('size'),
+                           temporary=body.get('temporary', False),
+                           workspace=workspace,
+                           owner=user)
+    db.session.add(upload)
+    db.session.commit()
+
+    return upload.to_dict(chunks=[]), codes.created
+
+
+def details(*, wid, sid):
+    """ Get the details of an upload, including the chunks received so far
+
+    API endpoints
+    -------------
+    * `GET /api/v1/data/workspaces/{wid}/uploads/{sid}`
+      :redoc:`See in redoc <operation/workspace_upload.details>`.
+
+    """
+    workspace = Workspace.get_or_404(wid)
+
+    if not ReadWorkspacePermission(wid).can():
+        raise APIException(status=codes.forbidden,
+                           title='Forbidden',
+                           detail='You are not authorized to read uploads on this workspace')
+
+    upload = UploadSession.get_or_404(sid, workspace)
+    chunks = [] if upload.finalized else storage.list_chunks(str(upload.id), workspace.data_url)
+    return upload.to_dict(chunks=chunks), codes.ok
+
+
+def upload_chunk(*, wid, sid, offset, body, user=None, token_info=None):
+    """ Send a chunk of the contents of a file being uploaded
+
+    Sending a chunk again on the same offset replaces the previous one. An
+    upload can have at most ``MAX_UPLOAD_CHUNKS`` chunks: when its size is
+    declared, any chunk but the last one must have at least that size divided
+    by ``MAX_UPLOAD_CHUNKS``.
+
+    Returns
+    -------
+    details: dict
+        Chunk details object, with its offset, size and checksum.
+    code: int
+        HTTP response code.
+
+    API endpoints
+    -------------
+    * `PUT /api/v1/data/workspaces/{wid}/uploads/{sid}`
+      :redoc:`See in redoc <operation/workspace_upload.upload_chunk>`.
+
+    """
+    workspace = get_writable_workspace(wid)
+    # Locked so that the upload is not finalized or deleted while the chunk is
+    # saved, which would leave the chunk behind. Chunks of the same upload are
+    # still received concurrently
+    upload = UploadSession.get_or_404(sid, workspace, for_share=True)
+
+    if upload.finalized:
+        raise APIException(status=codes.precondition_failed,
+                           title='Upload already finalized',
+                           detail=f'Upload {sid} was already finalized as file {upload.id_file}')
+
+    if upload.finalizing:
+        raise APIException(status=codes.precondition_failed,
+                           title='Upload being finalized',
+                           detail=f'Upload {sid} is being finalized and cannot receive more chunks')
+
+    if offset < 0:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid chunk offset',
+                           detail='Chunk offset cannot be negative')
+
+    if upload.size is not None and offset + len(body) > upload.size:
+        raise APIException(status=codes.bad_request,
+                           title='Invalid chunk',
+                           detail=f'Chunk at offset {offset} exceeds the '
+                                  f'declared file size of {upload.size} bytes')
+
+    if upload.size is not None and offset + len(body) < upload.size and \
+            len(body) < _min_chunk_size(upload.size):
+        raise APIException(status=codes.bad_request,
+                           title='Invalid chunk',
+                           detail=f'Chunks of a file of {upload.size} bytes must have at least '
+                                  f'{_min_chunk_size(upload.size)} bytes, except the last one')
+
+    try:
+        md5, size = storage.upload_chunk(str(upload.id), offset,
+                                         io.BytesIO(body), workspace.data_url)
+    except:
+        logger.warning('Failed to upload chunk', exc_info=True)
+        raise APIException(status=codes.server_error,
+                           title='Failed to upload chunk',
+                           detail='Could not upload chunk')
+
+    # Release the lock
+    db.session.commit()
+    return {'offset': offset, 'size': size, 'checksum': md5}, codes.ok
+
+
+def finalize(*, wid, sid, user=None, token_info=None):
+    """ Request the creation of the file of an upload from its chunks
+
+    The chunks must cover the file contents from the beginning without any
+    gaps. When the upload declared a size, the chunks must also cover the
+    declared size.
+
+    The file is created by a background task, because computing its
+    digests reads all its contents: the upload details are returned
+    immediately, and their ``file_id`` is set once the file is created. If
+    the task fails, the upload can be finalized again. Finalizing an upload
+    that is being finalized responds with its details again, and finalizing
+    an upload that was already finalized responds with the file details.
+
+    Returns
+    -------
+    details: dict
+        Upload details object, or file details object when the upload was
+        already finalized.
+    code: int
+        HTTP response code.
+
+    API endpoints
+    -------------
+    * `POST /api/v1/data/workspaces/{wid}/uploads/{sid}/finalize`
+      :redoc:`See in redoc <operation/workspace_upload.finalize>`.
+
+    """
+    workspace = get_writable_workspace(wid)
+    # Concurrent finalizations of the same upload, such as a retry of a
+    # request that timed out, wait here until the first one is saved, and
+    # then see the upload as finalizing or finalized
+    upload = UploadSession.get_or_404(sid, workspace, for_update=True)
+    base_family = get_base_family(workspace)
+
+    if upload.finalized:
+        # Finalizing twice is permitted so that a client can retry when the
+        # response was lost
+        meta = Metadata.get_latest(upload.id_file, base_family)
+        return meta.json, codes.ok
+
+    if upload.finalizing:
+        return upload.to_dict(), codes.accepted
+
+    # Verify the chunks. Only their list is read here
+    chunks = storage.list_chunks(str(upload.id), workspace.data_url)
+    if not chunks:
+        raise APIException(status=codes.precondition_failed,
+                           title='Incomplete upload',
+                           detail='Upload has not received any chunk')
+    if len(chunks) > MAX_UPLOAD_CHUNKS:
+        raise APIException(status=codes.precondition_failed,
+                           title='Too many chunks',
+                           detail=f'Upload has {len(chunks)} chunks, but files can be '
+                                  f'assembled from at most {MAX_UPLOAD_CHUNKS} chunks')
+    expected_offset = 0
+    for offset, size in chunks:
+        if offset < expected_offset:
+            raise APIException(status=codes.precondition_failed,
+                               title='Overlapping chunks',
+                               detail=f'Upload has a chunk at offset {offset} that '
+                                      f'overlaps bytes up to {expected_offset - 1}')
+        if offset != expected_offset:
+            raise APIException(status=codes.precondition_failed,
+                               title='Incomplete upload',
+                               detail=f'Upload is missing bytes {expected_offset} '
+                                      f'to {offset - 1}')
+        expected_offset = offset + size
+    if upload.size is not None and expected_offset != upload.size:
+        raise APIException(status=codes.precondition_failed,
+                           title='Incomplete upload',
+                           detail=f'Upload has received {expected_offset} bytes '
+                                  f'of {upload.size}')
+
+    # No chunk can be received from now on
+    upload.finalize_date = datetime.datetime.now(datetime.timezone.utc)
+    db.session.add(upload)
+    db.session.commit()
+    finalize_upload.si(str(upload.id)).apply_async()
+
+    return upload.to_dict(), codes.accepted
+
+
+def assemble_upload(upload):
+    """ Create the file of an upload that is being finalized
+
+    This function is called by the finalization task, with the upload session
+    locked. The chunks are assembled, the file is created with its base
+    metadata and the session is marked as finalized.
+
+    Parameters
+    ----------
+    upload: quetzal.app.models.UploadSession
+        Upload session being finalized.
+
+    """
+    workspace = upload.workspace
+    base_family = get_base_family(workspace)
+    url, obj, md5, size, digests = storage.assemble_chunks(str(upload.id),
+                                                           str(pathlib.Path(upload.path) / upload.filename),
+                                                           workspace.data_url,
+                                                           upload_digests())
+
+    stored = find_stored_contents([(md5, size)]) if current_app.config['QUETZAL_UPLOAD_DEDUP'] else {}
+    if (md5, size) not in stored:
+        storage.set_permissions(obj, workspace.owner)
+
+    state = FileState.TEMPORARY if upload.temporary else FileState.READY
+    meta = Metadata(id_file=uuid4(), family=base_family)
+    meta.json = {
+        'id': str(meta.id_file),
+        'filename': upload.filename,
+        'path': upload.path,
+        'size': size,
+        'checksum': md5,
+        'date': now(),
+        'url': url,
+        'state': state.name,
+        **{name: None for name in extra_digests()},
+        **digests,
+    }
+    if (md5, size) in stored:
+        # The contents were already committed: the assembled copy is not needed
+        meta.json = reference_contents(meta.json, stored[(md5, size)])
+    upload.id_file = meta.id_file
+    db.session.add_all([meta, upload])
+    db.session.commit()
+    if (md5, size) in stored:
+        discard_uploads([url])
+    schedule_digests([meta.id_file])
+
+
+def _min_chunk_size(size):
+    """ Minimum size of the chunks of a file, but its last chunk """
+    return -(-size // MAX_UPLOAD_CHUNKS)
+
+
+def delete(*, wid, sid, user=None, token_info=None):
+    """ Abort an upload and discard its chunks
+
+    API endpoints
+    -------------
+    * `DELETE /api/v1/data/workspaces/{wid}/uploads/{sid}`
+      :redoc:`See in redoc <operation/workspace_upload.delete>`.
+
+    """
+    workspace = get_writable_workspace(wid)
+    # Locked so that the chunks are not removed while a finalization assembles them
+    upload = UploadSession.get_or_404(sid, workspace, for_update=True)
+
+    if not upload.finalized:
+        storage.delete_chunks(str(upload.id), workspace.data_url)
+
+    db.session.delete(upload)
+    db.session.commit()
+    return None, codes.no_content
@@ -64,11 +64,32 @@ class WorkspaceFilesRouter:
     Where ``func`` is a member of this class.
     """
     create = _data.file.create
+    create_archive = _data.file.create_archive
+    create_reference = _data.file.create_reference
     delete = _data.file.delete
     details = _data.file.details_w
     fetch = _data.file.fetch_w
+    fetch_archive = _data.file.fetch_archive_w
     set_metadata = _data.file.set_metadata
     update_metadata = _data.file.update_metadata
+    update_metadata_many = _data.file.update_metadata_many
+
+
+class WorkspaceUploadRouter:
+    """Router for resumable upload operations inside a workspace.
+
+    Use as::
+
+        operationId: workspace_upload.func
+        x-openapi-router-controller: app.api.router
+
+    Where ``func`` is a member of this class.
+    """
+    create = _data.upload.create
+    delete = _data.upload.delete
+    details = _data.upload.details
+    finalize = _data.upload.finalize
+    upload_chunk = _data.upload.upload_chunk
 
 
 class WorkspaceQueryRouter:
@@ -98,6 +119,7 @@ class PublicRouter:
     """
     file_details = _data.file.details
     file_fetch = _data.file.fetch
+    file_fetch_archive = _data.file.fetch_archive
     query_create = _data.query.create
     query_fetch = _data.query.fetch
     query_details = _data.query.details
@@ -107,5 +129,6 @@ class PublicRouter:
 auth = AuthRouter
 workspace = WorkspaceRouter
 workspace_file = WorkspaceFilesRouter
+workspace_upload = WorkspaceUploadRouter
 workspace_query = WorkspaceQueryRouter
 public = PublicRouter
@@ -7,6 +7,7 @@ import binascii
 import logging
 import pathlib
 
+from .api.data import gc
 from .helpers.google_api import get_bucket
 from .helpers.files import get_readable_info
 
@@ -71,3 +72,11 @@ def backup_logs(app):
 
         if errors:
             logger.error('Failed to backup %d log files: %s', len(errors), errors)
+
+
+def collect_garbage(app):
+    with app.app_context():
+        report = gc.collect_garbage()
+        if report is not None:
+            logger.info('Garbage collection reclaimed %d bytes of %d unreferenced files',
+                        report['reclaimed_bytes'], report['deleted'])
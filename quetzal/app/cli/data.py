@@ -4,6 +4,7 @@ import click
 from flask import current_app
 from flask.cli import AppGroup
 
+from quetzal.app.api.data.gc import collect_garbage
 from quetzal.app.helpers.google_api import get_client
 
 
@@ -66,3 +67,30 @@ def data_init_backups(storage_class, location):
     bucket.create()
 
     click.secho(f'Bucket {bucket.name} created successfully!')
+
+
+@data_cli.command('gc')
+@click.option('--grace-period', type=int, default=None,
+              help='Minimum age in seconds of the deleted files. '
+                   'Default: QUETZAL_GC_GRACE_PERIOD configuration')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Count the unreferenced files without deleting them')
+def data_gc_command(grace_period, dry_run):
+    """ Delete stored files that are not referenced by any metadata"""
+    report = collect_garbage(grace_period, dry_run=dry_run)
+    if report is None:
+        raise click.ClickException('Another garbage collection is running')
+
+    for location_report in report['locations']:
+        click.secho(f'{location_report["location"]}: {location_report["scanned"]} files, '
+                    f'{location_report["unreferenced"]} unreferenced')
+
+    if dry_run:
+        click.secho(f'Dry run: {report["unreferenced"]} unreferenced files and '
+                    f'{report["expired_uploads"]} expired uploads were not deleted')
+    else:
+        click.secho(f'Deleted {report["deleted"]} files, '
+                    f'{report["reclaimed_bytes"]} bytes reclaimed, '
+                    f'and {report["expired_uploads"]} expired uploads')
+    if report['errors']:
+        click.secho(f'Could not delete {report["errors"]} files', fg='red')
@@ -5,7 +5,9 @@ response validation. See https://github.com/zalando/connexion/issues/860
 
 Until this issue is fixed, we need to find a way to avoid a false validation
 error when a requests sends an 'application/octet-stream' accept header when
-downloading files
+downloading files. Skipping the validation of these responses also avoids
+reading the complete file contents in memory, which is why the validation of
+archive downloads is always skipped.
 """
 import functools
 import logging
@@ -20,11 +22,18 @@ logger = logging.getLogger(__name__)
 
 class CustomResponseValidator(ResponseValidator):
 
-    def validate_response_with_request(self, request, data, status_code, headers, url):
+    def skip_validation(self, request):
+        # Archive downloads are always streamed
+        if self.operation.operation_id in ('quetzal.app.api.router.workspace_file.fetch_archive',
+                                           'quetzal.app.api.router.public.file_fetch_archive'):
+            return True
         details_op = self.operation.operation_id in ('quetzal.app.api.router.workspace_file.details',
                                                      'quetzal.app.api.router.public.file_details')
         accept_octet_header = (request.headers.get('accept', '') == 'application/octet-stream')
-        if details_op and accept_octet_header:
+        return details_op and accept_octet_header
+
+    def validate_response_with_request(self, request, data, status_code, headers, url):
+        if self.skip_validation(request):
             logging.debug('Circumventing validation for octet-stream')
             return True
         return self.validate_response(data, status_code, headers, url)
@@ -32,6 +41,12 @@ class CustomResponseValidator(ResponseValidator):
     def __call__(self, function):
 
         def _wrapper(request, response):
+            # Converting the response to a connexion response reads all its
+            # contents in memory, which must be avoided when streaming files
+            if self.skip_validation(request):
+                logging.debug('Circumventing validation for octet-stream')
+                return response
+
             try:
                 connexion_response = \
                     self.operation.api.get_connexion_response(response, self.mimetype)
@@ -0,0 +1,322 @@
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# Number of lookups between each report of the cache counters
+STATS_LOG_INTERVAL = 100
+
+# Seconds between each attempt to take the lock of an entry being filled
+LOCK_POLL_INTERVAL = 0.05
+
+# Process-wide caches, by directory
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_disk_cache(directory, max_size, fill_wait=0):
+    """ Get the process-wide disk cache of a directory
+
+    Parameters
+    ----------
+    directory: str
+        Directory where the cached files are saved.
+    max_size: int
+        Maximum size in bytes of all the cached files.
+    fill_wait: float
+        Maximum time in seconds that a miss waits for a concurrent fill of
+        the same entry.
+
+    Returns
+    -------
+    cache: DiskCache
+        The cache instance, which is created on the first call.
+
+    """
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None or (cache.max_size, cache.fill_wait) != (max_size, fill_wait):
+            cache = _caches[directory] = DiskCache(directory, max_size, fill_wait)
+        return cache
+
+
+class DiskCache:
+    """ Bounded read-through cache of files on a local directory
+
+    Entries are identified by a key, such as the URL and version of a
+    remote file, and saved as files named by a hash of the key. Several
+    processes can share the same directory:
+
+    * An entry is filled on a temporary file while its contents are read
+      from the source, and the temporary file is renamed once it is
+      complete, so an incomplete entry is never read.
+    * Only one thread or process fills an entry at a time, which is ensured
+      by a lock file of that entry. Concurrent misses of the same entry wait
+      for the fill during at most `fill_wait` seconds and then read the
+      entry. When the fill takes longer, such as a large file sent to a slow
+      client, they read their contents from the source without filling the
+      entry, so the same contents may be downloaded more than once. Misses
+      of other entries are never blocked.
+    * After each fill, the least recently used entries are removed until
+      the total size is below the maximum size. Reading an entry updates its
+      modification time, which is used as its last use time.
+
+    An entry that is removed while it is being read remains readable, since
+    entries are returned as open files.
+
+    Parameters
+    ----------
+    directory: str
+        Directory where the cached files are saved.
+    max_size: int
+        Maximum size in bytes of all the cached files.
+    fill_wait: float
+        Maximum time in seconds that a miss waits for a concurrent fill of
+        the same entry.
+
+    Attributes
+    ----------
+    hits, misses, evictions: int
+        Counters of this process. They are logged at the ``INFO`` level
+        every ``STATS_LOG_INTERVAL`` lookups.
+
+    """
+
+    def __init__(self, directory, max_size, fill_wait=0):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.fill_wait = fill_wait
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._counters_lock = threading.Lock()
+
+    def open(self, key, source):
+        """ Open a cached entry, or its source while filling it on a miss
+
+        Parameters
+        ----------
+        key: tuple
+            Entry key. Its ``repr`` identifies the entry.
+        source: callable
+            Function without arguments that opens the contents of the entry
+            as a binary file object. It is only called on a miss.
+
+        Returns
+        -------
+        file_obj: file-like
+            The entry contents, opened in binary read mode. On a miss, the
+            contents are read from the source as they are needed, and the
+            entry is created once they have been read until the end. An entry
+            that is not read completely, or whose source raises an exception,
+            is not created.
+
+        """
+        path = self._path(key)
+        file_obj = self._open_entry(path)
+        if file_obj is not None:
+            self._count(hits=1)
+            return file_obj
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lock = _FileLock(path.with_name(f'.{path.name}.lock'))
+        if not lock.acquire(timeout=self.fill_wait):
+            # Another thread or process is still filling the entry: rather
+            # than waiting longer, read the contents directly
+            self._count(misses=1)
+            return source()
+
+        try:
+            # Another thread or process may have filled it in the meantime
+            file_obj = self._open_entry(path)
+            if file_obj is not None:
+                lock.release()
+                self._count(hits=1)
+                return file_obj
+            self._count(misses=1)
+            return _FillingReader(self, path, lock, source())
+        except:
+            lock.release()
+            raise
+
+    def get(self, key):
+        """ Open a cached entry, without filling it on a miss
+
+        Parameters
+        ----------
+        key: tuple
+            Entry key. Its ``repr`` identifies the entry.
+
+        Returns
+        -------
+        file_obj: file-like or None
+            The entry contents, opened in binary read mode, or ``None`` when
+            the entry is not on the cache.
+
+        """
+        file_obj = self._open_entry(self._path(key))
+        if file_obj is None:
+            self._count(misses=1)
+        else:
+            self._count(hits=1)
+        return file_obj
+
+    def stats(self):
+        """ Get the counters of this process as a dictionary """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return self.directory / digest[:2] / digest
+
+    def _open_entry(self, path):
+        try:
+            file_obj = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(file_obj.fileno())
+        return file_obj
+
+    def _count(self, hits=0, misses=0, evictions=0):
+        with self._counters_lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+            report = (hits or misses) and (self.hits + self.misses) % STATS_LOG_INTERVAL == 0
+        if report:
+            logger.info('Disk cache %s: %d hits, %d misses, %d evictions',
+                        self.directory, self.hits, self.misses, self.evictions)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for subdir in self.directory.iterdir():
+            if subdir.name.startswith('.') or not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir):
+                if entry.name.startswith('.'):
+                    # Entry being filled, or its lock file
+                    continue
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+                total += info.st_size
+
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+                evicted += 1
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            total -= size
+        if evicted:
+            self._count(evictions=evicted)
+
+
+class _FillingReader(io.RawIOBase):
+    """ Reader of the source of a cache entry that saves what it reads
+
+    The entry is created when the source has been read until its end. The
+    lock of the entry is held until then, or until the reader is closed.
+    """
+
+    def __init__(self, cache, path, lock, source):
+        super().__init__()
+        self._cache = cache
+        self._path = path
+        self._lock = lock
+        self._source = source
+        self._tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        self._tmp = open(self._tmp_path, 'wb')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.read(len(buffer))
+        if self._tmp is not None:
+            if data:
+                self._tmp.write(data)
+            else:
+                self._complete()
+        n = len(data)
+        buffer[:n] = data
+        return n
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._discard()
+                self._source.close()
+            finally:
+                super().close()
+
+    def _complete(self):
+        self._tmp.close()
+        self._tmp = None
+        try:
+            os.replace(self._tmp_path, self._path)
+        finally:
+            self._lock.release()
+        self._cache._evict()
+
+    def _discard(self):
+        if self._tmp is None:
+            return
+        self._tmp.close()
+        self._tmp = None
+        try:
+            self._tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        self._lock.release()
+
+
+class _FileLock:
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    def acquire(self, timeout=0):
+        # The file is opened again on each attempt, since the previous holder
+        # removes it when it releases the lock
+        deadline = time.monotonic() + timeout
+        while True:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(LOCK_POLL_INTERVAL)
+                continue
+            self._fd = fd
+            return True
+
+    def release(self):
+        # The lock file is removed so that they do not accumulate. Anyone that
+        # opened it before and acquires it later checks the entry again
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
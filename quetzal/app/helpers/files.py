@@ -1,5 +1,35 @@
+import concurrent.futures
+import fcntl
 import hashlib
+import io
+import logging
+import mmap
 import os
+import shutil
+import stat
+import tarfile
+import time
+import uuid
+import zipfile
+
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+# Linux ioctl request to clone the contents of a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# Size of each read when hashing file contents
+HASH_BUFFER_SIZE = 1 << 20  # 1 Mb
 
 
 def split_check_path(filepath):
@@ -7,6 +37,242 @@ def split_check_path(filepath):
     return os.path.split(filepath)
 
 
+def transfer_file(source, target, *, move=False):
+    """ Make the contents of a file available on another path, avoiding copies
+
+    The following strategies are tried in order, from the cheapest to the most
+    expensive one:
+
+    1. A hard link, when both paths are on the same filesystem.
+    2. A reflink, a copy-on-write clone of the file contents, when the
+       filesystem supports it (like btrfs or xfs).
+    3. A rename of the source file, only when `move` is set, which means that
+       the source file is no longer needed.
+    4. A copy of the file contents.
+
+    The target file is replaced atomically if it already exists.
+
+    Parameters
+    ----------
+    source: str or pathlib.Path
+        Path of the file to transfer.
+    target: str or pathlib.Path
+        Path where the file contents should be available.
+    move: bool
+        Whether the source file can be renamed.
+
+    Returns
+    -------
+    str
+        Name of the strategy used: ``'link'``, ``'reflink'``, ``'rename'`` or
+        ``'copy'``.
+
+    """
+    source, target = os.fspath(source), os.fspath(target)
+    tmp_target = os.path.join(os.path.dirname(target),
+                              f'.{os.path.basename(target)}.{uuid.uuid4().hex}')
+
+    try:
+        os.link(source, tmp_target)
+        os.replace(tmp_target, target)
+        return 'link'
+    except OSError as ex:
+        logger.debug('Could not link %s: %s', source, ex)
+
+    try:
+        _reflink(source, tmp_target)
+        os.replace(tmp_target, target)
+        return 'reflink'
+    except OSError as ex:
+        logger.debug('Could not reflink %s: %s', source, ex)
+        _remove_if_exists(tmp_target)
+
+    if move:
+        try:
+            os.replace(source, target)
+            return 'rename'
+        except OSError as ex:
+            logger.debug('Could not rename %s: %s', source, ex)
+
+    try:
+        shutil.copy(source, tmp_target)
+        os.replace(tmp_target, target)
+    except:
+        _remove_if_exists(tmp_target)
+        raise
+    return 'copy'
+
+
+def _reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _remove_if_exists(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def iter_archive(file_obj):
+    """ Iterate over the regular files of a tar or zip archive
+
+    Directories, links and any other special entries of the archive are
+    ignored. Compressed tar archives (gzip, bz2 and lzma) are supported.
+
+    Parameters
+    ----------
+    file_obj: file-like
+        File object of the archive. It needs the `read`, `seek` and `tell`
+        methods.
+
+    Returns
+    -------
+    iterator
+        Iterator of ``(name, entry)`` tuples, where `name` is the name of the
+        archive entry, including its path, and `entry` is a file object with
+        its contents. Each file object is only valid until the next iteration.
+
+    Raises
+    ------
+    ValueError
+        When the file object is not a tar or zip archive.
+
+    """
+    position = file_obj.tell()
+    if zipfile.is_zipfile(file_obj):
+        file_obj.seek(position)
+        return _iter_zip(zipfile.ZipFile(file_obj))
+
+    file_obj.seek(position)
+    try:
+        archive = tarfile.open(fileobj=file_obj, mode='r:*')
+    except tarfile.TarError as ex:
+        raise ValueError('File is not a tar or zip archive') from ex
+    return _iter_tar(archive)
+
+
+def _iter_zip(archive):
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as entry:
+                yield info.filename, entry
+
+
+def _iter_tar(archive):
+    with archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            yield member.name, archive.extractfile(member)
+
+
+def stream_archive(entries, archive_format='tar', *, chunk_size=HASH_BUFFER_SIZE):
+    """ Generate a tar or zip archive by chunks
+
+    The archive is never kept in memory nor in a temporary file: each file
+    is read by chunks of `chunk_size` bytes, and the archive bytes are
+    generated as soon as a chunk is added. Zip archives are written with
+    data descriptors and without compression, since their entries cannot
+    be rewritten once they have been sent.
+
+    Parameters
+    ----------
+    entries: iterable
+        Iterable of ``(name, size, file_obj)`` tuples, where `name` is the
+        name of the archive entry, including its path, `size` the number of
+        bytes of the file and `file_obj` a file object with its contents.
+        Each file object is closed once it has been added.
+    archive_format: {'tar', 'zip'}
+        Format of the archive.
+    chunk_size: int
+        Size of each read of the file contents.
+
+    Returns
+    -------
+    iterator
+        Iterator of the archive contents, as non-empty bytes objects.
+
+    Raises
+    ------
+    IOError
+        When the contents of a file do not have the announced size.
+
+    """
+    if archive_format == 'tar':
+        chunks = _stream_tar(entries, chunk_size)
+    elif archive_format == 'zip':
+        chunks = _stream_zip(entries, chunk_size)
+    else:
+        raise ValueError(f'Unknown archive format {archive_format}')
+    return (chunk for chunk in chunks if chunk)
+
+
+def _stream_tar(entries, chunk_size):
+    # The tar format is simple enough to be written by hand: the tarfile
+    # module copies each file completely before giving back control
+    for name, size, file_obj in entries:
+        with file_obj:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            remaining = size
+            while remaining > 0:
+                chunk = file_obj.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f'Contents of {name} are shorter than {size} bytes')
+                remaining -= len(chunk)
+                yield chunk
+            if file_obj.read(1):
+                raise IOError(f'Contents of {name} are longer than {size} bytes')
+            yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+    # End of archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def _stream_zip(entries, chunk_size):
+    buffer = _WriteBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for name, size, file_obj in entries:
+            with file_obj:
+                info = zipfile.ZipInfo(name, date_time=time.gmtime()[:6])
+                info.file_size = size
+                info.external_attr = 0o644 << 16
+                with archive.open(info, mode='w') as entry:
+                    for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+                        entry.write(chunk)
+                        yield buffer.drain()
+                if info.file_size != size:
+                    raise IOError(f'Contents of {name} do not have {size} bytes')
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+class _WriteBuffer(io.RawIOBase):
+    """ Unseekable file object that keeps written bytes until they are drained """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
 def get_readable_info(file_obj):
     """ Extract useful information from reading a file
 
@@ -32,10 +298,386 @@ def get_readable_info(file_obj):
     position = file_obj.tell()
     hashobj = hashlib.new('md5')
     while True:
-        chunk = file_obj.read(4096)
+        chunk = file_obj.read(HASH_BUFFER_SIZE)
         size += len(chunk)
         if not chunk:
             break
         hashobj.update(chunk)
     file_obj.seek(position)
     return hashobj.hexdigest(), size
+
+
+class Crc32cHash:
+    """ Hash object, like the ones of :py:mod:`hashlib`, for CRC32C checksums
+
+    CRC32C is the checksum that GCP computes on its objects, so it can be
+    compared to the ``crc32c`` property of a blob without downloading it.
+    GCP encodes it in base64, while :py:meth:`hexdigest` uses hexadecimal like
+    the rest of the digests. This needs the optional ``crcmod`` package.
+
+    """
+
+    name = 'crc32c'
+
+    def __init__(self):
+        if crcmod is None:
+            raise ValueError('CRC32C digests need the crcmod package')
+        self._crc = crcmod.predefined.Crc('crc-32c')
+
+    def update(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self._crc.update(data)
+
+    def hexdigest(self):
+        return self._crc.hexdigest().lower()
+
+
+def new_hash(name):
+    """ Create a hash object of a digest algorithm by its name
+
+    Besides the algorithms of :py:mod:`hashlib`, this supports ``crc32c``.
+    """
+    if name == Crc32cHash.name:
+        return Crc32cHash()
+    return hashlib.new(name)
+
+
+def available_digests(names):
+    """ Filter the digest names that can be computed in this environment """
+    available = []
+    for name in names:
+        if name == Crc32cHash.name and crcmod is None:
+            logger.warning('Digest %s is not available: crcmod is not installed', name)
+            continue
+        available.append(name)
+    return available
+
+
+class MultiHash:
+    """ Compute several digests of the same contents in a single pass
+
+    Parameters
+    ----------
+    names: iterable
+        Names of the digest algorithms. See :py:func:`new_hash`.
+
+    """
+
+    def __init__(self, names=('md5',)):
+        self._hashes = {name: new_hash(name) for name in names}
+
+    def update(self, data):
+        for hashobj in self._hashes.values():
+            hashobj.update(data)
+
+    def hexdigest(self, name='md5'):
+        return self._hashes[name].hexdigest()
+
+    def hexdigests(self):
+        return {name: hashobj.hexdigest() for name, hashobj in self._hashes.items()}
+
+
+def compute_digests(file_obj, names):
+    """ Compute several digests and the size of a file in a single pass
+
+    When the file object is a regular file, its contents, from the current
+    position, are mapped in memory and each digest is computed on its own
+    thread. The :py:mod:`hashlib` functions release the GIL on large buffers,
+    so the digests are computed in parallel. Other file objects are read
+    sequentially with large buffers.
+
+    The file pointer is not restored: use this function on files that are
+    opened for this purpose, not on the contents of a request.
+
+    Parameters
+    ----------
+    file_obj: file-like
+        File object. It needs the `read` method.
+    names: iterable
+        Names of the digest algorithms. See :py:func:`new_hash`.
+
+    Returns
+    -------
+    digests, size: dict, int
+        Hexadecimal digests, indexed by their name, and size of the contents.
+
+    """
+    hashes = {name: new_hash(name) for name in names}
+    try:
+        fd = file_obj.fileno()
+        position = file_obj.tell()
+        info = os.fstat(fd)
+        mappable = stat.S_ISREG(info.st_mode) and info.st_size > position
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        mappable = False
+
+    if not mappable or not hashes:
+        size = 0
+        while True:
+            chunk = file_obj.read(HASH_BUFFER_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            for hashobj in hashes.values():
+                hashobj.update(chunk)
+        return {name: hashobj.hexdigest() for name, hashobj in hashes.items()}, size
+
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped) as contents, contents[position:] as view:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(hashes)) as executor:
+            futures = [executor.submit(_update_by_chunks, hashobj, view)
+                       for hashobj in hashes.values()]
+            for future in futures:
+                future.result()
+        size = len(view)
+    file_obj.seek(position + size)
+    return {name: hashobj.hexdigest() for name, hashobj in hashes.items()}, size
+
+
+def _update_by_chunks(hashobj, view):
+    for i in range(0, len(view), HASH_BUFFER_SIZE):
+        hashobj.update(view[i:i + HASH_BUFFER_SIZE])
+
+
+class HashingReader(io.RawIOBase):
+    """ File-like wrapper that computes the md5sum and size while reading
+
+    Use this object to pass a file to a consumer (such as a storage backend)
+    and obtain its md5sum and size from the same read operations, so that the
+    contents are read only once.
+
+    Consumers may seek backwards and read again (for example, on a retry of a
+    chunked upload); bytes that have already been hashed are not hashed twice.
+    When the consumer did not read the whole contents, :py:meth:`finish` reads
+    the remaining bytes so that the md5sum and size are always complete.
+
+    Any attribute that is not defined here, such as ``filename``, is obtained
+    from the wrapped object.
+
+    Parameters
+    ----------
+    file_obj: file-like
+        File object. It needs the `read`, `seek` and `tell` methods.
+    digests: iterable
+        Names of other digests to compute besides the md5sum. They are
+        obtained with :py:meth:`digests`.
+
+    """
+
+    def __init__(self, file_obj, digests=()):
+        super().__init__()
+        self._file_obj = file_obj
+        self._digests = tuple(digests)
+        self._hashobj = MultiHash(('md5',) + self._digests)
+        self._position = file_obj.tell()
+        self._start = self._position
+        self._hashed_until = self._position
+        self._eof = False
+
+    def __getattr__(self, name):
+        return getattr(self._file_obj, name)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        chunk = self._file_obj.read(size)
+        if not chunk:
+            # End of file: all contents were hashed unless some were skipped
+            self._eof = (self._position == self._hashed_until)
+            return chunk
+        end = self._position + len(chunk)
+        if end > self._hashed_until:
+            if self._position > self._hashed_until:
+                # A forward seek skipped some bytes: the next call to finish
+                # will need to read them
+                self._position += len(chunk)
+                return chunk
+            self._hashobj.update(chunk[self._hashed_until - self._position:])
+            self._hashed_until = end
+        self._position = end
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._position = self._file_obj.seek(offset, whence)
+        if self._position is None:
+            # Some file-like objects do not return the new position
+            self._position = self._file_obj.tell()
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def finish(self):
+        """ Read any bytes not consumed yet so that the md5sum is complete
+
+        The file pointer is restored to its position before this call.
+
+        Returns
+        -------
+        md5sum, size: str, int
+            MD5 sum and size of the file object contents
+
+        """
+        if not self._eof:
+            position = self._position
+            self.seek(self._hashed_until)
+            while self.read(1 << 20):
+                pass
+            self.seek(position)
+        return self.hexdigest(), self.size
+
+    def hexdigest(self):
+        return self._hashobj.hexdigest()
+
+    def digests(self):
+        """ Get the other digests, in hexadecimal, indexed by their name """
+        return {name: self._hashobj.hexdigest(name) for name in self._digests}
+
+    @property
+    def size(self):
+        return self._hashed_until - self._start
+
+
+class HashingWriter:
+    """ Minimal writable file-like object that computes the md5sum and size
+
+    Use this object as the target of an operation that writes to a file, such
+    as a download, when only the md5sum and size of the contents are needed.
+    Contents are not kept.
+
+    Parameters
+    ----------
+    digests: iterable
+        Names of other digests to compute besides the md5sum. They are
+        obtained with :py:meth:`digests`.
+
+    """
+
+    def __init__(self, digests=()):
+        self._digests = tuple(digests)
+        self._hashobj = MultiHash(('md5',) + self._digests)
+        self.size = 0
+
+    def write(self, data):
+        self._hashobj.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        return self._hashobj.hexdigest()
+
+    def digests(self):
+        """ Get the other digests, in hexadecimal, indexed by their name """
+        return {name: self._hashobj.hexdigest(name) for name in self._digests}
+
+
+def codec_available(codec):
+    """ Verify that a storage codec is known and can be used here """
+    if codec == 'zstd':
+        return zstandard is not None
+    return False
+
+
+class EncodingReader(io.RawIOBase):
+    """ Read-only file object with the encoded contents of another one
+
+    Contents are encoded progressively while they are read, so they are
+    never completely in memory. The encoded contents can only be read
+    sequentially: seeking is limited to the current position, which is
+    enough for consumers that rewind the file before reading it.
+
+    Parameters
+    ----------
+    file_obj: file-like
+        File object with the contents to encode. It needs the `read` method.
+    codec: str
+        Name of the codec. Only ``zstd`` is supported.
+    level: int
+        Compression level.
+
+    """
+
+    def __init__(self, file_obj, codec, level=3):
+        super().__init__()
+        if not codec_available(codec):
+            raise ValueError(f'Codec {codec} is not available')
+        compressor = zstandard.ZstdCompressor(level=level)
+        self._reader = compressor.stream_reader(file_obj)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Encoded contents cannot be seeked from their end')
+        if offset != self._position:
+            raise io.UnsupportedOperation('Encoded contents can only be read sequentially')
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def decode_stream(file_obj, codec):
+    """ Get a file object that decodes the contents of another one
+
+    Parameters
+    ----------
+    file_obj: file-like
+        File object with the encoded contents. It needs the `read` method.
+    codec: str
+        Name of the codec. Only ``zstd`` is supported.
+
+    Returns
+    -------
+    file-like
+        A readable file object with the decoded contents. Closing it closes
+        `file_obj` too.
+
+    """
+    if not codec_available(codec):
+        raise ValueError(f'Codec {codec} is not available')
+    return _DecodingReader(file_obj, zstandard.ZstdDecompressor().stream_reader(file_obj))
+
+
+class _DecodingReader(io.RawIOBase):
+
+    def __init__(self, file_obj, reader):
+        super().__init__()
+        self._file_obj = file_obj
+        self._reader = reader
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file_obj.close()
+        super().close()
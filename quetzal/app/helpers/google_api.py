@@ -1,29 +1,75 @@
+import io
+import itertools
 import logging
+import os
+import threading
+import time
+import weakref
 from urllib.parse import urlparse
 
+from google.api_core.exceptions import NotFound, RequestRangeNotSatisfiable
 from google.cloud import storage
-from flask import current_app, g
+from flask import current_app
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of calls in a single batch request, set by GCP
+MAX_BATCH_SIZE = 100
+
+# Process-wide pool of clients, one per thread and credentials file
+_clients = threading.local()
+
+# Bucket objects of each client, by name, with their expiration time
+_buckets = weakref.WeakKeyDictionary()
+_buckets_lock = threading.Lock()
+
 
 def get_client():
-    """Create a GCP client built from the app configuration
+    """Get a GCP client built from the app configuration
+
+    Clients are kept in a process-wide pool and reused by all future calls,
+    so that their authorized session and its connections are not created
+    again on each request or task. There is one client per thread, because
+    the current batch of a client is saved on the client itself. The pool is
+    emptied on a fork, since the connections of the parent process cannot
+    be shared with its children.
+    """
+    filename = current_app.config['QUETZAL_GCP_CREDENTIALS']
+    pool = _client_pool()
+    client = pool.get(filename)
+    if client is None:
+        client = storage.Client.from_service_account_json(filename)
+        pool[filename] = client
+    return client
 
-    The client is saved in the currrent application context and will be reused
-    in any future call on this context.
+
+def _client_pool():
+    if getattr(_clients, 'pid', None) != os.getpid():
+        _clients.pid = os.getpid()
+        _clients.pool = {}
+    return _clients.pool
+
+
+def clone_client(client):
+    """Create a new GCP client with the same project and credentials
+
+    The current batch of a client is saved on the client itself, so a client
+    cannot be used by several threads when any of them uses a batch. Use this
+    function to get a client for each thread.
     """
-    # Get a client and save it in the context so it can be reused
-    if 'google_client' not in g:
-        filename = current_app.config['QUETZAL_GCP_CREDENTIALS']
-        g.google_client = storage.Client.from_service_account_json(filename)
-    return g.google_client
+    return storage.Client(project=client.project, credentials=client._credentials)
 
 
 def get_bucket(url, *, client=None):
     """ Get a GCP bucket object from an URL
 
+    The bucket object is created without any request to GCP, so its
+    properties are not loaded and the bucket existence is not verified:
+    any error is reported by the first request that uses it. Bucket objects
+    are cached for each client during ``QUETZAL_GCP_BUCKET_CACHE_TTL``
+    seconds.
+
     Parameters
     ----------
     url: str
@@ -41,15 +87,157 @@ def get_bucket(url, *, client=None):
     if client is None:
         client = get_client()
     bucket_name = urlparse(url).netloc
-    return client.get_bucket(bucket_name)
+    ttl = current_app.config['QUETZAL_GCP_BUCKET_CACHE_TTL']
+    now = time.monotonic()
+    with _buckets_lock:
+        buckets = _buckets.setdefault(client, {})
+        expiration, bucket = buckets.get(bucket_name, (now, None))
+        if expiration <= now:
+            bucket = client.bucket(bucket_name)
+            buckets[bucket_name] = (now + ttl, bucket)
+    return bucket
+
+
+def split_location(url):
+    """ Get the bucket name and the object name prefix of a location
+
+    A location, such as the data URL of a workspace, is either a complete
+    bucket, ``gs://bucket``, or a prefix of a bucket shared with other
+    locations, ``gs://bucket/some/prefix``.
+
+    Parameters
+    ----------
+    url: str
+        URL of the location.
+
+    Returns
+    -------
+    bucket_name, prefix: str, str
+        Name of the bucket and prefix of the names of the objects of the
+        location. The prefix ends with a slash, or is empty when the location
+        is a complete bucket.
+
+    """
+    url_parsed = urlparse(url)
+    path = url_parsed.path.strip('/')
+    return url_parsed.netloc, f'{path}/' if path else ''
 
 
 def get_object(url, *, client=None):
-    if client is None:
-        client = get_client()
+    """ Get a GCP blob object from an URL
+
+    Like :py:func:`get_bucket`, no request is sent to GCP: the blob
+    properties, such as its size, are not loaded. Use
+    :py:meth:`google.storage.blob.Blob.reload` when they are needed.
+
+    Parameters
+    ----------
+    url: str
+        URL of the object.
+    client: google.storage.client.Client, optional
+        GCP client instance to use. If not set it uses :py:func:`get_client`.
+
+    Returns
+    -------
+    blob: google.storage.blob.Blob
+        A blob instance
+
+    """
     blob_name = urlparse(url).path.lstrip('/')
     bucket = get_bucket(url, client=client)
-    return bucket.get_blob(blob_name, client=client)
+    return bucket.blob(blob_name)
+
+
+def get_signed_url(url, expiration, *, client=None):
+    """ Get a V4 signed URL to download an object without credentials
+
+    The signature is computed locally with the client credentials, which must
+    be service account credentials. No request is sent to GCP.
+
+    Parameters
+    ----------
+    url: str
+        URL of the object.
+    expiration: datetime.timedelta
+        Time during which the signed URL is valid.
+    client: google.storage.client.Client, optional
+        GCP client instance to use. If not set it uses :py:func:`get_client`.
+
+    Returns
+    -------
+    signed_url: str
+        The signed URL.
+
+    """
+    blob = get_object(url, client=client)
+    return blob.generate_signed_url(expiration=expiration, method='GET', version='v4')
+
+
+def grant_owner(blob, email, *, client=None):
+    """ Add a user as an owner of an object
+
+    The owner entry is inserted with a single request, without reading and
+    saving the complete access control list of the object. This makes it
+    possible to use it inside a batch request.
+
+    Parameters
+    ----------
+    blob: google.storage.blob.Blob
+        The object.
+    email: str
+        Email of the user that will own the object.
+    client: google.storage.client.Client, optional
+        GCP client instance to use. If not set it uses :py:func:`get_client`.
+
+    """
+    if client is None:
+        client = get_client()
+    # https://cloud.google.com/storage/docs/json_api/v1/objectAccessControls/insert
+    _api_request(client, method='POST', path=f'{blob.path}/acl',
+                 data={'entity': f'user-{email}', 'role': 'OWNER'})
+
+
+def _api_request(client, **kwargs):
+    """ Send a JSON API request with the connection of a client
+
+    The ACL objects of google-cloud-storage only reload and save the complete
+    access control list, which needs a read request before the write and
+    cannot be done inside a batch. Single ACL entries are inserted with the
+    connection of the client instead: it is private, so google-cloud-storage
+    is pinned to the 1.x versions, where it has not changed.
+    """
+    return client._connection.api_request(**kwargs)
+
+
+def delete_blobs(blobs, *, client=None, ignore_missing=False):
+    """ Delete objects with batch requests
+
+    Parameters
+    ----------
+    blobs: iterable
+        Objects to delete, as :py:class:`google.storage.blob.Blob` instances.
+        It is consumed progressively, so it can be a listing of many objects.
+    client: google.storage.client.Client, optional
+        GCP client instance to use. If not set it uses :py:func:`get_client`.
+    ignore_missing: bool
+        Whether objects that do not exist are ignored. The other deletions
+        of a batch are still sent when one of its objects does not exist.
+
+    """
+    if client is None:
+        client = get_client()
+    blobs = iter(blobs)
+    while True:
+        group = list(itertools.islice(blobs, MAX_BATCH_SIZE))
+        if not group:
+            break
+        try:
+            with client.batch():
+                for blob in group:
+                    blob.delete(client=client)
+        except NotFound:
+            if not ignore_missing:
+                raise
 
 
 def get_data_bucket(*, client=None):
@@ -70,3 +258,101 @@ def get_data_bucket(*, client=None):
     return get_bucket(data_bucket_url, client=client)
 
 
+class BlobReader(io.RawIOBase):
+    """ Read-only file object that downloads a GCP blob by chunks
+
+    Each chunk is downloaded with a ranged request, and only the current chunk
+    is kept in memory. The chunk size starts small, so that the first bytes
+    are available quickly, and doubles on each request up to a maximum.
+
+    When the blob is read with more than one request, its properties are
+    loaded before the first one, so that all the chunks are downloaded from
+    the same generation of the blob. A blob that is replaced while it is
+    read fails with a not found error instead of mixing both versions.
+
+    Parameters
+    ----------
+    blob: google.storage.blob.Blob
+        The blob to read.
+    start: int, optional
+        Position of the first byte to read. By default, the beginning of
+        the blob.
+    stop: int, optional
+        Position after the last byte to read. By default, the end of the blob.
+    client: google.storage.client.Client, optional
+        GCP client instance to use. If not set it uses the blob client.
+    min_chunk_size: int
+        Size of the first chunk, in bytes.
+    max_chunk_size: int
+        Maximum size of a chunk, in bytes.
+
+    """
+
+    def __init__(self, blob, start=None, stop=None, *, client=None,
+                 min_chunk_size=1 << 20, max_chunk_size=8 << 20):
+        super().__init__()
+        self._blob = blob
+        self._client = client
+        self._position = start or 0
+        self._stop = stop if stop is not None else blob.size
+        self._chunk = memoryview(b'')
+        self._chunk_offset = 0
+        self._chunk_size = min_chunk_size
+        self._max_chunk_size = max_chunk_size
+        self._eof = False
+        self._pinned = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._chunk_offset >= len(self._chunk):
+            if self._eof:
+                return 0
+            self._fetch()
+        n = min(len(buffer), len(self._chunk) - self._chunk_offset)
+        buffer[:n] = self._chunk[self._chunk_offset:self._chunk_offset + n]
+        self._chunk_offset += n
+        return n
+
+    def prefetch(self):
+        """ Download the next chunk if there is no data left on the current one """
+        if self._chunk_offset >= len(self._chunk) and not self._eof:
+            self._fetch()
+
+    def _fetch(self):
+        if not self._pinned:
+            self._pin()
+        end = self._position + self._chunk_size
+        if self._stop is not None:
+            end = min(end, self._stop)
+        if end <= self._position:
+            chunk = b''
+        else:
+            try:
+                # The end position of a blob download is inclusive
+                chunk = self._blob.download_as_string(client=self._client,
+                                                      start=self._position,
+                                                      end=end - 1)
+            except RequestRangeNotSatisfiable:
+                # Only possible when the blob size is unknown, and the
+                # previous chunk ended exactly on the end of the blob
+                chunk = b''
+
+        # A chunk shorter than requested means that the end has been reached
+        self._eof = len(chunk) < end - self._position
+        self._chunk = memoryview(chunk)
+        self._chunk_offset = 0
+        self._position += len(chunk)
+        self._chunk_size = min(2 * self._chunk_size, self._max_chunk_size)
+
+    def _pin(self):
+        self._pinned = True
+        if self._stop is not None and self._stop - self._position <= self._chunk_size:
+            # A single request is enough
+            return
+        # The media link of the loaded properties includes the generation,
+        # which is then used by the ranged downloads
+        self._blob.reload(client=self._client)
+        if self._stop is None:
+            self._stop = self._blob.size
@@ -6,8 +6,10 @@ import os
 
 from flask_login import UserMixin
 from requests import codes
+from sqlalchemy import DDL, event, union_all
 from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy.sql import func
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import and_, exists, func, text, tuple_
 from sqlalchemy.schema import Index, UniqueConstraint, CheckConstraint
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -103,6 +105,8 @@ class User(UserMixin, db.Model):
         Set of :py:class:`Workspaces <Workspace>` owned by this user.
     queries
         Set of :py:class:`Queries <Query>` created by this user.
+    uploads
+        Set of :py:class:`Upload sessions <UploadSession>` started by this user.
 
     """
 
@@ -118,6 +122,7 @@ class User(UserMixin, db.Model):
                             backref=db.backref('users', lazy='dynamic'))
     workspaces = db.relationship('Workspace', backref='owner', lazy='dynamic')
     queries = db.relationship('MetadataQuery', backref='owner', lazy='dynamic')
+    uploads = db.relationship('UploadSession', backref='owner', lazy='dynamic')
 
     @property
     def is_active(self):
@@ -313,6 +318,15 @@ class BaseMetadataKeys(enum.Enum):
     CHECKSUM = 'checksum'
     """MD5 checksum of the file"""
 
+    SHA256 = 'sha256'
+    """SHA-256 digest of the file, when configured"""
+
+    CRC32C = 'crc32c'
+    """CRC32C checksum of the file, when configured"""
+
+    CODEC = 'codec'
+    """Codec of the stored file contents, only when they are encoded"""
+
     DATE = 'date'
     """Date when this file was created."""
 
@@ -483,6 +497,9 @@ class Workspace(db.Model):
         this workspace.
     queries
         Set of :py:class:`Queries <Query>` created on this workspace.
+    uploads
+        Set of :py:class:`Upload sessions <UploadSession>` of files being
+        uploaded to this workspace.
 
     """
 
@@ -507,6 +524,7 @@ class Workspace(db.Model):
 
     families = db.relationship('Family', backref='workspace', lazy='dynamic')
     queries = db.relationship('MetadataQuery', backref='workspace', lazy='dynamic')
+    uploads = db.relationship('UploadSession', backref='workspace', lazy='dynamic')
 
     @property
     def state(self):
@@ -598,25 +616,90 @@ class Workspace(db.Model):
         )
         return workspace_meta
 
-    def get_metadata(self):
-        """Get a union of the previous and new metadata of this workspace
+    def get_metadata(self, file_ids=None):
+        """Get the latest metadata of each file and family of this workspace
+
+        This is the merged version of :py:meth:`get_previous_metadata` and
+        :py:meth:`get_current_metadata`: the metadata changed on this
+        workspace, or otherwise the latest global metadata until the
+        reference of this workspace. This represents the definitive metadata
+        of each file, regardless of changes before or after the creation of
+        this workspace.
+
+        The entries are found with the :py:class:`MetadataHead` table, so the
+        cost of this query depends on the number of files, not on the number
+        of metadata versions. Only the files whose global metadata changed
+        after the workspace reference need to look into their previous
+        versions.
 
-        This function uses a combination of the results of
-        :py:meth:`get_previous_metadata` and :py:meth:`get_current_metadata`
-        to obtain the merged version of both. This represents the definitive
-        metadata of each file, regardless of changes before or after the
-        creation of this workspace.
+        Parameters
+        ----------
+        file_ids: list, optional
+            Identifiers of the files. When not set, all files are included.
+            Setting them here rather than filtering the result lets the
+            query look up the entries of these files only.
 
         """
         # Important note: this one does not have repeated entries!
-        merged_metadata = (
-            self.get_previous_metadata()
-            .union(
-                self.get_current_metadata()
-            )
-            .join(Family)  # Need to join again with family to use it in the distinct
+        reference = self.fk_last_metadata_id or 0
+        # Handy trick to add an inline filter only when file_ids is set
+        file_filter = MetadataHead.id_file.in_(file_ids) if file_ids is not None else True
+        family_names = (
+            db.session.query(Family.name)
+            .filter(Family.fk_workspace_id == self.id)
+        )
+
+        # Metadata changed on this workspace
+        current_ids = (
+            db.session.query(MetadataHead.fk_metadata_id.label('id'))
+            .filter(MetadataHead.fk_workspace_id == self.id, file_filter)
+        )
+
+        # Global metadata that was not changed on this workspace
+        workspace_head = aliased(MetadataHead)
+        global_heads = (
+            db.session.query(MetadataHead)
+            .filter(MetadataHead.fk_workspace_id.is_(None),
+                    MetadataHead.family_name.in_(family_names),
+                    file_filter,
+                    ~exists().where(and_(workspace_head.fk_workspace_id == self.id,
+                                         workspace_head.id_file == MetadataHead.id_file,
+                                         workspace_head.family_name == MetadataHead.family_name)))
+        )
+        previous_ids = (
+            global_heads
+            .filter(MetadataHead.fk_metadata_id <= reference)
+            .with_entities(MetadataHead.fk_metadata_id.label('id'))
+        )
+
+        # Global metadata changed after the reference: use the latest version
+        # until the reference, if there is one
+        changed_heads = (
+            global_heads
+            .filter(MetadataHead.fk_metadata_id > reference)
+            .with_entities(MetadataHead.id_file, MetadataHead.family_name)
+        )
+        changed_previous = (
+            db.session.query(Metadata.id)
+            .join(Family, Family.id == Metadata.fk_family_id)
+            .filter(Family.fk_workspace_id.is_(None),
+                    Metadata.id <= reference,
+                    tuple_(Metadata.id_file, Family.name).in_(changed_heads))
             .distinct(Metadata.id_file, Family.name)
             .order_by(Metadata.id_file, Family.name, Metadata.id.desc())
+            .subquery()
+        )
+        changed_ids = db.session.query(changed_previous.c.id)
+
+        latest_ids = union_all(current_ids.statement,
+                               previous_ids.statement,
+                               changed_ids.statement).alias('latest_ids')
+        merged_metadata = (
+            Metadata
+            .query
+            .join(latest_ids, latest_ids.c.id == Metadata.id)
+            .join(Family, Family.id == Metadata.fk_family_id)
+            .order_by(Metadata.id_file, Family.name)
         )
         return merged_metadata
 
@@ -691,11 +774,14 @@ class Family(db.Model):
         UniqueConstraint('name', 'fk_workspace_id'),
         # Do not allow the version and workspace to be simultaneously null
         CheckConstraint('version IS NOT NULL OR fk_workspace_id IS NOT NULL',
-                        name='simul_null_check')
+                        name='simul_null_check'),
+        # Lookup of the families by name and workspace, sorted by version;
+        # it also serves the lookups by name only
+        Index('ix_family_name_workspace_version', 'name', 'fk_workspace_id', 'version'),
     )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(60), index=True, nullable=False)  # 63 due to postgres limit, -3 for internal suffixes
+    name = db.Column(db.String(60), nullable=False)  # 63 due to postgres limit, -3 for internal suffixes
     version = db.Column(db.Integer)  # Can be temporary nullable during workspace creation
     description = db.Column(db.Text)
 
@@ -746,12 +832,27 @@ class Metadata(db.Model):
     __table_args__ = (
         # Do not allow metadata without an "id" entry
         CheckConstraint("json ? 'id'", name='check_id'),
+        # Lookup of the metadata that references a stored file
+        Index('ix_metadata_json_url', text("(json ->> 'url')")),
+        # Versions of a file, latest first; it also serves the lookups by file
+        Index('ix_metadata_id_file_id', 'id_file', text('id DESC')),
+        # Metadata of a family, by file or by file state
+        Index('ix_metadata_family_file', 'fk_family_id', 'id_file'),
+        Index('ix_metadata_family_state', 'fk_family_id', text("(json ->> 'state')")),
+        # Listing filters: containment of the keys and values of any family,
+        # and prefixes and ranges of the most common base metadata keys
+        Index('ix_metadata_json', 'json', postgresql_using='gin',
+              postgresql_ops={'json': 'jsonb_path_ops'}),
+        Index('ix_metadata_json_filename', text("(json ->> 'filename') text_pattern_ops")),
+        Index('ix_metadata_json_path', text("(json ->> 'path') text_pattern_ops")),
+        Index('ix_metadata_json_size', text("(json -> 'size')")),
+        Index('ix_metadata_json_date', text("(json -> 'date')")),
         # TODO: add constraint check file_id == json->'id' ?
         # TODO: add index on id? Would it be useful? For jsonb indices, see https://stackoverflow.com/a/17808864/227103
     )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    id_file = db.Column(UUID(as_uuid=True), index=True, nullable=False)
+    id_file = db.Column(UUID(as_uuid=True), nullable=False)
     json = db.Column(JSONB, nullable=False)
 
     fk_family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False)
@@ -856,7 +957,24 @@ class Metadata(db.Model):
 
     @staticmethod
     def get_latest_global(file_id=None, family_name=None):
-        """Retrieve the latest metadata of a file under a particular family
+        """Retrieve the latest committed metadata of files by family
+
+        The entries are found with the global entries of the
+        :py:class:`MetadataHead` table, so the cost of this query depends on
+        the number of files, not on the number of metadata versions.
+
+        Parameters
+        ----------
+        file_id: :py:class:`uuid.UUID`, optional
+            Identifier of the file. When not set, all files are included.
+        family_name: str, optional
+            Name of the family. When not set, all families are included.
+
+        Returns
+        -------
+        queryset
+            Query of the :py:class:`Metadata` entries, joined with their
+            family.
 
         Todo
         ----
@@ -865,36 +983,164 @@ class Metadata(db.Model):
         :py:func:`Workspace.get_current_metadata`, and
         :py:func:`Workspace.get_metadata`.
         """
-        # Get the families with null workspace (these are the committed families).
-        # From these, get the max version of each family.
-        # Finally, what we want is the associated metadata so we need to join
-        # with the Metadata
-        if file_id is not None:
-            queryset = (
-                Metadata
-                .query
-                .join(Family)
-                .filter(Metadata.id_file == file_id,
-                        Family.fk_workspace_id.is_(None),
-                        # Handy trick to add an inline filter only when family_name is set
-                        Family.name == family_name if family_name is not None else True)
-                .distinct(Family.name)
-                .order_by(Family.name, Family.version.desc())
-            )
-        else:
-            queryset = (
-                Metadata
-                .query
-                .join(Family)
-                .filter(Family.fk_workspace_id.is_(None),
-                        # Handy trick to add an inline filter only when family_name is set
-                        Family.name == family_name if family_name is not None else True)
-                .distinct(Metadata.id_file, Family.name)
-                .order_by(Metadata.id_file, Family.name, Family.version.desc())
-            )
+        queryset = (
+            Metadata
+            .query
+            .join(MetadataHead, MetadataHead.fk_metadata_id == Metadata.id)
+            .join(Family, Family.id == Metadata.fk_family_id)
+            .filter(MetadataHead.fk_workspace_id.is_(None),
+                    # Handy trick to add an inline filter only when file_id is set
+                    MetadataHead.id_file == file_id if file_id is not None else True,
+                    # Handy trick to add an inline filter only when family_name is set
+                    MetadataHead.family_name == family_name if family_name is not None else True)
+            .order_by(MetadataHead.id_file, MetadataHead.family_name)
+        )
         return queryset
 
 
+class MetadataHead(db.Model):
+    """ Latest metadata entry of a file for a family name
+
+    The metadata table keeps all the versions of the metadata of each file.
+    This table keeps a reference to the latest one, by file and family name,
+    so that the current metadata can be obtained without going through all
+    previous versions. There is a *global* entry, for the committed metadata,
+    and one entry for each workspace that changed the metadata.
+
+    The entries are maintained by database triggers on the metadata and
+    family tables, in the same transaction as the changes: when metadata is
+    added, when it changes family and when a family is committed.
+
+    Attributes
+    ----------
+    id: int
+        Identifier and primary key of an entry.
+    id_file: :py:class:`uuid.UUID`
+        Identifier of the file.
+    family_name: str
+        Name of the family.
+    fk_workspace_id: int
+        Reference to the workspace of the metadata, or ``None`` for the
+        committed metadata.
+    fk_metadata_id: int
+        Reference to the latest :py:class:`Metadata` entry.
+
+    """
+
+    __table_args__ = (
+        # There can only be one entry by file and family, globally or by workspace
+        Index('uq_metadata_head_global', 'id_file', 'family_name', unique=True,
+              postgresql_where=text('fk_workspace_id IS NULL')),
+        Index('uq_metadata_head_workspace', 'fk_workspace_id', 'id_file', 'family_name', unique=True,
+              postgresql_where=text('fk_workspace_id IS NOT NULL')),
+        # Listing of the committed files of a family, sorted by file
+        Index('ix_metadata_head_global_family', 'family_name', 'id_file',
+              postgresql_where=text('fk_workspace_id IS NULL')),
+        # Heads of the metadata found by the listing filters
+        Index('ix_metadata_head_metadata', 'fk_metadata_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    id_file = db.Column(UUID(as_uuid=True), index=True, nullable=False)
+    family_name = db.Column(db.String(60), nullable=False)
+    fk_workspace_id = db.Column(db.Integer, db.ForeignKey('workspace.id'), nullable=True)
+    fk_metadata_id = db.Column(db.Integer, db.ForeignKey('metadata.id'), nullable=False)
+
+    def __repr__(self):
+        return f'<MetadataHead {self.id_file} [{self.family_name}] -> {self.fk_metadata_id}>'
+
+
+METADATA_HEAD_TRIGGERS = """
+CREATE OR REPLACE FUNCTION metadata_head_refresh(file_ids uuid[], head_family_name varchar, head_workspace_id integer)
+RETURNS void AS $$
+BEGIN
+    DELETE FROM metadata_head
+    WHERE id_file = ANY(file_ids)
+      AND family_name = head_family_name
+      AND fk_workspace_id IS NOT DISTINCT FROM head_workspace_id;
+    INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+    SELECT metadata.id_file, family.name, family.fk_workspace_id, max(metadata.id)
+    FROM metadata JOIN family ON family.id = metadata.fk_family_id
+    WHERE metadata.id_file = ANY(file_ids)
+      AND family.name = head_family_name
+      AND family.fk_workspace_id IS NOT DISTINCT FROM head_workspace_id
+    GROUP BY metadata.id_file, family.name, family.fk_workspace_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION metadata_head_on_metadata() RETURNS trigger AS $$
+DECLARE
+    head_family_name varchar;
+    head_workspace_id integer;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.fk_family_id = NEW.fk_family_id AND OLD.id_file = NEW.id_file THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT name, fk_workspace_id INTO head_family_name, head_workspace_id
+        FROM family WHERE id = OLD.fk_family_id;
+        PERFORM metadata_head_refresh(ARRAY[OLD.id_file], head_family_name, head_workspace_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT name, fk_workspace_id INTO head_family_name, head_workspace_id
+        FROM family WHERE id = NEW.fk_family_id;
+        IF head_workspace_id IS NULL THEN
+            INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+            VALUES (NEW.id_file, head_family_name, NULL, NEW.id)
+            ON CONFLICT (id_file, family_name) WHERE fk_workspace_id IS NULL
+            DO UPDATE SET fk_metadata_id = GREATEST(metadata_head.fk_metadata_id, EXCLUDED.fk_metadata_id);
+        ELSE
+            INSERT INTO metadata_head (id_file, family_name, fk_workspace_id, fk_metadata_id)
+            VALUES (NEW.id_file, head_family_name, head_workspace_id, NEW.id)
+            ON CONFLICT (fk_workspace_id, id_file, family_name) WHERE fk_workspace_id IS NOT NULL
+            DO UPDATE SET fk_metadata_id = GREATEST(metadata_head.fk_metadata_id, EXCLUDED.fk_metadata_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION metadata_head_on_family() RETURNS trigger AS $$
+DECLARE
+    file_ids uuid[];
+BEGIN
+    SELECT array_agg(DISTINCT id_file) INTO file_ids FROM metadata WHERE fk_family_id = NEW.id;
+    IF file_ids IS NOT NULL THEN
+        PERFORM metadata_head_refresh(file_ids, OLD.name, OLD.fk_workspace_id);
+        PERFORM metadata_head_refresh(file_ids, NEW.name, NEW.fk_workspace_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER metadata_head_metadata
+AFTER INSERT OR UPDATE OF id_file, fk_family_id OR DELETE ON metadata
+FOR EACH ROW EXECUTE PROCEDURE metadata_head_on_metadata();
+
+CREATE TRIGGER metadata_head_family
+AFTER UPDATE OF name, fk_workspace_id ON family
+FOR EACH ROW
+WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.fk_workspace_id IS DISTINCT FROM NEW.fk_workspace_id)
+EXECUTE PROCEDURE metadata_head_on_family();
+"""
+"""
+Functions and triggers that maintain the :py:class:`MetadataHead` entries
+"""
+
+METADATA_HEAD_DROP_TRIGGERS = """
+DROP FUNCTION IF EXISTS metadata_head_on_family() CASCADE;
+DROP FUNCTION IF EXISTS metadata_head_on_metadata() CASCADE;
+DROP FUNCTION IF EXISTS metadata_head_refresh(uuid[], varchar, integer);
+"""
+
+# The metadata head table is created after the metadata and family tables,
+# which it references, and dropped before them
+event.listen(MetadataHead.__table__, 'after_create',
+             DDL(METADATA_HEAD_TRIGGERS).execute_if(dialect='postgresql'))
+event.listen(MetadataHead.__table__, 'before_drop',
+             DDL(METADATA_HEAD_DROP_TRIGGERS).execute_if(dialect='postgresql'))
+
+
 class QueryDialect(enum.Enum):
     """Query dialects supported by Quetzal"""
 
@@ -988,3 +1234,202 @@ class MetadataQuery(db.Model):
 
     def __repr__(self):
         return f'<MetadataQuery {self.id} ({self.dialect})>'
+
+
+class UploadSession(db.Model):
+    """ Resumable upload of a file on a workspace
+
+    Large files can be uploaded in several requests, each one sending a chunk
+    of the file contents at a particular offset. Chunks are staged in the data
+    directory or bucket of the workspace until the session is finalized: at
+    this point, the chunks are assembled and the file is created with its
+    base metadata.
+
+    This model keeps the information about the file being uploaded. The
+    received chunks are not saved in the database; they are determined from
+    the staged chunks on the storage backend.
+
+    Attributes
+    ----------
+    id: :py:class:`uuid.UUID`
+        Identifier and primary key of an upload session.
+    filename: str
+        Filename of the file being uploaded, without its path component.
+    path: str
+        Path component of the filename.
+    size: int
+        Expected size in bytes of the file. Can be ``None`` when unknown.
+    temporary: bool
+        Whether the file will be created as a temporary file.
+    creation_date: datetime
+        Date when the upload session was started.
+    finalize_date: datetime
+        Date when the finalization of the session was requested, or ``None``
+        when it was not requested or it failed.
+    id_file: :py:class:`uuid.UUID`
+        Identifier of the file created when the session was finalized, or
+        ``None`` if the session has not been finalized yet.
+    fk_workspace_id: int
+        Reference to the :py:class:`Workspace` where the file is uploaded.
+    fk_user_id: int
+        Reference to the :py:class:`User` who started this upload session.
+
+    """
+
+    id = db.Column(UUID(as_uuid=True), primary_key=True)
+    filename = db.Column(db.Text, nullable=False)
+    path = db.Column(db.Text, nullable=False, default='')
+    size = db.Column(db.BigInteger, nullable=True)
+    temporary = db.Column(db.Boolean, nullable=False, default=False)
+    creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    finalize_date = db.Column(db.DateTime(timezone=True), nullable=True)
+    id_file = db.Column(UUID(as_uuid=True), nullable=True)
+
+    fk_workspace_id = db.Column(db.Integer, db.ForeignKey('workspace.id'), nullable=False)
+    fk_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    @property
+    def finalized(self):
+        """Returns ``True`` when the file of this session has been created"""
+        return self.id_file is not None
+
+    @property
+    def finalizing(self):
+        """Returns ``True`` while the file of this session is being created"""
+        return self.finalize_date is not None and self.id_file is None
+
+    @staticmethod
+    def get_or_404(sid, workspace, for_update=False, for_share=False):
+        """Get an upload session of a workspace by id or raise an APIException
+
+        With `for_update`, the session row is locked until the end of the
+        transaction, and its attributes are read again under the lock. With
+        `for_share`, the lock is shared with the other `for_share` readers,
+        but excludes any `for_update` one.
+        """
+        query = UploadSession.query.filter_by(id=sid, workspace=workspace)
+        if for_update:
+            query = query.with_for_update().populate_existing()
+        elif for_share:
+            query = query.with_for_update(read=True).populate_existing()
+        upload = query.first()
+        if upload is None:
+            raise ObjectNotFoundException(status=codes.not_found,
+                                          title='Not found',
+                                          detail=f'Upload {sid} does not exist on '
+                                                 f'workspace {workspace.id}')
+        return upload
+
+    def to_dict(self, chunks=None):
+        """ Return a dictionary representation of the upload session
+
+        Used to conform to the upload details object on the OpenAPI
+        specification.
+
+        Parameters
+        ----------
+        chunks: list
+            List of ``(offset, size)`` tuples of the chunks received so far.
+
+        Returns
+        -------
+        dict
+            Dictionary representation of this object.
+
+        """
+        _dict = {
+            'id': str(self.id),
+            'workspace_id': self.fk_workspace_id,
+            'filename': self.filename,
+            'path': self.path,
+            'size': self.size,
+            'temporary': self.temporary,
+            'creation_date': self.creation_date,
+            'finalizing': self.finalizing,
+            'file_id': str(self.id_file) if self.id_file else None,
+        }
+        if chunks is not None:
+            _dict['chunks'] = [{'offset': offset, 'size': size} for offset, size in chunks]
+            _dict['received'] = sum(size for _, size in chunks)
+        return _dict
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} [{self.path}/{self.filename}]>'
+
+
+class DataObject(db.Model):
+    """ Content-addressed object on the global data storage
+
+    When a workspace is committed, the contents of its files are copied to the
+    global data directory or bucket. Files with the same contents, as
+    determined by the checksum and size of their base metadata, share the
+    same object, so the contents of duplicated files are stored only once.
+    The *url* entry of the base metadata of these files points to their
+    object.
+
+    Attributes
+    ----------
+    id: int
+        Identifier and primary key of an object.
+    checksum: str
+        MD5 checksum of the object contents.
+    size: int
+        Size in bytes of the object contents.
+    url: str
+        URL where the object contents are stored.
+    codec: str
+        Codec used to encode the stored contents, or ``None`` when they are
+        stored unchanged. The checksum and size are the ones of the decoded
+        contents.
+    creation_date: datetime
+        Date when the object was stored.
+
+    Extra attributes
+    ----------------
+    references
+        All :py:class:`DataObjectReference` entries of the files whose
+        contents are stored in this object.
+
+    """
+
+    __table_args__ = (
+        # There can only be one object for the same contents
+        UniqueConstraint('checksum', 'size'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    checksum = db.Column(db.String(32), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    url = db.Column(db.String(2048), nullable=False, unique=True)
+    codec = db.Column(db.String(16), nullable=True)
+    creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now())
+
+    references = db.relationship('DataObjectReference', backref='data_object', lazy='dynamic')
+
+    @staticmethod
+    def make_key(checksum, size):
+        """Name of the object with some contents, relative to the data storage"""
+        return f'objects/{checksum[:2]}/{checksum}-{size}'
+
+    def __repr__(self):
+        return f'<DataObject {self.id} [{self.checksum}, {self.size} bytes]>'
+
+
+class DataObjectReference(db.Model):
+    """ Reference from a committed file to the object that stores its contents
+
+    Attributes
+    ----------
+    id_file: :py:class:`uuid.UUID`
+        Identifier of the file, and primary key of the reference.
+    fk_data_object_id: int
+        Reference to the :py:class:`DataObject` with the file contents.
+
+    """
+
+    id_file = db.Column(UUID(as_uuid=True), primary_key=True)
+    fk_data_object_id = db.Column(db.Integer, db.ForeignKey('data_object.id'),
+                                  index=True, nullable=False)
+
+    def __repr__(self):
+        return f'<DataObjectReference {self.id_file} -> {self.fk_data_object_id}>'
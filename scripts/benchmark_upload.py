@@ -0,0 +1,87 @@
+""" Benchmark of the file reads done when a file is uploaded
+
+Compares the two ways that ``quetzal.app.api.data.file.create`` has used to
+obtain the md5sum and size of an uploaded file and save it on the local
+storage backend:
+
+* *baseline*: :py:func:`quetzal.app.helpers.files.get_readable_info` reads
+  the whole file, then the storage backend reads it again to save it.
+* *single read*: the file is wrapped in a
+  :py:class:`quetzal.app.helpers.files.HashingReader`, which computes the
+  md5sum and size while the storage backend saves it.
+
+Usage::
+
+    python scripts/benchmark_upload.py --size 1024 --repeat 5
+
+The file is read from the page cache after the first run, so this measures
+the CPU and copy costs of the second read. Uploads of files that do not fit
+on memory, or that are received on a spooled temporary file, also pay the
+disk read, which makes the difference larger.
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from flask import Flask
+
+from quetzal.app.api.data.storage import local
+from quetzal.app.helpers.files import HashingReader, get_readable_info
+
+
+def baseline(file_obj, target):
+    md5, size = get_readable_info(file_obj)
+    local.upload('benchmark.bin', file_obj, target)
+    return md5, size
+
+
+def single_read(file_obj, target):
+    reader = HashingReader(file_obj)
+    local.upload('benchmark.bin', reader, target)
+    return reader.finish()
+
+
+def measure(function, source, target, repeat):
+    """ Best time in seconds of `repeat` runs, and the result of the last one """
+    best = None
+    result = None
+    for _ in range(repeat):
+        with open(source, 'rb') as file_obj:
+            start = time.perf_counter()
+            result = function(file_obj, target)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=512,
+                        help='Size of the uploaded file, in Mb (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each method (default: %(default)s)')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with tempfile.TemporaryDirectory() as tmpdir, app.app_context():
+        # The local backend refuses to write on the global data directory
+        app.config['QUETZAL_FILE_DATA_DIR'] = os.path.join(tmpdir, 'data')
+        target = 'file://' + os.path.join(tmpdir, 'workspace')
+        source = os.path.join(tmpdir, 'source.bin')
+        with open(source, 'wb') as fd:
+            for _ in range(args.size):
+                fd.write(os.urandom(1 << 20))
+
+        results = {}
+        for name, function in [('baseline', baseline), ('single read', single_read)]:
+            elapsed, results[name] = measure(function, source, target, args.repeat)
+            print(f'{name:>12}: {elapsed:.3f} s, {args.size / elapsed:.1f} Mb/s')
+
+        if results['baseline'] != results['single read']:
+            raise SystemExit(f'Different md5sum and size: {results}')
+
+
+if __name__ == '__main__':
+    main()
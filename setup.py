@@ -37,7 +37,9 @@ setup(
         'syslog-rfc5424-formatter',
         'apscheduler',
         'gunicorn',
-        'google-cloud-storage',
+        'google-cloud-storage>=1.16,<2',
+        'zstandard>=0.12',
+        'crcmod',
     ],
     author=author_names,
     author_email=author_emails,
@@ -54,6 +54,18 @@ def workspace(make_workspace):
     return workspace
 
 
+@pytest.fixture(scope='function')
+def local_workspace(app, make_workspace, tmp_path, mocker):
+    """Workspace with a data directory on the local storage backend"""
+    mocker.patch.dict(app.config, {
+        'QUETZAL_DATA_STORAGE': 'file',
+        'QUETZAL_FILE_DATA_DIR': str(tmp_path / 'data'),
+    })
+    data_dir = tmp_path / 'workspace'
+    data_dir.mkdir()
+    return make_workspace(families={'base': 0}, data_url=f'file://{data_dir}')
+
+
 @pytest.fixture(scope='function')
 def missing_workspace_id(db, db_session):
     # Get the latest workspace id in order to request one that does not exist
@@ -123,7 +135,7 @@ def upload_file(app, make_file, user):
         from quetzal.app.api.data.file import create
         upload_result = (url or '', url or '')
         with mock.patch('quetzal.app.api.data.storage.upload', return_value=upload_result), \
-             mock.patch('quetzal.app.api.data.file._now', return_value=date or str(datetime.datetime.now(datetime.timezone.utc))), \
+             mock.patch('quetzal.app.api.data.file.now', return_value=date or str(datetime.datetime.now(datetime.timezone.utc))), \
              app.test_request_context():
 
             response, _ = create(wid=workspace.id, content=make_file(**kwargs), user=user or _user)
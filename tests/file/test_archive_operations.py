@@ -0,0 +1,136 @@
+"""Unit tests for uploading and downloading many files as an archive"""
+import hashlib
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+
+from quetzal.app.api.data.file import create_archive, fetch_archive_w
+from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
+from quetzal.app.models import Metadata
+
+
+CONTENTS = {
+    'a.txt': b'hello world',
+    'sub/b.txt': b'foo',
+    'sub/dir/c.bin': b'\x00\x01\x02',
+}
+
+
+def _make_tar():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in CONTENTS.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+
+def _make_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w') as archive:
+        for name, data in CONTENTS.items():
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.parametrize('make_archive', [_make_tar, _make_zip])
+def test_create_archive_success(app, db_session, local_workspace, user, make_archive, mocker):
+    """All files of an archive are created with their path"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+
+    with app.test_request_context(query_string='path=study'):
+        files, code = create_archive(wid=local_workspace.id, content=make_archive(), user=user)
+
+    assert code == 201
+    assert len(files) == len(CONTENTS)
+    for details in files:
+        name = details['path'][len('study/'):] + '/' + details['filename']
+        data = CONTENTS[name.lstrip('/')]
+        assert details['checksum'] == hashlib.md5(data).hexdigest()
+        assert details['size'] == len(data)
+        assert Metadata.query.filter_by(id_file=details['id']).one().json == details
+
+
+def test_create_archive_invalid(app, db_session, local_workspace, user, make_file, mocker):
+    """A file that is not an archive is rejected"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+
+    with app.test_request_context():
+        with pytest.raises(APIException) as exc_info:
+            create_archive(wid=local_workspace.id, content=make_file(), user=user)
+    assert exc_info.value.status == 400
+
+
+def _read_archive(data, archive_format):
+    if archive_format == 'zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive}
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'zip'])
+def test_fetch_archive_workspace(app, db_session, local_workspace, user, archive_format, mocker):
+    """All files of a workspace are downloaded as an archive with a manifest"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    with app.test_request_context():
+        files, _ = create_archive(wid=local_workspace.id, content=_make_zip(), user=user)
+
+    with app.test_request_context():
+        response, code = fetch_archive_w(wid=local_workspace.id, format=archive_format)
+        data = b''.join(response.response)
+
+    assert code == 200
+    assert response.headers['Content-Disposition'] == \
+        f'attachment; filename="workspace-{local_workspace.id}.{archive_format}"'
+    entries = _read_archive(data, archive_format)
+    manifest = json.loads(entries.pop('manifest.json'))
+    assert entries == CONTENTS
+    assert {f['name']: f['metadata']['base'] for f in manifest['files']} == \
+        {(d['path'] + '/' + d['filename']).lstrip('/'): d for d in files}
+
+
+def test_fetch_archive_selection(app, db_session, local_workspace, user, mocker):
+    """Only the requested files are downloaded, and unknown files are rejected"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    with app.test_request_context():
+        files, _ = create_archive(wid=local_workspace.id, content=_make_tar(), user=user)
+    selected = [d for d in files if d['filename'] == 'b.txt']
+
+    with app.test_request_context():
+        response, code = fetch_archive_w(wid=local_workspace.id, uuid=[selected[0]['id']])
+        data = b''.join(response.response)
+
+    entries = _read_archive(data, 'tar')
+    assert set(entries) == {'manifest.json', 'sub/b.txt'}
+
+    with app.test_request_context():
+        with pytest.raises(ObjectNotFoundException):
+            fetch_archive_w(wid=local_workspace.id, uuid=['00000000-0000-0000-0000-000000000000'])
+
+
+def test_fetch_archive_batches(app, db_session, local_workspace, user, mocker):
+    """Files read in several batches are all sent, followed by the manifest"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch('quetzal.app.api.data.file.ARCHIVE_BATCH_SIZE', 2)
+    mocker.patch('quetzal.app.api.data.file.ARCHIVE_MANIFEST_MEMORY', 16)
+    with app.test_request_context():
+        files, _ = create_archive(wid=local_workspace.id, content=_make_zip(), user=user)
+
+    with app.test_request_context():
+        response, _ = fetch_archive_w(wid=local_workspace.id)
+        data = b''.join(response.response)
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        names = archive.getnames()
+        manifest = json.loads(archive.extractfile('manifest.json').read())
+    assert names[-1] == 'manifest.json'
+    assert sorted(names[:-1]) == sorted(CONTENTS)
+    assert sorted(f['name'] for f in manifest['files']) == sorted(CONTENTS)
+    assert all(set(f['metadata']) == {'base'} for f in manifest['files'])
@@ -0,0 +1,69 @@
+"""Unit tests for the filters of the file listings"""
+import uuid
+
+import pytest
+
+from quetzal.app.api.data.file import fetch_w
+from quetzal.app.api.exceptions import APIException
+from quetzal.app.models import Metadata
+
+
+@pytest.fixture(scope='function')
+def filtered_workspace(db_session, make_workspace, mocker):
+    """A workspace with files of various base and other metadata"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0})
+    base = workspace.families.filter_by(name='base').one()
+    other = workspace.families.filter_by(name='other').one()
+
+    files = {}
+    for name, size, label, tags in [('IMG_1.png', 10, 'cat', ['red', 'large']),
+                                    ('IMG_2.png', 2000, 'dog', ['red']),
+                                    ('notes_1.txt', 300, '12', [])]:
+        file_id = str(uuid.uuid4())
+        files[name] = file_id
+        db_session.add(Metadata(id_file=file_id, family=base, json={
+            'id': file_id, 'filename': name, 'path': 'a/b', 'size': size,
+        }))
+        db_session.add(Metadata(id_file=file_id, family=other, json={
+            'id': file_id, 'label': label, 'tags': tags,
+        }))
+    db_session.commit()
+    return workspace, files
+
+
+@pytest.mark.parametrize('filters,expected', [
+    ('filename=IMG_1.png', {'IMG_1.png'}),
+    ('size=2000', {'IMG_2.png'}),
+    ('filename[prefix]=IMG_', {'IMG_1.png', 'IMG_2.png'}),
+    ('filename[prefix]=notes_', {'notes_1.txt'}),
+    ('size[gte]=300', {'IMG_2.png', 'notes_1.txt'}),
+    ('size[lt]=300,path=a/b', {'IMG_1.png'}),
+    ('other.label[in]=cat|dog', {'IMG_1.png', 'IMG_2.png'}),
+    ('other.label=12', {'notes_1.txt'}),
+    ('other.tags[contains]=red', {'IMG_1.png', 'IMG_2.png'}),
+    ('other.tags[contains]=red|large', {'IMG_1.png'}),
+    ('other.tags[contains]=red,filename[prefix]=IMG_2', {'IMG_2.png'}),
+    ('other.label=bird', set()),
+])
+def test_fetch_filters(app, filtered_workspace, filters, expected):
+    """Filters on the base and other families select the expected files"""
+    workspace, files = filtered_workspace
+    with app.test_request_context(query_string={'filters': filters}):
+        response, _ = fetch_w(wid=workspace.id)
+
+    assert {meta['id'] for meta in response['results']} == {files[name] for name in expected}
+
+
+@pytest.mark.parametrize('filters', [
+    'filename',
+    'unknown=value',
+    'size[between]=1',
+    'other.label[eq]value',
+])
+def test_fetch_filters_invalid(app, filtered_workspace, filters):
+    """Malformed filters, unknown base keys and unknown operators are rejected"""
+    workspace, _ = filtered_workspace
+    with app.test_request_context(query_string={'filters': filters}):
+        with pytest.raises(APIException):
+            fetch_w(wid=workspace.id)
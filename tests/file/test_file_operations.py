@@ -1,16 +1,21 @@
+import hashlib
 import io
 import json
 import logging
+import pathlib
 import urllib.parse
 from collections import namedtuple
 
 import pytest
+import rsa
 from google.auth.credentials import AnonymousCredentials
+from google.oauth2 import service_account
 from google.cloud.storage import Client, Blob
 
-from quetzal.app.api.data.file import create, details, details_w
+from quetzal.app.api.data.file import create, create_reference, delete, details, details_w
+from quetzal.app.api.data.tasks import compute_file_digests
 from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
-from quetzal.app.models import Metadata, WorkspaceState
+from quetzal.app.models import DataObject, Metadata, WorkspaceState
 
 
 def test_create_file_success(app, db, db_session, user, make_workspace, file_id, make_file, mocker):
@@ -69,7 +74,7 @@ def test_create_file_correct_metadata(app, db, db_session, make_workspace, file_
     mocker.patch('google.cloud._http.JSONConnection.api_request',
                  return_value={})
     mocker.patch('quetzal.app.api.data.file.uuid4', return_value=file_id)
-    mocker.patch('quetzal.app.api.data.file._now', return_value='2019-02-03 16:30:11.350719+00:00')
+    mocker.patch('quetzal.app.api.data.file.now', return_value='2019-02-03 16:30:11.350719+00:00')
     request_mock = mocker.patch('google.auth.transport.requests.AuthorizedSession.request')
 
     # A mock function to control external request. Here, there should be a call
@@ -101,6 +106,8 @@ def test_create_file_correct_metadata(app, db, db_session, make_workspace, file_
         'path': 'a/b/c',
         'size': 11,
         'checksum': '5eb63bbbe01eeed093cb22bb8f5acdc3',
+        'sha256': 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9',
+        'crc32c': 'c99465aa',
         'url': f'{bucket_url}/{file_id}',
         'date': '2019-02-03 16:30:11.350719+00:00',
         'state': 'READY'
@@ -221,11 +228,12 @@ def test_download_file_metadata_in_workspace(app, db_session, make_workspace, up
 
     headers = {'accept': 'application/json'}
     with app.test_request_context(headers=headers):
-        details, code = details_w(wid=workspace.id, uuid=file_id)
+        details, code, headers = details_w(wid=workspace.id, uuid=file_id)
 
     assert code == 200
     assert details['id'] == file_id
     assert 'metadata' in details
+    assert headers['ETag'] and headers['Cache-Control'] == 'no-cache'
 
 
 def test_download_file_content_in_global(app, db_session, committed_file, mocker):
@@ -253,12 +261,60 @@ def test_download_file_metadata_in_global(app, db_session, committed_file, mocke
 
     headers = {'accept': 'application/json'}
     with app.test_request_context(headers=headers):
-        metadata, code = details(uuid=file_id)
+        metadata, code, _ = details(uuid=file_id)
 
     assert code == 200
     assert metadata['metadata'] == file_metadata
 
 
+def test_download_file_content_not_modified(app, db_session, committed_file, mocker):
+    """A conditional request with the checksum as entity tag does not read the contents"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+
+    file_id = committed_file['id']
+    checksum = committed_file['metadata']['base']['checksum']
+    base_meta = Metadata.get_latest_global(file_id, 'base').first()
+    base_meta.json = dict(base_meta.json, url='file:///data/object')
+    db_session.commit()
+    download_mock = mocker.patch('quetzal.app.api.data.file._download_file',
+                                 return_value=io.BytesIO(committed_file['content']))
+
+    headers = {'accept': 'application/octet-stream'}
+    with app.test_request_context(headers=headers):
+        response, code = details(uuid=file_id)
+    assert code == 200
+    assert response.headers['ETag'] == f'"{checksum}"'
+    assert response.headers['Cache-Control'] == app.config['QUETZAL_FILE_CACHE_CONTROL']
+
+    download_mock.reset_mock()
+    headers = {'accept': 'application/octet-stream', 'if-none-match': f'"other", "{checksum}"'}
+    with app.test_request_context(headers=headers):
+        response, code = details(uuid=file_id)
+    assert code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == f'"{checksum}"'
+    download_mock.assert_not_called()
+
+
+def test_download_file_metadata_not_modified(app, db_session, committed_file, mocker):
+    """A conditional request with the entity tag of the current metadata is not modified"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+
+    file_id = committed_file['id']
+    with app.test_request_context(headers={'accept': 'application/json'}):
+        _, _, headers = details(uuid=file_id)
+
+    headers = {'accept': 'application/json', 'if-none-match': headers['ETag']}
+    with app.test_request_context(headers=headers):
+        response, code = details(uuid=file_id)
+    assert code == 304
+
+    headers = {'accept': 'application/json', 'if-none-match': '"outdated"'}
+    with app.test_request_context(headers=headers):
+        _, code, _ = details(uuid=file_id)
+    assert code == 200
+
+
 def test_download_file_content_correct_api(app, db_session, make_workspace, upload_file, mocker):
     """Retrieve file contents of a file uploaded to a workspace"""
     mocker.patch('flask_principal.Permission.can', return_value=True)
@@ -283,18 +339,258 @@ def test_download_file_content_correct_api(app, db_session, make_workspace, uplo
     with app.test_request_context(headers=headers):
         details_w(wid=workspace.id, uuid=file_id)
 
-    # the first two calls concern getting the bucket name
-    assert request_mock.call_count == 2
-
-    args1, kwargs1 = request_mock.call_args_list[0]
-    args2, kwargs2 = request_mock.call_args_list[1]
-    assert kwargs1['method'] == kwargs2['method'] == 'GET'
-    assert kwargs1['path'] == '/b/bucket_name'
-    assert kwargs2['path'] == '/b/bucket_name/o/object_name'
+    # the bucket and object are not retrieved: the only request is the download
+    request_mock.assert_not_called()
 
     # the last call concerns the downloading and should respect
     # https://cloud.google.com/storage/docs/json_api/v1/objects/get
     transport_request_mock.assert_called_once()
-    args3, kwargs3 = transport_request_mock.call_args
-    assert args3[0] == 'GET'
-    assert args3[1] == 'https://www.googleapis.com/download/storage/v1/b/bucket_name/o/object_name?alt=media'
+    args, kwargs = transport_request_mock.call_args
+    assert args[0] == 'GET'
+    assert args[1] == 'https://www.googleapis.com/download/storage/v1/b/bucket_name/o/object_name?alt=media'
+
+
+def test_create_file_async_digests(app, db_session, local_workspace, user, make_file, mocker):
+    """Extra digests are left to a background task when configured"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_EXTRA_DIGESTS': ['sha256'],
+                                   'QUETZAL_ASYNC_DIGESTS': True})
+    task_mock = mocker.patch('quetzal.app.api.data.helpers.compute_file_digests')
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(content=b'hello world'), user=user)
+
+    assert file_details['checksum'] == '5eb63bbbe01eeed093cb22bb8f5acdc3'
+    assert file_details['sha256'] is None
+    task_mock.si.assert_called_once_with(file_details['id'], ['sha256'])
+
+    compute_file_digests(file_details['id'], ['sha256'])
+    meta = Metadata.query.filter_by(id_file=file_details['id']).one()
+    assert meta.json['sha256'] == 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9'
+
+
+def test_compute_digests_deleted_file(app, db_session, local_workspace, user, make_file, mocker):
+    """Digests of a file deleted before they are computed are skipped"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_EXTRA_DIGESTS': ['sha256'],
+                                   'QUETZAL_ASYNC_DIGESTS': True})
+    mocker.patch('quetzal.app.api.data.helpers.compute_file_digests')
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(content=b'hello world'), user=user)
+        delete(wid=local_workspace.id, uuid=file_details['id'], user=user)
+
+    compute_file_digests(file_details['id'], ['sha256'])
+    meta = Metadata.query.filter_by(id_file=file_details['id']).one()
+    assert meta.json['state'] == 'DELETED'
+    assert meta.json['sha256'] is None
+
+
+def test_download_file_codec_local(app, db_session, local_workspace, user, make_file, mocker):
+    """Files stored with a codec are decoded on download, unless the client accepts it"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_STORAGE_CODEC': 'zstd'})
+    content = b'a,b,c\n1,2,3\n' * 1000
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(content=content), user=user)
+
+    # Size and checksum are the ones of the contents, not of the stored file
+    assert file_details['codec'] == 'zstd'
+    assert file_details['size'] == len(content)
+    assert file_details['checksum'] == hashlib.md5(content).hexdigest()
+    stored = pathlib.Path(urllib.parse.urlparse(file_details['url']).path).read_bytes()
+    assert stored.startswith(b'\x28\xb5\x2f\xfd') and len(stored) < len(content)
+
+    headers = {'accept': 'application/octet-stream'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=local_workspace.id, uuid=file_details['id'])
+    assert code == 200
+    assert response.data == content
+    assert 'Content-Encoding' not in response.headers
+
+    headers = {'accept': 'application/octet-stream', 'accept-encoding': 'gzip, zstd'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=local_workspace.id, uuid=file_details['id'])
+    assert code == 200
+    assert response.data == stored
+    assert response.headers['Content-Encoding'] == 'zstd'
+
+
+def test_download_file_range_local(app, db_session, local_workspace, user, make_file, mocker):
+    """Retrieve a byte range of the contents of a file on a workspace"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    content = b'0123456789'
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(content=content), user=user)
+
+    headers = {'accept': 'application/octet-stream', 'range': 'bytes=2-5'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=local_workspace.id, uuid=file_details['id'])
+
+    # The server closes the response iterable, which must close the file
+    iterable = response.response
+    assert code == 206
+    assert response.data == content[2:6]
+    assert response.headers['Content-Range'] == f'bytes 2-5/{len(content)}'
+    iterable.close()
+    assert iterable.file._file_obj.closed
+    assert iterable.file.closed
+
+    headers = {'accept': 'application/octet-stream', 'range': 'bytes=20-30'}
+    with app.test_request_context(headers=headers):
+        with pytest.raises(APIException) as exc_info:
+            details_w(wid=local_workspace.id, uuid=file_details['id'])
+    assert exc_info.value.status == 416
+
+
+def test_download_file_range_gcp(app, db_session, make_workspace, upload_file, mocker):
+    """Retrieve a byte range of a file on GCP downloads only the requested bytes"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+
+    result_type = namedtuple('request', ['status_code', 'headers', 'json'])
+    mocker.patch('google.auth.default',
+                 return_value=(AnonymousCredentials(), 'mock-project'))
+    mocker.patch('quetzal.app.helpers.google_api.get_client',
+                 return_value=Client(project='mock-project'))
+    mocker.patch('google.cloud._http.JSONConnection.api_request',
+                 side_effect=result_type(200, {'location': 'something'}, lambda: {}))
+    transport_request_mock = mocker.patch('google.auth.transport.requests.AuthorizedSession.request',
+                                          return_value=result_type(206, {}, lambda: {}))
+    mocker.patch('google.resumable_media.requests.download.Download._write_to_stream')
+
+    workspace = make_workspace(families={'base': 0})
+    file_id = upload_file(workspace=workspace, url='gs://bucket_name/object_name', content=b'0123456789')
+
+    headers = {'accept': 'application/octet-stream', 'range': 'bytes=2-5'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=workspace.id, uuid=file_id)
+
+    assert code == 206
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    transport_request_mock.assert_called_once()
+    _, kwargs = transport_request_mock.call_args
+    assert kwargs['headers']['range'] == 'bytes=2-5'
+
+
+def test_download_file_cache_gcp(app, db_session, make_workspace, upload_file, tmp_path, mocker):
+    """GCP downloads are saved on the disk cache and served from it"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_CACHE_DIR': str(tmp_path)})
+    get_object_mock = mocker.patch('quetzal.app.api.data.file.get_object')
+    download_mock = get_object_mock.return_value.download_as_string
+    download_mock.side_effect = lambda client, start, end: b'0123456789'[start:end + 1]
+
+    workspace = make_workspace(families={'base': 0})
+    file_id = upload_file(workspace=workspace, url='gs://bucket_name/object_name', content=b'0123456789')
+
+    headers = {'accept': 'application/octet-stream'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=workspace.id, uuid=file_id)
+    assert code == 200
+    assert response.data == b'0123456789'
+
+    headers = {'accept': 'application/octet-stream', 'range': 'bytes=2-5'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=workspace.id, uuid=file_id)
+    assert code == 206
+    assert response.data == b'2345'
+
+    # Only the first download was sent to GCP
+    download_mock.assert_called_once()
+
+
+def test_download_file_accel_redirect(app, db_session, local_workspace, user, make_file, mocker):
+    """Local file contents are delegated to nginx when configured"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_FILE_DOWNLOAD_MODE': 'nginx'})
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(), user=user)
+
+    headers = {'accept': 'application/octet-stream'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=local_workspace.id, uuid=file_details['id'])
+
+    path = urllib.parse.urlparse(file_details['url']).path
+    assert code == 200
+    assert response.headers['X-Accel-Redirect'] == '/_quetzal_files' + path
+    assert response.data == b''
+
+
+def test_download_file_signed_url(app, db_session, make_workspace, upload_file, mocker):
+    """GCP file contents are served by a redirection to a signed URL when configured"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_DOWNLOAD_MODE': 'signed_url'})
+
+    # A stand-in for GCP: signing uses service account credentials with a
+    # throwaway key, and any request to GCP is intercepted
+    _, private_key = rsa.newkeys(1024)
+    credentials = service_account.Credentials.from_service_account_info({
+        'client_email': 'quetzal@mock-project.iam.gserviceaccount.com',
+        'private_key': private_key.save_pkcs1().decode(),
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    })
+    mocker.patch('quetzal.app.helpers.google_api.get_client',
+                 return_value=Client(project='mock-project', credentials=credentials))
+    request_mock = mocker.patch('google.cloud._http.JSONConnection.api_request')
+    transport_request_mock = mocker.patch('google.auth.transport.requests.AuthorizedSession.request')
+
+    workspace = make_workspace(families={'base': 0})
+    file_id = upload_file(workspace=workspace, url='gs://bucket_name/object_name')
+
+    headers = {'accept': 'application/octet-stream'}
+    with app.test_request_context(headers=headers):
+        response, code = details_w(wid=workspace.id, uuid=file_id)
+
+    assert code == 303
+    location = urllib.parse.urlparse(response.headers['Location'])
+    query = urllib.parse.parse_qs(location.query)
+    assert location.netloc == 'storage.googleapis.com'
+    assert location.path == '/bucket_name/object_name'
+    assert query['X-Goog-Algorithm'] == ['GOOG4-RSA-SHA256']
+    assert query['X-Goog-Expires'] == [str(app.config['QUETZAL_GCP_SIGNED_URL_EXPIRATION'])]
+    assert 'X-Goog-Signature' in query
+
+    # The file contents are not downloaded by the application
+    request_mock.assert_not_called()
+    transport_request_mock.assert_not_called()
+
+
+def test_create_reference(app, db_session, local_workspace, user, mocker):
+    """A file is created from committed contents without uploading them"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    content = b'stored contents'
+    checksum = hashlib.md5(content).hexdigest()
+    data_object = DataObject(checksum=checksum, size=len(content), url='file:///data/objects/stored')
+    db_session.add(data_object)
+    db_session.commit()
+
+    body = {'checksum': checksum.upper(), 'size': len(content), 'filename': 'a/b/file.txt'}
+    with app.test_request_context():
+        file_details, code = create_reference(wid=local_workspace.id, body=body, user=user)
+
+    assert code == 201
+    assert file_details['url'] == data_object.url
+    assert (file_details['path'], file_details['filename']) == ('a/b', 'file.txt')
+    assert (file_details['checksum'], file_details['size']) == (checksum, len(content))
+    assert Metadata.query.filter_by(id_file=file_details['id']).one().json == file_details
+
+    body = {'checksum': checksum, 'size': len(content) + 1, 'filename': 'file.txt'}
+    with app.test_request_context():
+        with pytest.raises(ObjectNotFoundException):
+            create_reference(wid=local_workspace.id, body=body, user=user)
+
+
+def test_create_file_dedup(app, db_session, local_workspace, user, make_file, mocker):
+    """Uploaded contents that are already committed are not kept on the workspace"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_UPLOAD_DEDUP': True})
+    content = b'stored contents'
+    data_object = DataObject(checksum=hashlib.md5(content).hexdigest(), size=len(content),
+                             url='file:///data/objects/stored')
+    db_session.add(data_object)
+    db_session.commit()
+
+    with app.test_request_context():
+        file_details, _ = create(wid=local_workspace.id, content=make_file(content=content), user=user)
+
+    assert file_details['url'] == data_object.url
+    workspace_dir = pathlib.Path(urllib.parse.urlparse(local_workspace.data_url).path)
+    assert not any(path.is_file() for path in workspace_dir.rglob('*'))
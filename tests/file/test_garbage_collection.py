@@ -0,0 +1,124 @@
+"""Unit tests for the garbage collection of unreferenced stored files"""
+import datetime
+import uuid
+
+from quetzal.app.api.data.gc import collect_garbage
+from quetzal.app.api.data.upload import create, upload_chunk
+from quetzal.app.models import DataObject, Metadata, UploadSession, WorkspaceState
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def _stored_files(app, db_session, local_workspace, tmp_path):
+    data_dir = tmp_path / 'data'
+    workspace_dir = tmp_path / 'workspace'
+    referenced_file = _write(workspace_dir / 'a.txt', b'hello')
+    referenced_object = _write(data_dir / 'objects' / 'aa' / 'object', b'world')
+    orphan_file = _write(workspace_dir / 'sub' / 'orphan.txt', b'orphan')
+    orphan_object = _write(data_dir / 'objects' / 'bb' / 'orphan', b'lost object')
+    chunk = _write(workspace_dir / '.uploads' / 'key' / '0', b'chunk')
+
+    file_id = str(uuid.uuid4())
+    family = local_workspace.families.filter_by(name='base').one()
+    db_session.add(Metadata(id_file=file_id, family=family,
+                            json={'id': file_id, 'url': f'file://{referenced_file.resolve()}'}))
+    db_session.add(DataObject(checksum='0' * 32, size=5, url=f'file://{referenced_object.resolve()}'))
+    db_session.commit()
+
+    return {
+        'kept': [referenced_file, referenced_object, chunk],
+        'deleted': [orphan_file, orphan_object],
+    }
+
+
+def test_collect_garbage_deletes_unreferenced(app, db_session, local_workspace, tmp_path):
+    """Unreferenced files are deleted and their size is reported"""
+    files = _stored_files(app, db_session, local_workspace, tmp_path)
+
+    with app.app_context():
+        report = collect_garbage(0)
+
+    assert all(path.exists() for path in files['kept'])
+    assert not any(path.exists() for path in files['deleted'])
+    assert report['deleted'] == 2
+    assert report['reclaimed_bytes'] == sum(len(b) for b in (b'orphan', b'lost object'))
+    assert report['errors'] == 0
+
+
+def test_collect_garbage_grace_period(app, db_session, local_workspace, tmp_path):
+    """Recent unreferenced files are kept"""
+    files = _stored_files(app, db_session, local_workspace, tmp_path)
+
+    with app.app_context():
+        report = collect_garbage(3600)
+
+    assert all(path.exists() for path in files['kept'] + files['deleted'])
+    assert report['scanned'] >= 4
+    assert report['unreferenced'] == 0
+    assert report['reclaimed_bytes'] == 0
+
+
+def test_collect_garbage_dry_run(app, db_session, local_workspace, tmp_path):
+    """A dry run counts the unreferenced files without deleting them"""
+    files = _stored_files(app, db_session, local_workspace, tmp_path)
+
+    with app.app_context():
+        report = collect_garbage(0, dry_run=True)
+
+    assert all(path.exists() for path in files['kept'] + files['deleted'])
+    assert report['unreferenced'] == 2
+    assert report['deleted'] == 0
+
+
+def test_collect_garbage_shared_bucket(app, db_session, make_workspace, mocker):
+    """Workspaces that are prefixes of the data bucket are only listed once"""
+    mocker.patch.dict(app.config, {
+        'QUETZAL_DATA_STORAGE': 'GCP',
+        'QUETZAL_GCP_DATA_BUCKET': 'gs://data',
+    })
+    make_workspace(data_url='gs://data/workspaces/ready')
+    make_workspace(data_url='gs://data/workspaces/scanning', state=WorkspaceState.SCANNING)
+    old = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    objects = [
+        ('gs://data/objects/aa/orphan', 1, old),
+        ('gs://data/workspaces/ready/orphan.txt', 2, old),
+        ('gs://data/workspaces/scanning/orphan.txt', 4, old),
+    ]
+    list_mock = mocker.patch('quetzal.app.api.data.storage.list_objects',
+                             side_effect=lambda location: iter(objects if location == 'gs://data' else []))
+    delete_mock = mocker.patch('quetzal.app.api.data.storage.delete_objects')
+
+    with app.app_context():
+        report = collect_garbage(0)
+
+    list_mock.assert_called_once_with('gs://data')
+    delete_mock.assert_called_once_with(['gs://data/objects/aa/orphan',
+                                         'gs://data/workspaces/ready/orphan.txt'])
+    assert report['scanned'] == 2
+    assert report['reclaimed_bytes'] == 3
+
+
+def test_collect_garbage_expired_uploads(app, db_session, local_workspace, user, tmp_path, mocker):
+    """Uploads that were not finalized in time are deleted with their chunks"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    sessions = [create(wid=local_workspace.id, body={'filename': f'file_{i}.txt'}, user=user)[0]
+                for i in range(2)]
+    for session in sessions:
+        upload_chunk(wid=local_workspace.id, sid=session['id'], offset=0, body=b'hello')
+    expired = UploadSession.query.get(sessions[0]['id'])
+    expired.creation_date = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    db_session.add(expired)
+    db_session.commit()
+
+    with app.app_context():
+        report = collect_garbage(0)
+
+    assert report['expired_uploads'] == 1
+    assert [str(upload.id) for upload in local_workspace.uploads] == [sessions[1]['id']]
+    chunks = tmp_path / 'workspace' / '.uploads'
+    assert not (chunks / sessions[0]['id']).exists()
+    assert (chunks / sessions[1]['id']).exists()
@@ -1,7 +1,9 @@
 import pytest
 import warnings
 
-from quetzal.app.api.data.file import update_metadata
+from quetzal.app.api.data.file import (
+    _all_metadata, _all_metadata_many, update_metadata, update_metadata_many
+)
 from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
 from quetzal.app.models import Family, Metadata, WorkspaceState
 
@@ -310,6 +312,122 @@ def test_update_metadata_db_records(make_workspace, upload_file, mocker):
     assert new_meta_other_ids_1 == new_meta_other_ids_2
 
 
+def test_update_metadata_many_db_records(db_session, make_workspace, upload_file, mocker):
+    """Bulk changes add entries for new families and reuse the existing ones"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0})
+    file_ids = [upload_file(workspace=workspace, name=f'file_{i}.txt') for i in range(3)]
+    other_family = workspace.families.filter_by(name='other').first()
+    other_query = Metadata.query.filter_by(family=other_family)
+
+    body = [{'id': file_id, 'metadata': {'other': {'index': i}}}
+            for i, file_id in enumerate(file_ids)]
+    result, _ = update_metadata_many(wid=workspace.id, body=body)
+
+    assert result == [{'id': file_id, 'metadata': {'other': {'id': file_id, 'index': i}}}
+                      for i, file_id in enumerate(file_ids)]
+    first_ids = {m.id for m in other_query.all()}
+    assert len(first_ids) == 3
+
+    # Change the same files again, with two changes of the first file
+    body = [{'id': file_id, 'metadata': {'other': {'key': 'value'}}} for file_id in file_ids]
+    body.append({'id': file_ids[0], 'metadata': {'other': {'index': 10}}})
+    update_metadata_many(wid=workspace.id, body=body)
+
+    assert {m.id for m in other_query.all()} == first_ids
+    assert {str(m.id_file): m.json for m in other_query.all()} == {
+        file_id: {'id': file_id, 'key': 'value', 'index': 10 if i == 0 else i}
+        for i, file_id in enumerate(file_ids)
+    }
+
+
+def test_update_metadata_many_missing_file(db_session, make_workspace, upload_file, mocker):
+    """Bulk changes on a file that does not exist fail without any change"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0})
+    file_id = upload_file(workspace=workspace)
+
+    body = [
+        {'id': file_id, 'metadata': {'other': {'key': 'value'}}},
+        {'id': '00000000-0000-4000-8000-000000000000', 'metadata': {'other': {'key': 'value'}}},
+    ]
+    with pytest.raises(ObjectNotFoundException):
+        update_metadata_many(wid=workspace.id, body=body)
+
+    other_family = workspace.families.filter_by(name='other').first()
+    assert Metadata.query.filter_by(family=other_family).count() == 0
+
+
+def test_update_metadata_many_failed_move(db_session, make_workspace, upload_file, mocker):
+    """Files renamed before a failed rename of the same batch are renamed back"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0}, data_url='file:///workspace')
+    file_ids = [upload_file(workspace=workspace, name=f'file_{i}.txt', path='a',
+                            url=f'file:///workspace/a/file_{i}.txt') for i in range(2)]
+    move_mock = mocker.patch('quetzal.app.api.data.file._move_file',
+                             side_effect=['file:///workspace/b/file_0.txt', OSError('disk full'), None])
+
+    body = [{'id': file_id, 'metadata': {'base': {'path': 'b'}}} for file_id in file_ids]
+    with pytest.raises(OSError):
+        update_metadata_many(wid=workspace.id, body=body)
+
+    assert move_mock.call_args_list[-1] == mocker.call('file:///workspace/b/file_0.txt',
+                                                        'file:///workspace', 'a', 'file_0.txt')
+    base_family = workspace.families.filter_by(name='base').first()
+    assert {m.json['path'] for m in Metadata.query.filter_by(family=base_family)} == {'a'}
+
+
+def test_update_metadata_many_deleted_file(db_session, make_workspace, upload_file, mocker):
+    """Bulk changes on a deleted file are rejected"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0})
+    file_id = upload_file(workspace=workspace)
+    base = Metadata.query.filter_by(id_file=file_id).one()
+    base.update({'url': None, 'state': 'DELETED'})
+    db_session.add(base)
+    db_session.commit()
+
+    with pytest.raises(ObjectNotFoundException):
+        update_metadata_many(wid=workspace.id, body=[{'id': file_id, 'metadata': {'base': {'path': 'b'}}}])
+
+
+@pytest.mark.parametrize('metadata', [
+    {'base': {'size': 0}},
+    {'other': {'id': '00000000-0000-4000-8000-000000000000'}},
+    {'unknown': {'key': 'value'}},
+])
+def test_update_metadata_many_invalid(db_session, make_workspace, upload_file, metadata, mocker):
+    """Bulk changes are verified like the changes of a single file"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0})
+    file_id = upload_file(workspace=workspace)
+
+    with pytest.raises(APIException):
+        update_metadata_many(wid=workspace.id, body=[{'id': file_id, 'metadata': metadata}])
+
+
+def test_all_metadata_many_workspace(db_session, make_workspace, upload_file, mocker):
+    """The latest metadata of all families of many files is gathered at once"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0, 'empty': 0})
+    file_ids = [upload_file(workspace=workspace, name=f'file_{i}.txt') for i in range(2)]
+    update_metadata_many(wid=workspace.id, body=[{'id': file_ids[0], 'metadata': {'other': {'key': 'value'}}}])
+
+    gathered = _all_metadata_many(file_ids, workspace)
+
+    assert set(gathered) == set(file_ids)
+    assert set(gathered[file_ids[0]]) == {'base', 'other'}
+    assert gathered[file_ids[0]]['other'] == {'id': file_ids[0], 'key': 'value'}
+    assert set(gathered[file_ids[1]]) == {'base'}
+    assert gathered[file_ids[1]]['base']['filename'] == 'file_1.txt'
+    assert _all_metadata(file_ids[0], workspace) == gathered[file_ids[0]]
+
+
+def test_all_metadata_committed(db_session, committed_file):
+    """Without workspace, the committed metadata of all families is gathered"""
+    assert _all_metadata(committed_file['id']) == committed_file['metadata']
+
+
 def test_set_metadata_success():
     warnings.warn('Unit test not implemented', UserWarning)
 
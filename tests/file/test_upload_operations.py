@@ -0,0 +1,152 @@
+"""Unit tests for resumable uploads of files, using the local storage backend"""
+import hashlib
+import pathlib
+import urllib.parse
+from unittest import mock
+
+import pytest
+
+from quetzal.app.api.data.upload import create, details, finalize, upload_chunk
+from quetzal.app.api.exceptions import APIException
+from quetzal.app.models import Metadata
+
+
+def test_upload_chunks_success(app, db_session, local_workspace, user, mocker):
+    """A file uploaded in chunks out of order is assembled correctly"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    content = b'hello world, this is a chunked upload'
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'a/b/file.txt', 'size': len(content)}, user=user)
+    sid = session['id']
+
+    # Send chunks in reverse order, like a parallel upload could do
+    for offset in (30, 20, 10, 0):
+        chunk, _ = upload_chunk(wid=wid, sid=sid, offset=offset, body=content[offset:offset + 10])
+        assert chunk['checksum'] == hashlib.md5(content[offset:offset + 10]).hexdigest()
+
+    session, _ = details(wid=wid, sid=sid)
+    assert session['received'] == len(content)
+
+    with app.test_request_context():
+        session, code = finalize(wid=wid, sid=sid)
+
+    # The file is created by a task, which runs immediately on unit tests
+    assert code == 202
+    assert session['file_id'] is not None
+    file_details = Metadata.query.filter_by(id_file=session['file_id']).one().json
+    assert file_details['size'] == len(content)
+    assert file_details['checksum'] == hashlib.md5(content).hexdigest()
+    assert file_details['path'] == 'a/b'
+    assert file_details['filename'] == 'file.txt'
+    path = pathlib.Path(urllib.parse.urlparse(file_details['url']).path)
+    assert path.read_bytes() == content
+
+
+
+def test_upload_chunks_retry_finalize(app, db_session, local_workspace, user, mocker):
+    """Finalizing twice returns the same file"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt'}, user=user)
+    upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello world')
+
+    first, code1 = finalize(wid=wid, sid=session['id'])
+    second, code2 = finalize(wid=wid, sid=session['id'])
+    assert (code1, code2) == (202, 200)
+    assert second['id'] == first['file_id']
+
+
+def test_upload_chunks_missing_chunk(app, db_session, local_workspace, user, mocker):
+    """Finalizing fails when there is a gap in the chunks"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt'}, user=user)
+    upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello')
+    upload_chunk(wid=wid, sid=session['id'], offset=6, body=b'world')
+
+    with pytest.raises(APIException) as exc_info:
+        finalize(wid=wid, sid=session['id'])
+    assert exc_info.value.status == 412
+
+    # Sending the missing chunk makes it possible to finalize
+    upload_chunk(wid=wid, sid=session['id'], offset=5, body=b' ')
+    session, _ = finalize(wid=wid, sid=session['id'])
+    file_details = Metadata.query.filter_by(id_file=session['file_id']).one().json
+    assert file_details['checksum'] == hashlib.md5(b'hello world').hexdigest()
+
+
+def test_upload_chunk_exceeds_size(db_session, local_workspace, user, mocker):
+    """A chunk beyond the declared size is rejected"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt', 'size': 5}, user=user)
+    with pytest.raises(APIException):
+        upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello world')
+
+
+def test_upload_chunks_overlapping(app, db_session, local_workspace, user, mocker):
+    """Finalizing fails when two chunks overlap"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt'}, user=user)
+    upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello ')
+    upload_chunk(wid=wid, sid=session['id'], offset=4, body=b'o world')
+
+    with pytest.raises(APIException) as exc_info:
+        finalize(wid=wid, sid=session['id'])
+    assert exc_info.value.status == 412
+    assert exc_info.value.title == 'Overlapping chunks'
+    assert 'offset 4' in exc_info.value.detail
+
+
+def test_upload_chunks_too_many(app, db_session, local_workspace, user, mocker):
+    """Finalizing fails before reading any chunk when there are too many chunks"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch('quetzal.app.api.data.upload.MAX_UPLOAD_CHUNKS', 2)
+    assemble_mock = mocker.patch('quetzal.app.api.data.storage.assemble_chunks')
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt'}, user=user)
+    for offset in range(3):
+        upload_chunk(wid=wid, sid=session['id'], offset=offset, body=b'x')
+
+    with pytest.raises(APIException) as exc_info:
+        finalize(wid=wid, sid=session['id'])
+    assert exc_info.value.title == 'Too many chunks'
+    assemble_mock.assert_not_called()
+
+
+def test_upload_chunk_too_small(db_session, local_workspace, user, mocker):
+    """Chunks but the last one cannot be smaller than the minimum chunk size"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch('quetzal.app.api.data.upload.MAX_UPLOAD_CHUNKS', 2)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt', 'size': 10}, user=user)
+    with pytest.raises(APIException):
+        upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hell')
+    upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello')
+    upload_chunk(wid=wid, sid=session['id'], offset=5, body=b'world')
+
+
+def test_upload_chunks_failed_finalize(app, db_session, local_workspace, user, mocker):
+    """An upload can be finalized again when its finalization task fails"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    wid = local_workspace.id
+
+    session, _ = create(wid=wid, body={'filename': 'file.txt'}, user=user)
+    upload_chunk(wid=wid, sid=session['id'], offset=0, body=b'hello world')
+
+    with mock.patch('quetzal.app.api.data.storage.assemble_chunks', side_effect=IOError('disk full')):
+        session, code = finalize(wid=wid, sid=session['id'])
+    assert code == 202
+    session, _ = details(wid=wid, sid=session['id'])
+    assert (session['finalizing'], session['file_id']) == (False, None)
+
+    session, _ = finalize(wid=wid, sid=session['id'])
+    assert session['file_id'] is not None
@@ -1,6 +1,20 @@
+import hashlib
 import io
+import shutil
+import threading
+import time
+from unittest import mock
 
-from quetzal.app.helpers.files import get_readable_info
+import pytest
+from google.api_core.exceptions import NotFound
+
+from quetzal.app.helpers.cache import DiskCache
+from quetzal.app.helpers.files import (
+    compute_digests, get_readable_info, iter_archive, stream_archive, transfer_file, HashingReader
+)
+from quetzal.app.helpers.google_api import (
+    BlobReader, delete_blobs, get_bucket, get_client, get_object, split_location
+)
 
 
 def test_readable_info():
@@ -9,3 +23,314 @@ def test_readable_info():
     md5, size = get_readable_info(buffer)
     assert md5 == '5eb63bbbe01eeed093cb22bb8f5acdc3'
     assert size == 11
+
+
+def test_hashing_reader_single_read():
+    # Reading through the wrapper is enough to obtain the md5sum and size
+    buffer = io.BytesIO(b'hello world')
+    reader = HashingReader(buffer)
+    target = io.BytesIO()
+    shutil.copyfileobj(reader, target)
+    read_calls = buffer.read
+    assert target.getvalue() == b'hello world'
+    assert reader.hexdigest() == '5eb63bbbe01eeed093cb22bb8f5acdc3'
+    assert reader.size == 11
+    # finish does not need to read again
+    with mock.patch.object(buffer, 'read', wraps=read_calls) as read_mock:
+        assert reader.finish() == ('5eb63bbbe01eeed093cb22bb8f5acdc3', 11)
+        read_mock.assert_not_called()
+
+
+def test_hashing_reader_reread():
+    # Consumers that seek back and read again do not corrupt the md5sum
+    reader = HashingReader(io.BytesIO(b'hello world'))
+    reader.read(5)
+    reader.seek(0)
+    reader.read(8)
+    reader.seek(2)
+    reader.read()
+    assert reader.finish() == ('5eb63bbbe01eeed093cb22bb8f5acdc3', 11)
+
+
+def test_hashing_reader_partial_read():
+    # Contents that were not read by the consumer are read by finish
+    reader = HashingReader(io.BytesIO(b'hello world'))
+    reader.read(3)
+    assert reader.finish() == ('5eb63bbbe01eeed093cb22bb8f5acdc3', 11)
+    assert reader.tell() == 3
+
+
+def test_hashing_reader_digests():
+    # Other digests are computed from the same reads as the md5sum
+    reader = HashingReader(io.BytesIO(b'hello world'), digests=['sha256', 'crc32c'])
+    reader.read()
+    assert reader.finish() == ('5eb63bbbe01eeed093cb22bb8f5acdc3', 11)
+    assert reader.digests() == {
+        'sha256': 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9',
+        'crc32c': 'c99465aa',
+    }
+
+
+@pytest.mark.parametrize('mapped', [True, False])
+def test_compute_digests(tmp_path, mapped):
+    # Mapped files and streams from the current position give the same digests
+    content = b'skipped' + bytes(range(256)) * 10000
+    path = tmp_path / 'file'
+    path.write_bytes(content)
+    with open(path, 'rb') as f:
+        file_obj = f if mapped else io.BytesIO(f.read())
+        file_obj.seek(7)
+        digests, size = compute_digests(file_obj, ['md5', 'sha256'])
+        assert file_obj.tell() == len(content)
+    assert size == len(content) - 7
+    assert digests == {
+        'md5': hashlib.md5(content[7:]).hexdigest(),
+        'sha256': hashlib.sha256(content[7:]).hexdigest(),
+    }
+
+
+def test_iter_archive_not_archive():
+    with pytest.raises(ValueError):
+        iter_archive(io.BytesIO(b'hello world'))
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'zip'])
+def test_stream_archive(archive_format):
+    contents = {'a.txt': b'hello world' * 100, 'sub/b.bin': b'\x00\x01', 'empty': b''}
+    entries = ((name, len(data), io.BytesIO(data)) for name, data in contents.items())
+    chunks = list(stream_archive(entries, archive_format, chunk_size=64))
+
+    # The archive is generated by chunks, not at once
+    assert all(chunks) and len(chunks) > len(contents)
+    archive = io.BytesIO(b''.join(chunks))
+    assert {name: entry.read() for name, entry in iter_archive(archive)} == contents
+
+
+def test_stream_archive_wrong_size():
+    with pytest.raises(IOError):
+        list(stream_archive([('a.txt', 100, io.BytesIO(b'hello'))]))
+
+
+class _FakeBlob:
+    """A stand-in for a GCP blob that records its ranged downloads"""
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.ranges = []
+        self.reloads = 0
+
+    def reload(self, client=None):
+        self.reloads += 1
+        self.size = len(self.data)
+
+    def download_as_string(self, client=None, start=None, end=None):
+        self.ranges.append((start, end))
+        return self.data[start:end + 1]
+
+
+@pytest.mark.parametrize('size', [100, None])
+def test_blob_reader(size):
+    # Reading a blob downloads it by chunks of increasing size
+    blob = _FakeBlob(bytes(range(100)), size)
+    reader = BlobReader(blob, min_chunk_size=10, max_chunk_size=40)
+    assert reader.read() == blob.data
+    assert blob.ranges[:3] == [(0, 9), (10, 29), (30, 69)]
+    # The generation is pinned before the first chunk
+    assert blob.reloads == 1
+
+
+def test_blob_reader_range():
+    # Reading a range of a blob only downloads the bytes of that range
+    blob = _FakeBlob(bytes(range(100)), 100)
+    reader = BlobReader(blob, 15, 25, min_chunk_size=8)
+    reader.prefetch()
+    assert blob.ranges == [(15, 22)]
+    assert reader.read() == blob.data[15:25]
+    assert blob.ranges == [(15, 22), (23, 24)]
+
+
+def test_blob_reader_single_chunk():
+    # A blob read with a single request does not load its properties
+    blob = _FakeBlob(bytes(range(100)), 100)
+    reader = BlobReader(blob, min_chunk_size=128)
+    assert reader.read() == blob.data
+    assert blob.reloads == 0
+
+
+def test_transfer_file_link(tmp_path):
+    # On the same filesystem, a hard link is used and the source is kept
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    source.write_bytes(b'hello world')
+    target.write_bytes(b'previous contents')
+    assert transfer_file(source, target, move=True) == 'link'
+    assert source.stat().st_ino == target.stat().st_ino
+    assert target.read_bytes() == b'hello world'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['source', 'target']
+
+
+@pytest.mark.parametrize('move,strategy', [(True, 'rename'), (False, 'copy')])
+def test_transfer_file_fallback(tmp_path, move, strategy):
+    # Without links nor reflinks, the source is renamed only when permitted
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    source.write_bytes(b'hello world')
+    with mock.patch('os.link', side_effect=OSError), \
+            mock.patch('quetzal.app.helpers.files._reflink', side_effect=OSError):
+        assert transfer_file(source, target, move=move) == strategy
+    assert target.read_bytes() == b'hello world'
+    assert source.exists() != move
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.')]
+
+
+def test_delete_blobs_batches():
+    # Objects are deleted in batches of at most 100 calls
+    client = mock.MagicMock()
+    blobs = [mock.Mock() for _ in range(250)]
+    delete_blobs(iter(blobs), client=client)
+    assert client.batch.call_count == 3
+    for blob in blobs:
+        blob.delete.assert_called_once_with(client=client)
+
+
+def test_delete_blobs_missing():
+    # Missing objects fail the batch, unless they are ignored
+    client = mock.MagicMock()
+    client.batch.return_value.__exit__.side_effect = NotFound('missing')
+    blobs = [mock.Mock() for _ in range(150)]
+    with pytest.raises(NotFound):
+        delete_blobs(blobs, client=client)
+    delete_blobs(blobs, client=client, ignore_missing=True)
+    assert client.batch.call_count == 3
+    for blob in blobs[:100]:
+        assert blob.delete.call_count == 2
+
+
+def test_get_client_pool(app, mocker):
+    # Clients are created once per thread and credentials file
+    from_json = mocker.patch('google.cloud.storage.Client.from_service_account_json')
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_CREDENTIALS': 'pool-test.json'})
+    assert get_client() is get_client()
+    from_json.assert_called_once_with('pool-test.json')
+
+
+def test_get_bucket_cache(app, mocker):
+    # Bucket objects are created once per TTL, without any request
+    client = mock.MagicMock()
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_BUCKET_CACHE_TTL': 300})
+    bucket = get_bucket('gs://bucket-name', client=client)
+    assert get_bucket('gs://bucket-name/some/path', client=client) is bucket
+    blob = get_object('gs://bucket-name/some/path', client=client)
+    client.bucket.assert_called_once_with('bucket-name')
+    bucket.blob.assert_called_once_with('some/path')
+    assert blob is bucket.blob.return_value
+    assert not client.get_bucket.called
+
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_BUCKET_CACHE_TTL': 0})
+    get_bucket('gs://bucket-name', client=client)
+    assert client.bucket.call_count == 2
+
+
+def test_disk_cache_read_through(tmp_path):
+    # An entry is filled once, then read from the cache
+    cache = DiskCache(str(tmp_path), max_size=100)
+    source = mock.Mock(side_effect=lambda: io.BytesIO(b'hello world'))
+    for _ in range(3):
+        with cache.open(('gs://bucket/a', 'md5'), source) as f:
+            assert f.read() == b'hello world'
+    source.assert_called_once()
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 0}
+
+
+def test_disk_cache_failed_fill(tmp_path):
+    # A failed or incomplete fill does not leave any entry, complete or not
+    cache = DiskCache(str(tmp_path), max_size=100)
+
+    class FailingSource(io.RawIOBase):
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            raise RuntimeError('download failed')
+
+    with pytest.raises(RuntimeError):
+        with cache.open(('gs://bucket/a', 'md5'), FailingSource) as f:
+            f.read()
+    with cache.open(('gs://bucket/a', 'md5'), lambda: io.BytesIO(b'partial')) as f:
+        f.read(3)
+    assert cache.get(('gs://bucket/a', 'md5')) is None
+
+    with cache.open(('gs://bucket/a', 'md5'), lambda: io.BytesIO(b'complete')) as f:
+        assert f.read() == b'complete'
+    assert not list(tmp_path.glob('*/.*'))
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=25)
+    for name in 'ab':
+        with cache.open(name, lambda: io.BytesIO(b'0123456789')) as f:
+            f.read()
+        # Make the modification times different and increasing
+        time.sleep(0.01)
+    # Using "a" makes "b" the least recently used entry
+    cache.open('a', mock.Mock()).close()
+    time.sleep(0.01)
+    with cache.open('c', lambda: io.BytesIO(b'0123456789')) as f:
+        f.read()
+    assert cache.evictions == 1
+
+    source = mock.Mock(side_effect=lambda: io.BytesIO(b'0123456789'))
+    cache.open('a', source).close()
+    source.assert_not_called()
+    cache.open('b', source).close()
+    source.assert_called_once()
+
+
+def test_disk_cache_concurrent_miss(tmp_path):
+    # A miss of an entry that is being filled reads its source directly,
+    # and the entry is only filled once
+    cache = DiskCache(str(tmp_path), max_size=100)
+    source = mock.Mock(side_effect=lambda: io.BytesIO(b'hello world'))
+
+    filling = cache.open('key', source)
+    assert filling.read(5) == b'hello'
+    with cache.open('key', source) as f:
+        assert f.read() == b'hello world'
+    assert source.call_count == 2
+    assert cache.get('key') is None
+
+    # Misses of other entries are not blocked
+    with cache.open('other', source) as f:
+        assert f.read() == b'hello world'
+
+    assert filling.read() == b' world'
+    filling.close()
+    with cache.open('key', source) as f:
+        assert f.read() == b'hello world'
+    assert source.call_count == 3
+    assert cache.stats() == {'hits': 1, 'misses': 4, 'evictions': 0}
+
+
+def test_disk_cache_single_flight(tmp_path):
+    # A miss of an entry that is being filled waits for the fill, then reads
+    # the entry instead of its source
+    cache = DiskCache(str(tmp_path), max_size=100, fill_wait=5)
+    source = mock.Mock(side_effect=lambda: io.BytesIO(b'hello world'))
+
+    filling = cache.open('key', source)
+    timer = threading.Timer(0.1, lambda: (filling.read(), filling.close()))
+    timer.start()
+    with cache.open('key', source) as f:
+        assert f.read() == b'hello world'
+    timer.join()
+    source.assert_called_once()
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('gs://bucket', ('bucket', '')),
+    ('gs://bucket/', ('bucket', '')),
+    ('gs://bucket/workspaces/ws-1', ('bucket', 'workspaces/ws-1/')),
+    ('gs://bucket/workspaces/ws-1/', ('bucket', 'workspaces/ws-1/')),
+])
+def test_split_location(url, expected):
+    assert split_location(url) == expected
@@ -1,5 +1,7 @@
+from uuid import uuid4
+
 from quetzal.app.models import (
-    Family, MetadataQuery, Metadata, User, Role, Workspace
+    Family, MetadataHead, MetadataQuery, Metadata, User, Role, Workspace
 )
 
 
@@ -10,3 +12,60 @@ def test_registry(db):
                          if isinstance(cls, type) and issubclass(cls, db.Model))
     expected_set = {Family, Metadata, MetadataQuery, User, Role, Workspace}
     assert registered_set == expected_set
+
+
+def test_metadata_head_follows_changes(db_session, make_workspace, file_id):
+    """The head entry of a file follows new metadata and workspace commits"""
+    workspace = make_workspace(families={'base': 0})
+    family = workspace.get_base_family()
+    first = Metadata(id_file=file_id, family=family, json={'id': str(file_id), 'version': 1})
+    db_session.add(first)
+    db_session.commit()
+    second = first.copy().update({'version': 2})
+    db_session.add(second)
+    db_session.commit()
+
+    head = MetadataHead.query.filter_by(id_file=file_id).one()
+    assert (head.fk_workspace_id, head.fk_metadata_id) == (workspace.id, second.id)
+
+    # A commit detaches the family from its workspace: its metadata is global
+    family.workspace = None
+    family.version = 1
+    db_session.add(family)
+    db_session.commit()
+
+    head = MetadataHead.query.filter_by(id_file=file_id).one()
+    assert (head.fk_workspace_id, head.fk_metadata_id) == (None, second.id)
+    assert Metadata.get_latest_global(file_id, 'base').one().id == second.id
+
+
+def test_workspace_get_metadata_reference(db_session, make_workspace, make_family, file_id):
+    """A workspace only sees the global metadata until its reference"""
+    family_v1 = make_family(name='head-family', version=1)
+    old = Metadata(id_file=file_id, family=family_v1, json={'id': str(file_id), 'version': 1})
+    db_session.add(old)
+    db_session.commit()
+
+    workspace = make_workspace(families={'head-family': 1})
+    workspace.fk_last_metadata_id = old.id
+    db_session.add(workspace)
+    db_session.commit()
+
+    # Global changes after the workspace reference
+    family_v2 = make_family(name='head-family', version=2)
+    new = Metadata(id_file=file_id, family=family_v2, json={'id': str(file_id), 'version': 2})
+    other_id = uuid4()
+    other = Metadata(id_file=other_id, family=family_v2, json={'id': str(other_id)})
+    db_session.add_all([new, other])
+    db_session.commit()
+
+    assert [meta.id for meta in workspace.get_metadata()] == [old.id]
+    assert {meta.id for meta in Metadata.get_latest_global(family_name='head-family')} == {new.id, other.id}
+
+    # Changes on the workspace replace the global metadata
+    local = old.copy().update({'version': 3})
+    local.family = workspace.families.one()
+    db_session.add(local)
+    db_session.commit()
+
+    assert [meta.id for meta in workspace.get_metadata()] == [local.id]
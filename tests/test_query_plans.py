@@ -0,0 +1,124 @@
+"""Regression tests of the query plans of the metadata and family hot paths
+
+A large synthetic dataset is inserted and analyzed, and the plan of each
+query is verified to use the indexes designed for it instead of a
+sequential scan.
+"""
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from quetzal.app.models import Family, FileState, Metadata
+
+
+NUM_FILES = 3000
+NUM_NAMES = 10
+NUM_VERSIONS = 10
+
+
+@pytest.fixture(scope='function')
+def synthetic_metadata(db, db_session):
+    """Global families with many versions of the metadata of many files"""
+    db_session.execute(text("""
+        INSERT INTO family (name, version, description)
+        SELECT 'plan-' || (i % :names), i / :names + 1, ''
+        FROM generate_series(0, :names * :versions - 1) AS i
+    """), {'names': NUM_NAMES, 'versions': NUM_VERSIONS})
+    db_session.execute(text("""
+        INSERT INTO metadata (id_file, json, fk_family_id)
+        SELECT md5('plan' || f)::uuid,
+               jsonb_build_object('id', md5('plan' || f)::uuid,
+                                  'state', (ARRAY['READY', 'DELETED', 'TEMPORARY'])[1 + f % 3]),
+               family.id
+        FROM generate_series(0, :files - 1) AS f
+        JOIN family ON family.name = 'plan-' || (f % :names)
+        ORDER BY family.version, f
+    """), {'files': NUM_FILES, 'names': NUM_NAMES})
+    for table in ('family', 'metadata', 'metadata_head'):
+        db_session.execute(text(f'ANALYZE {table}'))
+
+    family = Family.query.filter_by(name='plan-0', version=NUM_VERSIONS).one()
+    file_id = db_session.query(Metadata.id_file).filter_by(fk_family_id=family.id).first()[0]
+    return family, file_id
+
+
+def _plan_nodes(db, query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = {key: str(value) if isinstance(value, uuid.UUID) else value
+              for key, value in compiled.params.items()}
+    plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(compiled), params).scalar()
+
+    nodes = []
+    pending = [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+
+def _assert_uses_index(nodes, table, expected_indexes):
+    scans = [node for node in nodes if node.get('Relation Name') == table]
+    assert scans, f'No scan of {table}'
+    for node in scans:
+        assert node['Node Type'] != 'Seq Scan', f'Sequential scan of {table}'
+    used = {node.get('Index Name') for node in nodes if node.get('Index Name')}
+    assert used & expected_indexes, f'{table} is scanned with {used}, not with {expected_indexes}'
+
+
+def test_plan_latest_in_family(db, synthetic_metadata):
+    """Metadata of a file in a family, as in Metadata.get_latest"""
+    family, file_id = synthetic_metadata
+    query = Metadata.query.filter(Metadata.id_file == file_id, Metadata.fk_family_id == family.id)
+    _assert_uses_index(_plan_nodes(db, query), 'metadata',
+                       {'ix_metadata_family_file', 'ix_metadata_id_file_id'})
+
+
+def test_plan_latest_global_version(db, synthetic_metadata):
+    """Latest global version of a file until a reference, as in Metadata.get_latest"""
+    family, file_id = synthetic_metadata
+    query = (
+        Metadata.query
+        .filter(Metadata.id_file == file_id, Metadata.id <= 10 ** 9)
+        .join(Family)
+        .filter(Family.name == family.name)
+        .order_by(Metadata.id.desc())
+        .limit(1)
+    )
+    _assert_uses_index(_plan_nodes(db, query), 'metadata', {'ix_metadata_id_file_id'})
+
+
+def test_plan_files_by_state(db, synthetic_metadata):
+    """Files of a family in a state, as in the commit task"""
+    family, _ = synthetic_metadata
+    query = family.metadata_set.filter(Metadata.json['state'].astext == FileState.READY.name)
+    _assert_uses_index(_plan_nodes(db, query), 'metadata',
+                       {'ix_metadata_family_state', 'ix_metadata_family_file'})
+
+
+def test_plan_latest_family_version(db, synthetic_metadata):
+    """Latest global version of a family, as in the workspace initialization"""
+    family, _ = synthetic_metadata
+    query = (
+        Family.query
+        .filter(Family.name == family.name, Family.fk_workspace_id.is_(None))
+        .order_by(Family.version.desc())
+        .limit(1)
+    )
+    _assert_uses_index(_plan_nodes(db, query), 'family', {'ix_family_name_workspace_version'})
+
+
+def test_plan_global_listing(db, synthetic_metadata):
+    """Page of the committed files of a family, as in the public file listing"""
+    family, _ = synthetic_metadata
+    query = Metadata.get_latest_global(family_name=family.name).limit(20)
+    _assert_uses_index(_plan_nodes(db, query), 'metadata_head',
+                       {'ix_metadata_head_global_family', 'uq_metadata_head_global'})
+
+
+def test_plan_filter_containment(db, synthetic_metadata):
+    """Metadata with a key and value, as in the file listing filters"""
+    _, file_id = synthetic_metadata
+    query = Metadata.query.filter(Metadata.json.contains({'id': str(file_id)}))
+    _assert_uses_index(_plan_nodes(db, query), 'metadata', {'ix_metadata_json'})
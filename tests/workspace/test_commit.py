@@ -1,8 +1,13 @@
 """Unit tests for committing a workspace and detecting conflicts """
+import pathlib
+import urllib.parse
+
 import pytest
 
-from quetzal.app.api.data.tasks import merge
+from quetzal.app.api.data.file import create
+from quetzal.app.api.data.tasks import commit_workspace, merge
 from quetzal.app.api.exceptions import Conflict
+from quetzal.app.models import DataObject, DataObjectReference, Metadata, WorkspaceState
 
 
 def test_commit_success():
@@ -45,6 +50,73 @@ def test_commit_success_metadata_modification():
     raise NotImplementedError
 
 
+def test_commit_deduplicates_contents(app, db_session, local_workspace, user, make_file, mocker):
+    """Files with the same contents are stored once on commit"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    content = b'the same raw recording'
+    with app.test_request_context():
+        first, _ = create(wid=local_workspace.id, content=make_file(name='a', content=content), user=user)
+        second, _ = create(wid=local_workspace.id, content=make_file(name='b', content=content), user=user)
+
+    local_workspace._state = WorkspaceState.COMMITTING
+    db_session.add(local_workspace)
+    db_session.commit()
+    commit_workspace(local_workspace.id)
+
+    assert local_workspace.state == WorkspaceState.READY
+    data_object = DataObject.query.filter_by(checksum=first['checksum'], size=len(content)).one()
+    urls = {Metadata.get_latest_global(file_id, 'base').one().json['url']
+            for file_id in (first['id'], second['id'])}
+    assert urls == {data_object.url}
+    assert pathlib.Path(urllib.parse.urlparse(data_object.url).path).read_bytes() == content
+    assert data_object.references.count() == 2
+    assert DataObjectReference.query.get(first['id']).data_object == data_object
+
+
+def test_commit_concurrent_transfers(app, db_session, local_workspace, user, make_file, mocker):
+    """Files transferred concurrently on commit get the url of their contents"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    mocker.patch.dict(app.config, {'QUETZAL_FILE_COMMIT_WORKERS': 3})
+    contents = {}
+    with app.test_request_context():
+        for i in range(10):
+            content = f'file number {i}'.encode()
+            details, _ = create(wid=local_workspace.id, content=make_file(name=f'f{i}', content=content), user=user)
+            contents[details['id']] = content
+
+    local_workspace._state = WorkspaceState.COMMITTING
+    db_session.add(local_workspace)
+    db_session.commit()
+    commit_workspace(local_workspace.id)
+
+    assert local_workspace.state == WorkspaceState.READY
+    for file_id, content in contents.items():
+        url = Metadata.get_latest_global(file_id, 'base').one().json['url']
+        assert pathlib.Path(urllib.parse.urlparse(url).path).read_bytes() == content
+
+
+def test_commit_upload_same_path(app, db_session, local_workspace, user, make_file, mocker):
+    """Uploading a file where a committed file was does not change the committed contents"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    content = b'committed contents'
+    with app.test_request_context():
+        first, _ = create(wid=local_workspace.id, content=make_file(name='a', content=content), user=user)
+        other, _ = create(wid=local_workspace.id, content=make_file(name='b', content=content), user=user)
+
+    local_workspace._state = WorkspaceState.COMMITTING
+    db_session.add(local_workspace)
+    db_session.commit()
+    commit_workspace(local_workspace.id)
+    assert local_workspace.state == WorkspaceState.READY
+
+    with app.test_request_context():
+        create(wid=local_workspace.id, content=make_file(name='a', content=b'new contents'), user=user)
+
+    for file_id in (first['id'], other['id']):
+        url = Metadata.get_latest_global(file_id, 'base').one().json['url']
+        assert pathlib.Path(urllib.parse.urlparse(url).path).read_bytes() == content
+
+
 @pytest.mark.parametrize('predecessor,theirs,mine,expected', [
     ({}, {}, {}, {}),                          # No change at all
     ({}, {}, {'x': 1}, {'x': 1}),              # Mine branch adds
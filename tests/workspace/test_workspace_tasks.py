@@ -211,6 +211,19 @@ def test_init_data_bucket_correct_api(db, db_session, make_workspace, mocker):
     }
 
 
+def test_init_data_bucket_shared(app, db, db_session, make_workspace, mocker):
+    """Init data bucket on a shared bucket does not send any API request"""
+    mocker.patch.dict(app.config, {'QUETZAL_GCP_WORKSPACE_BUCKET': 'gs://shared-bucket/workspaces'})
+    request_mock = mocker.patch('google.cloud._http.JSONConnection.api_request')
+
+    w = make_workspace(state=WorkspaceState.INITIALIZING)
+    init_data_bucket(w.id)
+
+    request_mock.assert_not_called()
+    assert w.state == WorkspaceState.READY
+    assert w.data_url.startswith('gs://shared-bucket/workspaces/quetzal-ws-')
+
+
 def test_init_data_bucket_missing(db_session):
     """Init data bucket fails when the workspace does not exist"""
     # Get the latest workspace id in order to request one that does not exist
@@ -253,9 +266,8 @@ def test_delete_workspace_task_correct_api(db_session, make_workspace, mocker):
                  return_value=Client(project='mock-project'))
     request_mock = mocker.patch('google.cloud._http.JSONConnection.api_request')
     request_mock.side_effect = [
-        {},  # First call is when the Bucket information is retrieved
-        {},  # Second call is to list all bucket objects
-        {},  # Third call is to delete the bucket
+        {},  # First call is to list all bucket objects
+        {},  # Second call is to delete the bucket
     ]
 
     w = make_workspace(state=WorkspaceState.DELETING, data_url='gs://bucket-name')
@@ -270,6 +282,27 @@ def test_delete_workspace_task_correct_api(db_session, make_workspace, mocker):
     assert 'data' not in request_kwargs
 
 
+def test_delete_workspace_task_shared(app, db_session, make_workspace, mocker):
+    """Delete workspace on a shared bucket only deletes the objects of its prefix"""
+    mocker.patch('google.auth.default',
+                 return_value=(None, 'mock-project'))
+    mocker.patch('quetzal.app.api.data.tasks.get_client',
+                 return_value=Client(project='mock-project'))
+    request_mock = mocker.patch('google.cloud._http.JSONConnection.api_request')
+    request_mock.return_value = {}
+
+    w = make_workspace(state=WorkspaceState.DELETING, data_url='gs://shared-bucket/workspaces/ws-name')
+    delete_workspace(w.id)
+
+    # The only request lists the objects of the prefix; the bucket is kept
+    request_kwargs = request_mock.call_args[-1]
+    assert request_mock.call_count == 1
+    assert request_kwargs['method'] == 'GET'
+    assert request_kwargs['path'] == '/b/shared-bucket/o'
+    assert request_kwargs['query_params']['prefix'] == 'workspaces/ws-name/'
+    assert w.state == WorkspaceState.DELETED
+
+
 def test_delete_workspace_task_missing(db_session):
     """Delete workspace fails when the workspace does not exist"""
     # Get the latest workspace id in order to request one that does not exist